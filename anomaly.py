@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""
+Streaming anomaly and change-point detection on monthly ΔY.
+
+ChangeDetector follows every series of the ΔY matrix (the "dY_matrix"
+pipeline stage, or the national dY of delta_Y.py) one month at a time,
+keeping only O(1) state per series:
+
+  - exponentially weighted sums for an AR(1)-with-mean regression of ΔY_t
+    on ΔY_{t-1} (the bounce-back model), from which each new month gets a
+    one-step forecast and residual standard deviation;
+  - a two-sided CUSUM of the standardised one-step residuals.
+
+Each month's ΔY is scored as z = (ΔY - forecast) / sd before it is added
+to the sums. |z| > threshold is an "outlier"; a CUSUM above h is a
+"shift_up"/"shift_down" change point, after which that CUSUM restarts.
+Residuals enter the CUSUM and the regression clipped at `clip` sd, so one
+surge neither trips the change-point test on its own nor distorts the
+model; the following month is still forecast from the raw surge, so the
+expected revert is not flagged. Missing months (NaN) are skipped.
+
+    python anomaly.py [--series national|all] [--threshold 3.5] [--forgetting 1.0] [--out alerts.csv]
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from instrument import traced
+
+THRESHOLD = 3.5
+CUSUM_K = 0.5
+CUSUM_H = 5.0
+CLIP = 3.0
+WARMUP = 6  # month pairs seen before a series is scored
+ALERT_COLUMNS = ["YEAR_MONTH", "kind", "dY", "expected", "z", "cusum"]
+
+
+class ChangeDetector:
+    """
+    Vectorized one-step scoring and CUSUM change points for `n_series`
+    series; update() takes the next ΔY of every series.
+    """
+
+    def __init__(self, n_series, threshold=THRESHOLD, k=CUSUM_K, h=CUSUM_H, clip=CLIP,
+                 forgetting=1.0, warmup=WARMUP):
+        if not 0 < forgetting <= 1:
+            raise ValueError(f"forgetting must be in (0, 1], got {forgetting}")
+        # The weight of the sums tends to 1/(1-forgetting); the residual
+        # variance needs more than 2, so below this nothing is ever scored.
+        if forgetting <= 0.5:
+            raise ValueError(f"forgetting must be above 0.5 for any series to be scored, got {forgetting}")
+        self.threshold, self.k, self.h, self.clip = threshold, k, h, clip
+        self.forgetting, self.warmup = forgetting, warmup
+        zeros = lambda: np.zeros(n_series)
+        self.w, self.sx, self.st, self.sxx, self.stt, self.sxt = (zeros() for _ in range(6))
+        self.pairs = np.zeros(n_series, dtype=np.int64)  # unweighted, for the warm-up
+        self.g_up, self.g_down = zeros(), zeros()
+        self.last = np.full(n_series, np.nan)
+
+    def predict(self):
+        """
+        One-step forecast and residual sd of the next ΔY (NaN where a
+        series has not seen `warmup` month pairs).
+        """
+        w = self.w
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mx, mt = self.sx / w, self.st / w
+            cxx = self.sxx - w * mx * mx
+            cxt = self.sxt - w * mx * mt
+            ctt = self.stt - w * mt * mt
+            phi = np.where(cxx > 0, cxt / cxx, 0.0)
+            s2 = (ctt - phi * cxt) / (w - 2)
+            expected = mt + phi * (self.last - mx)
+            sd = np.sqrt(np.maximum(s2, 0))
+        ready = (self.pairs >= self.warmup) & (w > 2) & (sd > 0)
+        return np.where(ready, expected, np.nan), np.where(ready, sd, np.nan)
+
+    def update(self, dy):
+        """
+        Scores the next ΔY of every series and folds it into the state.
+
+        Returns a dict of per-series arrays: dY, expected, sd, z, cusum
+        (the larger side, signed) and the boolean alerts outlier,
+        shift_up and shift_down.
+        """
+        dy = np.asarray(dy, dtype=np.float64)
+        expected, sd = self.predict()
+        with np.errstate(invalid="ignore"):
+            z = (dy - expected) / sd
+        scored = np.isfinite(z)
+        zc = np.clip(np.where(scored, z, 0.0), -self.clip, self.clip)
+
+        self.g_up = np.where(scored, np.maximum(0, self.g_up + zc - self.k), self.g_up)
+        self.g_down = np.where(scored, np.maximum(0, self.g_down - zc - self.k), self.g_down)
+        shift_up, shift_down = self.g_up > self.h, self.g_down > self.h
+        cusum = np.where(self.g_up >= self.g_down, self.g_up, -self.g_down)
+        self.g_up[shift_up] = 0
+        self.g_down[shift_down] = 0
+
+        # The regression sees the clipped value; the next forecast uses the raw one.
+        target = np.where(scored, expected + zc * sd, dy)
+        pair = np.isfinite(self.last) & np.isfinite(target)
+        x, t = np.where(pair, self.last, 0.0), np.where(pair, target, 0.0)
+        lam = self.forgetting
+        self.pairs += pair
+        self.w = lam * self.w + pair
+        self.sx = lam * self.sx + x
+        self.st = lam * self.st + t
+        self.sxx = lam * self.sxx + x * x
+        self.stt = lam * self.stt + t * t
+        self.sxt = lam * self.sxt + x * t
+        self.last = dy
+
+        return {"dY": dy, "expected": expected, "sd": sd, "z": z, "cusum": cusum,
+                "outlier": scored & (np.abs(z) > self.threshold),
+                "shift_up": shift_up, "shift_down": shift_down}
+
+
+def _no_alerts(index):
+    return pd.DataFrame(columns=ALERT_COLUMNS[:2] + list(index.columns) + ALERT_COLUMNS[2:])
+
+
+def alert_frame(result, month, index):
+    """
+    One row per alert in an update() result, labelled with the series'
+    `index` row (a DataFrame aligned with the series).
+    """
+    frames = []
+    for kind in ("outlier", "shift_up", "shift_down"):
+        rows = np.flatnonzero(result[kind])
+        if not len(rows):
+            continue
+        frame = index.iloc[rows].reset_index(drop=True)
+        frame.insert(0, "YEAR_MONTH", month)
+        frame.insert(1, "kind", kind)
+        for col in ("dY", "expected", "z", "cusum"):
+            frame[col] = result[col][rows]
+        frames.append(frame)
+    return pd.concat(frames, ignore_index=True) if frames else _no_alerts(index)
+
+
+@traced("diagnose")
+def detect(dY, months, index, **params):
+    """
+    Streams the (n_series, n_months) ΔY matrix through a ChangeDetector a
+    month at a time and returns the alert table.
+    """
+    dY = np.atleast_2d(dY)
+    detector = ChangeDetector(len(dY), **params)
+    alerts = [alert_frame(detector.update(dY[:, j]), int(months[j]), index)
+              for j in range(dY.shape[1])]
+    alerts = [a for a in alerts if len(a)]
+    return pd.concat(alerts, ignore_index=True) if alerts else _no_alerts(index)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--series", choices=["national", "all"], default="all",
+                        help="national monthly ITEMS, or every region x drug series of ITEMS and COST")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD)
+    parser.add_argument("--forgetting", type=float, default=1.0)
+    parser.add_argument("--out", help="write the alert table to this CSV")
+    args = parser.parse_args()
+
+    from pipeline import Pipeline
+    pipe = Pipeline()
+    if args.series == "national":
+        months = pipe.get("monthly_totals")["YEAR_MONTH"].to_numpy()
+        dY = pipe.get("dY").to_numpy(dtype=np.float64)[None, :]
+        index = pd.DataFrame({"MEASURE": ["ITEMS"], "REGION_NAME": ["(all regions)"],
+                              "BNF_CHEMICAL_SUBSTANCE": ["(all drugs)"]})
+    else:
+        dY, index, months = pipe.get("dY_matrix")
+
+    params = {"threshold": args.threshold, "forgetting": args.forgetting}
+    detector = ChangeDetector(len(dY), **params)
+    start = time.perf_counter()
+    for j in range(dY.shape[1]):
+        detector.update(dY[:, j])
+    per_month = (time.perf_counter() - start) / dY.shape[1]
+
+    alerts = detect(dY, months, index, **params)
+    print(f"{len(dY)} series x {dY.shape[1]} months: update {per_month*1e6:.0f} us per month "
+          f"({per_month / len(dY)*1e9:.0f} ns per series)")
+    print(alerts["kind"].value_counts().reindex(["outlier", "shift_up", "shift_down"], fill_value=0)
+          .to_string())
+    with pd.option_context("display.width", 200, "display.max_columns", None,
+                           "display.float_format", "{:,.3f}".format):
+        latest = alerts[alerts["YEAR_MONTH"] == alerts["YEAR_MONTH"].max()] if len(alerts) else alerts
+        print(f"\nAlerts in the latest alerted month:\n{latest.to_string(index=False)}")
+    if args.out:
+        alerts.to_csv(args.out, index=False)
+        print(f"\nWrote {len(alerts)} alerts to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
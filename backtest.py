@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""
+Rolling-origin (expanding-window) backtest of the ARIMA(1,1,0)+drift model.
+
+Instead of the single split in prediction.py (test_size = 5), the model is
+refitted at every possible forecast origin and each origin's 1..H step
+forecasts are scored against what actually happened: MAE, MAPE and the
+coverage of the 50/70/90% intervals used in prediction.py's conf_levels.
+
+Two engines:
+
+  numpy        the sufficient statistics of arima110 are cumulated along
+               time, so the fits for every origin (and every series) extend
+               the previous origin's state and run in one vectorized pass.
+  statsmodels  the ARIMA used in prediction.py. Origins are split into
+               contiguous blocks that run concurrently in a process pool;
+               within a block each refit is warm-started from the previous
+               origin's parameters.
+
+    python backtest.py [--engine numpy|statsmodels] [--horizon 5] [--min-train 12] [--series national|all]
+"""
+import argparse
+import os
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from statistics import NormalDist
+
+import numpy as np
+import pandas as pd
+
+from arima110 import fit_arima110, fit_from_stats
+from instrument import traced
+
+CONF_LEVELS = [0.90, 0.70, 0.50]
+
+
+def _expanding_stats(y, origins):
+    """
+    ar1_stats for every prefix y[:, :o], o in `origins`, via cumulative sums.
+
+    Returns a stats dict of flat arrays ordered (series, origin).
+    """
+    z = np.diff(y, axis=1)
+    shift = z.mean(axis=1)
+    zc = z - shift[:, None]
+    zero = np.zeros((len(y), 1))
+    c1 = np.hstack([zero, np.cumsum(zc, axis=1)])
+    c2 = np.hstack([zero, np.cumsum(zc * zc, axis=1)])
+    cp = np.hstack([zero, np.cumsum(zc[:, :-1] * zc[:, 1:], axis=1)])
+
+    n = np.asarray(origins) - 1  # differences available at each origin
+    stats = {
+        "n": np.broadcast_to(n, (len(y), len(n))).astype(np.float64),
+        "shift": np.repeat(shift[:, None], len(n), axis=1),
+        "z1": np.repeat(zc[:, :1], len(n), axis=1),
+        "sx": c1[:, n - 1],
+        "st": c1[:, n] - c1[:, [1]],
+        "sxx": c2[:, n - 1],
+        "stt": c2[:, n] - c2[:, [1]],
+        "sxt": cp[:, n - 1],
+    }
+    return {k: v.ravel() for k, v in stats.items()}
+
+
+def _numpy_forecasts(y, origins, horizon):
+    stats = _expanding_stats(y, origins)
+    idx = np.asarray(origins)
+    last_y = y[:, idx - 1].ravel()
+    last_dy = (y[:, idx - 1] - y[:, idx - 2]).ravel()
+    fit = fit_from_stats(stats, last_y, last_dy)
+    mean, var = fit.forecast_moments(horizon)
+    shape = (len(y), len(idx), horizon)
+    return mean.reshape(shape), np.sqrt(var).reshape(shape)
+
+
+def _statsmodels_block(y, origins, horizon, start_params):
+    from statsmodels.tsa.arima.model import ARIMA
+
+    warnings.simplefilter("ignore")
+    mean = np.full((len(origins), horizon), np.nan)
+    sd = np.full((len(origins), horizon), np.nan)
+    params = start_params
+    for k, o in enumerate(origins):
+        res = ARIMA(y[:o], order=(1,1,0), trend="t").fit(start_params=params)
+        params = res.params
+        fc = res.get_forecast(steps=horizon)
+        mean[k] = fc.predicted_mean
+        sd[k] = np.sqrt(fc.var_pred_mean)
+    return mean, sd
+
+
+def _statsmodels_forecasts(y, origins, horizon, jobs):
+    from statsmodels.tsa.arima.model import ARIMA
+
+    jobs = jobs or os.cpu_count()
+    blocks = [b for b in np.array_split(np.asarray(origins), jobs) if len(b)]
+    means, sds = [], []
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        for series in y:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                seed = ARIMA(series[:origins[0]], order=(1,1,0), trend="t").fit().params
+            parts = list(pool.map(_statsmodels_block, [series] * len(blocks), blocks,
+                                  [horizon] * len(blocks), [seed] * len(blocks)))
+            means.append(np.vstack([p[0] for p in parts]))
+            sds.append(np.vstack([p[1] for p in parts]))
+    return np.stack(means), np.stack(sds)
+
+
+@traced("fit")
+def backtest(y, horizon=5, min_train=12, engine="numpy", levels=CONF_LEVELS, jobs=None):
+    """
+    Rolling-origin backtest of each row of `y` (levels, n_series x n_months).
+
+    Returns a DataFrame indexed by forecast horizon (plus an "all" row) with
+    MAE, MAPE (%), interval coverage for each level and the number of scored
+    forecasts.
+    """
+    y = np.atleast_2d(np.asarray(y, dtype=np.float64))
+    T = y.shape[1]
+    origins = list(range(min_train, T))
+    if engine == "numpy":
+        mean, sd = _numpy_forecasts(y, origins, horizon)
+    else:
+        mean, sd = _statsmodels_forecasts(y, origins, horizon, jobs)
+
+    # actual[s, k, h] = y[s, origin_k + h], NaN past the end of the data
+    cols = np.asarray(origins)[:, None] + np.arange(horizon)[None, :]
+    padded = np.hstack([y, np.full((len(y), horizon), np.nan)])
+    actual = padded[:, cols]
+    return score(actual, mean, sd, levels)
+
+
+def score(actual, mean, sd, levels=CONF_LEVELS):
+    """
+    Error metrics by horizon (last axis) over every series and origin.
+    """
+    err = np.abs(actual - mean)
+    valid = np.isfinite(err)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ape = np.where(actual != 0, err / np.abs(actual), np.nan) * 100
+
+    def summarise(axis):
+        out = {
+            "MAE": np.nanmean(err, axis=axis),
+            "MAPE": np.nanmean(ape, axis=axis),
+        }
+        for level in levels:
+            q = NormalDist().inv_cdf(0.5 + level / 2)
+            covered = np.where(valid, err <= q * sd, np.nan)
+            out[f"coverage_{int(level*100)}"] = np.nanmean(covered, axis=axis)
+        out["n"] = valid.sum(axis=axis)
+        return out
+
+    by_h = pd.DataFrame(summarise((0, 1)), index=pd.Index(np.arange(1, err.shape[-1] + 1), name="horizon"))
+    overall = pd.DataFrame({k: [v] for k, v in summarise(None).items()}, index=["all"])
+    return pd.concat([by_h, overall])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--engine", choices=["numpy", "statsmodels"], default="numpy")
+    parser.add_argument("--horizon", type=int, default=5)
+    parser.add_argument("--min-train", type=int, default=12)
+    parser.add_argument("--series", choices=["national", "all"], default="national",
+                        help="national monthly ITEMS, or every region x drug series of ITEMS and COST")
+    parser.add_argument("--jobs", type=int, default=None)
+    args = parser.parse_args()
+
+    from cube import load_cube
+    cube = load_cube()
+    if args.series == "national":
+        y = cube.monthly_totals(["ITEMS"])["ITEMS"].to_numpy(dtype=np.float64)[None, :]
+    else:
+        from batch_forecast import MIN_OBSERVATIONS, build_series
+        y, _ = build_series(cube)
+        y = y[np.count_nonzero(y, axis=1) >= MIN_OBSERVATIONS]
+
+    def full_sample_fit():
+        if args.engine == "numpy":
+            return fit_arima110(y)
+        from statsmodels.tsa.arima.model import ARIMA
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            for series in y:
+                ARIMA(series, order=(1,1,0), trend="t").fit()
+
+    full_sample_fit()  # warm-up: imports and first-call overhead
+    start = time.perf_counter()
+    full_sample_fit()
+    single = time.perf_counter() - start
+
+    start = time.perf_counter()
+    table = backtest(y, horizon=args.horizon, min_train=args.min_train,
+                     engine=args.engine, jobs=args.jobs)
+    elapsed = time.perf_counter() - start
+
+    n_origins = y.shape[1] - args.min_train
+    print(f"Rolling-origin backtest ({args.engine}): {len(y)} series x {n_origins} origins, "
+          f"horizon {args.horizon}")
+    with pd.option_context("display.float_format", "{:,.3f}".format):
+        print(table)
+    print(f"Backtest {elapsed:.3f}s vs one full-sample fit {single:.3f}s "
+          f"({elapsed / single:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
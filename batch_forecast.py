@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""
+Batch ARIMA(1,1,0) forecasting for every REGION_NAME x BNF_CHEMICAL_SUBSTANCE
+series, for ITEMS and COST, fanned out over a process pool.
+
+The series are taken from the cube and written once to a memory-mapped .npy
+file; workers open it read-only, so the input is shared rather than pickled
+to every process. Each series is fitted with the same
+ARIMA(y, order=(1,1,0), trend="t") used in prediction.py. The result is one
+tidy table with a row per series and forecast step: parameters, predicted
+mean and the 50/70/90% interval bounds. Series that fail, do not converge or
+are too short are reported in the STATUS column instead of stopping the run.
+
+With --engine numpy every series is fitted in one vectorized pass by
+arima110.fit_arima110() instead of one statsmodels MLE per series.
+
+    python batch_forecast.py [--engine statsmodels|numpy] [--steps N] [--jobs N] [--out forecasts.csv]
+"""
+import argparse
+import os
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from cube import MEASURES, load_cube, to_units
+from instrument import traced
+from loader import CACHE_DIR
+
+CONF_LEVELS = [0.90, 0.70, 0.50]
+MIN_OBSERVATIONS = 12
+PARAM_NAMES = ["x1", "ar.L1", "sigma2"]
+
+_SERIES = None  # memory-mapped (n_series, n_months) array, set per worker
+
+
+def build_series(cube, measures=MEASURES):
+    """
+    Stacks every region x drug series of each measure into one matrix.
+
+    Returns (values, index) where values is (n_series, n_months) float64 and
+    index is a DataFrame of MEASURE, REGION_NAME, BNF_CHEMICAL_SUBSTANCE.
+    """
+    m, r, d = cube.shape
+    blocks, keys = [], []
+    for measure in measures:
+        blocks.append(to_units(measure, cube.values(measure).reshape(m, r * d).T).astype(np.float64))
+        keys.append(pd.DataFrame({
+            "MEASURE": measure,
+            "REGION_NAME": np.repeat(cube.regions, d),
+            "BNF_CHEMICAL_SUBSTANCE": np.tile(cube.drugs, r),
+        }))
+    return np.vstack(blocks), pd.concat(keys, ignore_index=True)
+
+
+def future_months(last_month, steps):
+    """
+    The `steps` YEAR_MONTH values (YYYYMM) following `last_month`.
+    """
+    year, month = divmod(int(last_month), 100)
+    out = []
+    for _ in range(steps):
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+        out.append(year * 100 + month)
+    return out
+
+
+def _init_worker(series_path):
+    global _SERIES
+    _SERIES = np.load(series_path, mmap_mode="r")
+    warnings.simplefilter("ignore")
+
+
+def fit_one(y, steps, conf_levels=CONF_LEVELS):
+    """
+    Fits ARIMA(1,1,0)+trend to `y` and forecasts `steps` ahead.
+
+    Returns (status, params dict, mean array, {level: (lower, upper)}).
+    """
+    from statsmodels.tools.sm_exceptions import ConvergenceWarning
+    from statsmodels.tsa.arima.model import ARIMA
+
+    if np.count_nonzero(y) < MIN_OBSERVATIONS:
+        return "skipped: too few non-zero months", {}, None, {}
+
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always", ConvergenceWarning)
+        results = ARIMA(y, order=(1,1,0), trend="t").fit()
+    converged = results.mle_retvals.get("converged", True) if results.mle_retvals else True
+    if not converged or any(issubclass(w.category, ConvergenceWarning) for w in caught):
+        status = "not converged"
+    else:
+        status = "ok"
+
+    params = dict(zip(results.param_names, np.asarray(results.params)))
+    params["aic"] = results.aic
+    forecast = results.get_forecast(steps=steps)
+    intervals = {conf: np.asarray(forecast.conf_int(alpha=1.0 - conf)) for conf in conf_levels}
+    return status, params, np.asarray(forecast.predicted_mean), intervals
+
+
+def _fit_chunk(rows, steps):
+    out = []
+    for i in rows:
+        y = np.asarray(_SERIES[i], dtype=np.float64)
+        try:
+            out.append((i, *fit_one(y, steps)))
+        except Exception as exc:  # one bad series must not stop the batch
+            out.append((i, f"failed: {type(exc).__name__}: {exc}", {}, None, {}))
+    return out
+
+
+def _tidy(index, fits, months, steps):
+    records = []
+    for i, status, params, mean, intervals in fits:
+        key = index.iloc[i]
+        for h in range(steps):
+            rec = {
+                "MEASURE": key["MEASURE"],
+                "REGION_NAME": key["REGION_NAME"],
+                "BNF_CHEMICAL_SUBSTANCE": key["BNF_CHEMICAL_SUBSTANCE"],
+                "STATUS": status,
+                "STEP": h + 1,
+                "YEAR_MONTH": months[h],
+            }
+            for name in PARAM_NAMES + ["aic"]:
+                rec[name] = params.get(name, np.nan)
+            rec["mean"] = mean[h] if mean is not None else np.nan
+            for conf in CONF_LEVELS:
+                lo, hi = intervals[conf][h] if conf in intervals else (np.nan, np.nan)
+                rec[f"lower_{int(conf*100)}"] = lo
+                rec[f"upper_{int(conf*100)}"] = hi
+            records.append(rec)
+    return pd.DataFrame.from_records(records)
+
+
+def _numpy_status(fit):
+    """
+    Per-series STATUS of an arima110 fit, matching what fit_one reports.
+    """
+    from arima110 import PHI_BOUND
+
+    finite = np.isfinite(fit.drift) & np.isfinite(fit.ar_L1) & np.isfinite(fit.sigma2) & np.isfinite(fit.aic)
+    status = np.full(len(fit.drift), "ok", dtype=object)
+    status[np.abs(fit.ar_L1) >= PHI_BOUND] = "not converged"
+    status[~finite | ~(fit.sigma2 > 0)] = "failed: degenerate fit"
+    return status
+
+
+def _fit_numpy(values, steps):
+    from arima110 import fit_arima110
+
+    fit = fit_arima110(values)
+    mean, intervals = fit.forecast(steps, CONF_LEVELS)
+    status = _numpy_status(fit)
+    too_short = np.count_nonzero(values, axis=1) < MIN_OBSERVATIONS
+    fits = []
+    for i in range(len(values)):
+        if too_short[i]:
+            fits.append((i, "skipped: too few non-zero months", {}, None, {}))
+            continue
+        params = {"x1": fit.drift[i], "ar.L1": fit.ar_L1[i], "sigma2": fit.sigma2[i], "aic": fit.aic[i]}
+        fits.append((i, status[i], params, mean[i], {c: np.c_[lo[i], hi[i]] for c, (lo, hi) in intervals.items()}))
+    return fits
+
+
+@traced("fit")
+def forecast_all(cube, steps=5, measures=MEASURES, jobs=None, chunk=32, limit=None,
+                 cache_dir=CACHE_DIR, engine="statsmodels"):
+    """
+    Fits and forecasts every region x drug series; returns the tidy table.
+    """
+    values, index = build_series(cube, measures)
+    if limit:
+        values, index = values[:limit], index.iloc[:limit]
+    months = future_months(cube.months[-1], steps)
+    if engine == "numpy":
+        return _tidy(index, _fit_numpy(values, steps), months, steps)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    series_path = os.path.join(cache_dir, f"batch_series.{os.getpid()}.npy")
+    np.save(series_path, values)
+    try:
+        chunks = [range(s, min(s + chunk, len(values))) for s in range(0, len(values), chunk)]
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                                 initargs=(series_path,)) as pool:
+            fits = [f for part in pool.map(_fit_chunk, chunks, [steps] * len(chunks)) for f in part]
+    finally:
+        os.remove(series_path)
+
+    return _tidy(index, fits, months, steps)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--engine", choices=["statsmodels", "numpy"], default="statsmodels")
+    parser.add_argument("--steps", type=int, default=5)
+    parser.add_argument("--jobs", type=int, default=os.cpu_count())
+    parser.add_argument("--measures", nargs="+", default=list(MEASURES), choices=MEASURES)
+    parser.add_argument("--limit", type=int, help="only fit the first N series (for a quick check)")
+    parser.add_argument("--out", default="forecasts.csv")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    table = forecast_all(load_cube(), steps=args.steps, measures=args.measures,
+                         jobs=args.jobs, limit=args.limit, engine=args.engine)
+    table.to_csv(args.out, index=False)
+    elapsed = time.perf_counter() - start
+
+    per_series = table.drop_duplicates(["MEASURE", "REGION_NAME", "BNF_CHEMICAL_SUBSTANCE"])
+    workers = "one vectorized pass" if args.engine == "numpy" else f"{args.jobs} workers"
+    print(f"Fitted {len(per_series)} series in {elapsed:.1f}s with {workers} -> {args.out}")
+    print(per_series["STATUS"].value_counts().to_string())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+"""
+Benchmark harness: times the pipeline stages on synthetic data of growing size.
+
+For each size a synthetic extract (synthetic.py) is generated once under
+--workdir and reused by later runs. The stages timed are the ones every
+report run goes through:
+
+  load_csv        parse the CSV (loader.read_drug_summary_csv)
+  cache_build     first load_drug_summary(): parse + write the Parquet cache
+  load_cached     later load_drug_summary(): read the Parquet cache
+  aggregate       build the month x region x drug cube
+  monthly_pandas  the original df.groupby("YEAR_MONTH").sum() (baseline)
+  pivot           annual ITEMS per region from the cube (part_one_table.py)
+  pivot_pandas    the same pivot with groupby + pivot (baseline)
+  fit_numpy       ARIMA(1,1,0)+drift for every series (arima110.py)
+  fit_statsmodels ARIMA(1,1,0)+drift on the national series
+  diagnostics     ΔY + ACF/PACF/Ljung-Box/normality for every series
+  render          the national monthly ITEMS figure (part_two_a.py), Agg
+
+From --stream-from rows (default 1e7) the extract no longer fits in memory
+as a DataFrame, so loading and aggregation are timed together as
+
+  stream_aggregate  streaming.stream_cube() over the CSV in 1e6-row chunks
+
+and the stages that need every row in memory (load_csv, cache_build,
+load_cached, aggregate, monthly_pandas, pivot_pandas) are recorded as
+skipped with the reason; the cube-based stages still run. Those grow with
+the number of region x drug series rather than rows (at 1e7 rows the cube
+is 46 x 7077 x 32 and diagnostics dominate the ~2.5 GB peak), so at 1e8
+leave fit_numpy and diagnostics out with --stages. Each size runs in its
+own subprocess, so peak_rss_mb is that size's own peak.
+
+Results are written as JSON (environment, then one record per size and
+stage with every repeat's seconds) so runs can be compared with --compare.
+
+    python bench.py [--sizes 1e4,1e5,1e6] [--repeat 3] [--out bench.json] [--compare OLD.json]
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from loader import CACHE_DIR
+
+BENCH_DIR = os.path.join(CACHE_DIR, "bench")
+DEFAULT_SIZES = [1e4, 1e5, 1e6]
+STREAM_FROM = 1e7
+IN_MEMORY_STAGES = ("load_csv", "cache_build", "load_cached", "aggregate", "monthly_pandas", "pivot_pandas")
+
+
+def environment():
+    """
+    Versions and machine details recorded with every result file.
+    """
+    import matplotlib
+    import scipy
+    import statsmodels
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "git_commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "scipy": scipy.__version__,
+        "statsmodels": statsmodels.__version__,
+        "matplotlib": matplotlib.__version__,
+    }
+
+
+def synthetic_file(rows, workdir=BENCH_DIR, seed=0):
+    """
+    Path of the synthetic extract of about `rows` rows, generating it if needed.
+    """
+    from synthetic import GENERATOR_VERSION, shape_for_rows, write_csv
+
+    os.makedirs(workdir, exist_ok=True)
+    months, regions, drugs = shape_for_rows(rows)
+    path = os.path.join(workdir, f"synthetic_{months}x{regions}x{drugs}_s{seed}.g{GENERATOR_VERSION}.csv")
+    if not os.path.exists(path):
+        tmp = f"{path}.tmp{os.getpid()}"
+        write_csv(tmp, months, regions, drugs, seed=seed)
+        os.replace(tmp, path)
+    return path
+
+
+def _timed(fn, repeat):
+    seconds, value = [], None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        value = fn()
+        seconds.append(time.perf_counter() - start)
+    return seconds, value
+
+
+def run_size(rows, repeat=3, workdir=BENCH_DIR, stages=None, stream_from=STREAM_FROM):
+    """
+    Times every stage on the synthetic extract of about `rows` rows.
+
+    Returns a list of {"rows", "stage", "seconds", ...} records; stages
+    skipped at this size have a "skipped" reason instead of timings.
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    from statsmodels.tsa.arima.model import ARIMA
+
+    from arima110 import fit_arima110
+    from batch_forecast import build_series
+    from cube import build_cube
+    from diagnostics import summarise
+    from loader import load_drug_summary, read_drug_summary_csv
+    from part_two_a import monthly_national_totals, plot_monthly_items
+    from streaming import stream_cube
+    from transforms import cube_matrix, log_diff
+
+    path = synthetic_file(rows, workdir)
+    records = []
+
+    def record(stage, fn, n=repeat):
+        if stages and stage not in stages:
+            return None
+        seconds, value = _timed(fn, n)
+        records.append({"rows": int(rows), "stage": stage, "seconds": seconds,
+                        "median": float(np.median(seconds)), "min": min(seconds)})
+        return value
+
+    with tempfile.TemporaryDirectory(dir=workdir) as cache_dir, warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        if rows >= stream_from:
+            reason = f"needs the full DataFrame in memory; >= {stream_from:.0e} rows are streamed"
+            records.extend({"rows": int(rows), "stage": s, "skipped": reason}
+                           for s in IN_MEMORY_STAGES if not stages or s in stages)
+            stats = {}
+            cube = stream_cube(path, cache_dir=cache_dir, stats=stats)
+            records.append({"rows": int(rows), "stage": "stream_aggregate", "seconds": [stats["seconds"]],
+                            "median": stats["seconds"], "min": stats["seconds"]})
+            actual_rows = stats["rows"]
+        else:
+            record("load_csv", lambda: read_drug_summary_csv(path, cache_dir))
+            record("cache_build", lambda: load_drug_summary(path, cache_dir), n=1)
+            df = load_drug_summary(path, cache_dir)
+            record("load_cached", lambda: load_drug_summary(path, cache_dir))
+            actual_rows = len(df)
+
+            cube = record("aggregate", lambda: build_cube(df)) or build_cube(df)
+            record("monthly_pandas", lambda: df.groupby("YEAR_MONTH")[["ITEMS", "COST_PENCE"]].sum())
+            record("pivot_pandas", lambda: df.groupby(["YEAR", "REGION_NAME"], observed=True)["ITEMS"]
+                   .sum().reset_index().pivot(index="REGION_NAME", columns="YEAR", values="ITEMS"))
+            del df
+        record("pivot", lambda: cube.annual_by_region("ITEMS"))
+
+        values, _ = build_series(cube)
+        national = cube.monthly_totals(["ITEMS"])["ITEMS"].to_numpy(dtype=np.float64)
+        record("fit_numpy", lambda: fit_arima110(values))
+
+        fit_statsmodels = lambda: ARIMA(national, order=(1,1,0), trend="t").fit()
+        fit_statsmodels()  # warm-up: first-call overhead is not part of the stage
+        record("fit_statsmodels", fit_statsmodels)
+
+        record("diagnostics", lambda: summarise(log_diff(cube_matrix(cube)[0])[:, 1:]))
+
+        monthly = monthly_national_totals(cube)
+        render_path = os.path.join(cache_dir, "monthly_items.png")
+        render = lambda: plt.close(plot_monthly_items(monthly, path=render_path))
+        render()  # warm-up: font cache and backend setup
+        record("render", render)
+
+    # Peak resident memory of this process, which runs only this size (see main()).
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    for rec in records:
+        rec["actual_rows"] = actual_rows
+        rec["cube_shape"] = list(cube.shape)
+        rec["peak_rss_mb"] = round(peak_rss_mb, 1)
+    return records
+
+
+def compare(new, old):
+    """
+    Median seconds of two result files side by side, with new/old ratios.
+    """
+    frame = lambda res: pd.DataFrame(res["results"]).set_index(["rows", "stage"])["median"]
+    table = pd.concat({"old": frame(old), "new": frame(new)}, axis=1, join="inner")
+    table["ratio"] = table["new"] / table["old"]
+    return table
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default=",".join(f"{s:.0e}" for s in DEFAULT_SIZES),
+                        help="comma-separated approximate row counts, e.g. 1e4,1e5,1e6,1e7,1e8")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--stages", default=None, help="comma-separated subset of stages")
+    parser.add_argument("--workdir", default=BENCH_DIR)
+    parser.add_argument("--out", default="bench.json")
+    parser.add_argument("--compare", default=None, metavar="OLD_JSON")
+    parser.add_argument("--stream-from", type=float, default=STREAM_FROM,
+                        help="sizes from this many rows are loaded with streaming.stream_cube")
+    parser.add_argument("--one-size", type=float, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    stages = set(args.stages.split(",")) if args.stages else None
+    if args.one_size is not None:
+        # Child process of the loop below: one size, records as JSON on stdout.
+        json.dump(run_size(args.one_size, args.repeat, args.workdir, stages, args.stream_from), sys.stdout)
+        return
+
+    sizes = [float(s) for s in args.sizes.split(",")]
+    result = {"environment": environment(), "repeat": args.repeat, "results": []}
+    for rows in sizes:
+        start = time.perf_counter()
+        cmd = [sys.executable, os.path.abspath(__file__), "--one-size", repr(rows),
+               "--repeat", str(args.repeat), "--workdir", args.workdir,
+               "--stream-from", repr(args.stream_from)]
+        if args.stages:
+            cmd += ["--stages", args.stages]
+        child = subprocess.run(cmd, stdout=subprocess.PIPE, text=True, check=True)
+        result["results"].extend(json.loads(child.stdout))
+        print(f"{int(rows):>12,} rows: {time.perf_counter() - start:6.1f}s", file=sys.stderr)
+
+    with open(args.out, "w") as fh:
+        json.dump(result, fh, indent=2)
+
+    table = pd.DataFrame(result["results"]).pivot(index="stage", columns="rows", values="median")
+    table = table.reindex(pd.unique(pd.Series([r["stage"] for r in result["results"]])))
+    with pd.option_context("display.float_format", "{:,.4f}".format, "display.width", 200):
+        print("Median seconds by stage and size:")
+        print(table.to_string())
+        if args.compare:
+            with open(args.compare) as fh:
+                print("\nAgainst", args.compare)
+                print(compare(result, json.load(fh)).to_string())
+    print(f"Results -> {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,36 +1,23 @@
 #!/usr/bin/env python3
-import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 import statsmodels.api as sm
 from statsmodels.stats.diagnostic import acorr_ljungbox
 from scipy import stats
 
-def main():
-    # 1) Read the CSV data
-    df = pd.read_csv("BSA_ODP_PCA_REGIONAL_DRUG_SUMMARY.csv")
+from instrument import span, traced
+from pipeline import Pipeline
 
-    # 2) Group by YEAR_MONTH to get monthly total ITEMS (if not already aggregated)
-    monthly_totals = (
-        df.groupby("YEAR_MONTH", as_index=False)["ITEMS"]
-          .sum()
-          .sort_values("YEAR_MONTH")
-    )
-    
-    # Create a string for plotting on the x-axis
-    monthly_totals["YEAR_MONTH_STR"] = monthly_totals["YEAR_MONTH"].astype(str)
-    
-    # 3) Log-transform the ITEMS: Y_t = ln(ITEMS)
-    monthly_totals["Y"] = np.log(monthly_totals["ITEMS"])
-    
-    # 4) Compute first difference: ΔY_t = Y_{t+1} - Y_t
-    monthly_totals["dY"] = monthly_totals["Y"].diff()
-    
+def load_dY(pipe):
+    # Monthly ΔY_t = ln(ITEMS_{t+1}) - ln(ITEMS_t) from the cached pipeline stages.
     # Slice off the first NaN row (diff can't compute at t=0)
-    dY = monthly_totals["dY"].iloc[1:].dropna()
-    
+    return pipe.get("dY").iloc[1:].dropna()
+
+
+@traced("render")
+def plot_dY_histogram(dY, path="dY_histogram.png"):
     # A) HISTOGRAM & KERNEL DENSITY
-    plt.figure(figsize=(7,4))
+    fig = plt.figure(figsize=(7,4))
     plt.hist(dY, bins=15, density=True, color="skyblue", edgecolor="black", alpha=0.7)
     
     # mean & std of dY
@@ -44,18 +31,46 @@ def main():
     plt.ylabel("Density")
     plt.legend()
     plt.tight_layout()
-    plt.savefig("dY_histogram.png")
-    plt.show()
-    
+    fig.savefig(path)
+    return fig
+
+
+@traced("render")
+def plot_dY_qqplot(dY, path="dY_qqplot.png"):
     # B) QQ Plot
-    sm.qqplot(dY, line='45', fit=True)
+    fig = sm.qqplot(dY, line='45', fit=True)
     plt.title("QQ Plot of ΔY")
     plt.tight_layout()
-    plt.savefig("dY_qqplot.png")
+    fig.savefig(path)
+    return fig
+
+
+@traced("render")
+def plot_dY_acf_pacf(dY, path="dY_acf_pacf.png"):
+    # D) ACF/PACF for checking independence
+    fig, axes = plt.subplots(1, 2, figsize=(12,4))
+    sm.graphics.tsa.plot_acf(dY, lags=12, ax=axes[0], title="ACF of ΔY")
+    sm.graphics.tsa.plot_pacf(dY, lags=12, ax=axes[1], title="PACF of ΔY")
+    plt.tight_layout()
+    fig.savefig(path)
+    return fig
+
+
+def main():
+    # 1-4) Monthly ITEMS -> Y = ln(ITEMS) -> ΔY, via the cached pipeline stages
+    dY = load_dY(Pipeline())
+    
+    # A) HISTOGRAM & KERNEL DENSITY
+    plot_dY_histogram(dY)
+    plt.show()
+    
+    # B) QQ Plot
+    plot_dY_qqplot(dY)
     plt.show()
     
     # C) Normality Test (Shapiro–Wilk)
-    w_stat, p_val = stats.shapiro(dY)
+    with span("shapiro", "diagnose"):
+        w_stat, p_val = stats.shapiro(dY)
     print(f"Shapiro–Wilk Test for dY: W={w_stat:.4f}, p-value={p_val:.4f}")
     if p_val < 0.05:
         print("=> We reject the null hypothesis of normality at 5% level.")
@@ -63,15 +78,12 @@ def main():
         print("=> We cannot reject normality at 5% level.")
     
     # D) ACF/PACF for checking independence
-    fig, axes = plt.subplots(1, 2, figsize=(12,4))
-    sm.graphics.tsa.plot_acf(dY, lags=12, ax=axes[0], title="ACF of ΔY")
-    sm.graphics.tsa.plot_pacf(dY, lags=12, ax=axes[1], title="PACF of ΔY")
-    plt.tight_layout()
-    plt.savefig("dY_acf_pacf.png")
+    plot_dY_acf_pacf(dY)
     plt.show()
     
     # E) Ljung–Box test (portmanteau test) for autocorrelation at lag=20
-    lb_results = acorr_ljungbox(dY, lags=[20], return_df=True)
+    with span("ljung_box", "diagnose"):
+        lb_results = acorr_ljungbox(dY, lags=[20], return_df=True)
     print("\nLjung–Box Test (lag=20):")
     print(lb_results)
     # If p-value is high, no significant autocorrelation => good for i.i.d. assumption
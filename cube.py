@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+"""
+Dense YEAR_MONTH x REGION_NAME x BNF_CHEMICAL_SUBSTANCE cube of ITEMS and COST.
+
+Every aggregation the scripts need (monthly national totals, annual totals
+per region, totals per drug, monthly series per drug) is a sum over one or
+more axes of these arrays, so the raw rows are grouped only once. The cube
+is saved as an .npz file in the loader's cache directory, keyed by the
+dataset version, and rebuilt only when the source CSV changes.
+
+ITEMS and COST are both held as int64 (COST in pence), so the sums are
+exact and the same whichever order cells are added in; totals are turned
+into pounds only in the tables the aggregations return.
+"""
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+from instrument import traced
+from loader import CACHE_DIR, DRUG_SUMMARY_CSV, dataset_version, load_drug_summary, to_pence, to_pounds
+
+MEASURES = ("ITEMS", "COST")
+# Bump when the saved array layout changes so old cube files are not reused.
+CUBE_FORMAT = 2
+
+
+def to_units(measure, totals):
+    """
+    Exact integer totals of `measure` in reporting units (COST in pounds).
+    """
+    return to_pounds(totals) if measure == "COST" else totals
+
+
+class Cube:
+    """
+    ITEMS and COST indexed by integer (month, region, drug) codes.
+
+    `months`, `regions` and `drugs` are the label lookup tables for the
+    three axes; `observed` marks the cells that had at least one source row,
+    so pivots can show gaps the same way a pandas groupby would. `items`
+    and `cost` (pence) are int64 arrays.
+    """
+
+    def __init__(self, months, regions, drugs, items, cost, observed, version=None):
+        self.months = np.asarray(months, dtype=np.int64)
+        self.regions = np.asarray(regions, dtype=object)
+        self.drugs = np.asarray(drugs, dtype=object)
+        self.items = items
+        self.cost = cost
+        self.observed = observed
+        self.version = version
+
+    @property
+    def shape(self):
+        return self.items.shape
+
+    @property
+    def years(self):
+        return np.unique(self.months // 100)
+
+    def values(self, measure):
+        """
+        The stored int64 array of `measure` (COST in pence); pass sums of
+        it through to_units() for reporting.
+        """
+        if measure == "ITEMS":
+            return self.items
+        if measure == "COST":
+            return self.cost
+        raise KeyError(f"Unknown measure {measure!r}; expected one of {MEASURES}")
+
+    def region_code(self, region):
+        return _lookup(self.regions, region, "REGION_NAME")
+
+    def drug_code(self, drug):
+        return _lookup(self.drugs, drug, "BNF_CHEMICAL_SUBSTANCE")
+
+    # ---- aggregations ---------------------------------------------------
+
+    def year_sums(self, arr):
+        # Months are sorted, so each year is a contiguous run along axis 0.
+        year_of_month = self.months // 100
+        starts = np.flatnonzero(np.r_[True, year_of_month[1:] != year_of_month[:-1]])
+        return np.add.reduceat(arr, starts, axis=0)
+
+    def monthly_totals(self, measures=MEASURES):
+        """
+        National totals per YEAR_MONTH, sorted chronologically.
+        """
+        out = pd.DataFrame({"YEAR_MONTH": self.months})
+        for m in measures:
+            out[m] = to_units(m, self.values(m).sum(axis=(1, 2)))
+        return out
+
+    def annual_totals(self, measures=MEASURES):
+        """
+        National totals per YEAR.
+        """
+        out = pd.DataFrame({"YEAR": self.years})
+        for m in measures:
+            out[m] = to_units(m, self.year_sums(self.values(m).sum(axis=(1, 2))))
+        return out
+
+    def annual_by_region(self, measure):
+        """
+        YEAR x REGION_NAME pivot of `measure`, as built in part_one_table.py.
+        """
+        data = to_units(measure, self.year_sums(self.values(measure).sum(axis=2)))
+        seen = self.year_sums(self.observed.any(axis=2).astype(np.int64)) > 0
+        data = np.where(seen, data, np.nan)
+        return pd.DataFrame(
+            data,
+            index=pd.Index(self.years, name="YEAR"),
+            columns=pd.Index(self.regions, name="REGION_NAME"),
+        )
+
+    def by_drug(self, measure):
+        """
+        All-years total of `measure` per BNF_CHEMICAL_SUBSTANCE.
+        """
+        return pd.Series(
+            to_units(measure, self.values(measure).sum(axis=(0, 1))),
+            index=pd.Index(self.drugs, name="BNF_CHEMICAL_SUBSTANCE"),
+            name=measure,
+        )
+
+    def top_drugs(self, measure, n):
+        """
+        Names of the `n` drugs with the largest all-years total of `measure`.
+        """
+        return self.by_drug(measure).sort_values(ascending=False).head(n).index.tolist()
+
+    def drug_monthly(self, measure, drugs):
+        """
+        Long table of monthly national `measure` for the given drugs.
+
+        Months in which a drug has no source rows are left out, matching a
+        groupby over the raw data.
+        """
+        codes = [self.drug_code(d) for d in drugs]
+        sums = to_units(measure, self.values(measure).sum(axis=1)[:, codes])
+        seen = self.observed.any(axis=1)[:, codes]
+        frames = []
+        for j, drug in enumerate(drugs):
+            mask = seen[:, j]
+            frames.append(pd.DataFrame({
+                "YEAR_MONTH": self.months[mask],
+                "BNF_CHEMICAL_SUBSTANCE": drug,
+                measure: sums[mask, j],
+            }))
+        return pd.concat(frames, ignore_index=True).sort_values("YEAR_MONTH", kind="stable")
+
+    # ---- persistence ----------------------------------------------------
+
+    def save(self, path):
+        tmp = f"{path}.tmp{os.getpid()}.npz"
+        np.savez(
+            tmp,
+            months=self.months,
+            regions=self.regions.astype(str),
+            drugs=self.drugs.astype(str),
+            items=self.items,
+            cost=self.cost,
+            observed=self.observed,
+            version=np.array(self.version or ""),
+        )
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as z:
+            cost = z["cost"]
+            if cost.dtype.kind == "f":
+                cost = to_pence(cost)  # saved before COST was held in pence
+            return cls(
+                months=z["months"],
+                regions=z["regions"].astype(object),
+                drugs=z["drugs"].astype(object),
+                items=z["items"],
+                cost=cost,
+                observed=z["observed"],
+                version=str(z["version"]) or None,
+            )
+
+
+def _lookup(labels, label, axis_name):
+    hits = np.flatnonzero(labels == label)
+    if len(hits) == 0:
+        raise KeyError(f"{label!r} is not a known {axis_name}")
+    return int(hits[0])
+
+
+def _factorize_labels(col):
+    """
+    Dense codes for a label column, reusing the loader's dictionary codes.
+
+    Categorical columns keep the dictionary order (so axis positions are
+    stable across dataset versions); unused categories are dropped.
+    """
+    if not isinstance(col.dtype, pd.CategoricalDtype):
+        return pd.factorize(col, sort=True)
+    codes = col.cat.codes.to_numpy()
+    present = np.unique(codes)
+    remap = np.full(len(col.cat.categories), -1, dtype=np.int64)
+    remap[present] = np.arange(len(present))
+    return remap[codes], np.asarray(col.cat.categories[present], dtype=object)
+
+
+@traced("aggregate")
+def build_cube(df, version=None):
+    """
+    Builds a Cube from drug-level rows in a single scatter-add pass.
+    """
+    month_codes, months = pd.factorize(df["YEAR_MONTH"], sort=True)
+    region_codes, regions = _factorize_labels(df["REGION_NAME"])
+    drug_codes, drugs = _factorize_labels(df["BNF_CHEMICAL_SUBSTANCE"])
+    shape = (len(months), len(regions), len(drugs))
+    flat = np.ravel_multi_index((month_codes, region_codes, drug_codes), shape)
+    size = int(np.prod(shape))
+
+    # bincount adds in float64, which is exact for integer sums below 2**53
+    # (about 90 trillion pounds of pence per cell), so rint recovers them.
+    items = np.bincount(flat, weights=df["ITEMS"].to_numpy(), minlength=size)
+    cost = np.bincount(flat, weights=df["COST_PENCE"].to_numpy(), minlength=size)
+    observed = np.bincount(flat, minlength=size) > 0
+
+    return Cube(
+        months=np.asarray(months),
+        regions=np.asarray(regions, dtype=object),
+        drugs=np.asarray(drugs, dtype=object),
+        items=np.rint(items).astype(np.int64).reshape(shape),
+        cost=np.rint(cost).astype(np.int64).reshape(shape),
+        observed=observed.reshape(shape),
+        version=version,
+    )
+
+
+def cube_path(path=DRUG_SUMMARY_CSV, cache_dir=CACHE_DIR, version=None):
+    stem = os.path.splitext(os.path.basename(path))[0]
+    version = version or dataset_version(path, cache_dir)
+    return os.path.join(cache_dir, f"{stem}.{version[:16]}.v{CUBE_FORMAT}.cube.npz")
+
+
+@traced("aggregate")
+def load_cube(path=DRUG_SUMMARY_CSV, cache_dir=CACHE_DIR, chunksize=None):
+    """
+    Returns the cube for the current version of `path`, building it if needed.
+
+    With `chunksize` (or the NHS_STREAM_CHUNKSIZE environment variable) the
+    cube is built by streaming.stream_cube() instead of loading every row.
+    """
+    version = dataset_version(path, cache_dir)
+    target = cube_path(path, cache_dir, version)
+    if os.path.exists(target):
+        return Cube.load(target)
+
+    chunksize = chunksize or int(os.environ.get("NHS_STREAM_CHUNKSIZE", 0))
+    if chunksize:
+        from streaming import stream_cube
+        cube = stream_cube(path, chunksize=chunksize, cache_dir=cache_dir, version=version)
+    else:
+        cube = build_cube(load_drug_summary(path, cache_dir), version=version)
+    cube.save(target)
+    return cube
+
+
+def main():
+    path = sys.argv[1] if len(sys.argv) > 1 else DRUG_SUMMARY_CSV
+    cube = load_cube(path)
+    m, r, d = cube.shape
+    print(f"Cube {cube.version[:16]}: {m} months x {r} regions x {d} drugs "
+          f"({cube.observed.sum():,} observed cells)")
+    print(cube.monthly_totals().tail())
+
+
+if __name__ == "__main__":
+    main()
@@ -1,30 +1,28 @@
 #!/usr/bin/env python3
-import pandas as pd
-import numpy as np
 import matplotlib.pyplot as plt
 
-def main():
-    # 1) Read the CSV data
-    df = pd.read_csv("BSA_ODP_PCA_REGIONAL_DRUG_SUMMARY.csv")
-    
-    # 2) Aggregate by YEAR_MONTH to get monthly totals of ITEMS (if not already done)
-    monthly_totals = (
-        df.groupby("YEAR_MONTH", as_index=False)["ITEMS"]
-          .sum()
-          .sort_values("YEAR_MONTH")
-    )
+from instrument import traced
+from pipeline import Pipeline
+
+def monthly_log_diff(pipe):
+    # Monthly totals of ITEMS per YEAR_MONTH
+    monthly_totals = pipe.get("monthly_totals")[["YEAR_MONTH", "ITEMS"]].copy()
     
-    # 3) Create a string column for plotting on the x-axis
+    # Create a string column for plotting on the x-axis
     monthly_totals["YEAR_MONTH_STR"] = monthly_totals["YEAR_MONTH"].astype(str)
     
-    # 4) Log-transform the ITEMS: Y_t = ln(ITEMS_t)
-    monthly_totals["Y"] = np.log(monthly_totals["ITEMS"])
-    
-    # 5) Compute the first difference: ΔY_t = Y_{t+1} - Y_t
-    monthly_totals["dY"] = monthly_totals["Y"].diff()
+    # Log-transform the ITEMS: Y_t = ln(ITEMS_t)
+    monthly_totals["Y"] = pipe.get("Y")
     
-    # 6) Plot ΔY_t over time - note the first entry is NaN, so we slice [1:]
-    plt.figure(figsize=(8,5))
+    # Compute the first difference: ΔY_t = Y_{t+1} - Y_t
+    monthly_totals["dY"] = pipe.get("dY")
+    return monthly_totals
+
+
+@traced("render")
+def plot_dY_over_time(monthly_totals, path="plot_dY_over_time.png"):
+    # Plot ΔY_t over time - note the first entry is NaN, so we slice [1:]
+    fig = plt.figure(figsize=(8,5))
     plt.plot(
         monthly_totals["YEAR_MONTH_STR"].iloc[1:],
         monthly_totals["dY"].iloc[1:],
@@ -37,9 +35,19 @@ def main():
     plt.xticks(rotation=70)
     plt.grid(True, linestyle='--', alpha=0.7)
     plt.tight_layout()
+    fig.savefig(path)
+    return fig
+
+
+def main():
+    # 1) Resolve the cached pipeline stages (only stale ones are recomputed)
+    pipe = Pipeline()
+    
+    # 2-5) Monthly ITEMS, Y = ln(ITEMS) and ΔY
+    monthly_totals = monthly_log_diff(pipe)
     
-    # 7) Save the plot to a file and display
-    plt.savefig("plot_dY_over_time.png")
+    # 6-7) Plot ΔY_t over time, save the plot to a file and display
+    plot_dY_over_time(monthly_totals)
     plt.show()
 
 if __name__ == "__main__":
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+"""
+Batched residual and normality diagnostics for many series at once.
+
+check_normal.py and residual_diagnostics.py run acf/pacf, acorr_ljungbox and
+Shapiro-Wilk on one series per statsmodels/scipy call. Here every row of a
+(series x time) matrix of ΔY or residuals is screened in a few array passes:
+
+  ACF           via FFT of the zero-padded, demeaned rows (statsmodels acf)
+  PACF          batched Durbin-Levinson recursion on the autocovariances
+                (statsmodels pacf, default "ywadjusted", or "ywm")
+  Ljung-Box     Q statistics and chi-square p-values (acorr_ljungbox)
+  normality     skewness, excess kurtosis, Jarque-Bera, and Shapiro-Wilk W
+                with Royston's approximation (scipy.stats.shapiro)
+
+summarise() returns one row per series, so thousands of fitted models can be
+screened and only the flagged ones plotted.
+
+    python diagnostics.py [--input dY|resid] [--plot-worst N] [--out FILE]
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from instrument import traced
+
+LB_LAGS = [12, 20]  # as in residual_diagnostics.py
+ALPHA = 0.05
+
+
+def _rows(x):
+    x = np.atleast_2d(np.asarray(x, dtype=np.float64))
+    return x, x.shape[1]
+
+
+def acovf(x, nlags):
+    """
+    Biased autocovariances (denominator n) of each row up to `nlags`, via FFT.
+    """
+    x, n = _rows(x)
+    xc = x - x.mean(axis=1, keepdims=True)
+    size = 1 << int(np.ceil(np.log2(2 * n - 1)))
+    f = np.fft.rfft(xc, n=size, axis=1)
+    return np.fft.irfft(f * np.conj(f), n=size, axis=1)[:, :nlags + 1] / n
+
+
+def acf(x, nlags=12):
+    """
+    Autocorrelations of each row, lags 0..nlags.
+    """
+    g = acovf(x, nlags)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return g / g[:, :1]
+
+
+def pacf(x, nlags=12, method="ywadjusted"):
+    """
+    Partial autocorrelations of each row, lags 0..nlags, by a Durbin-Levinson
+    recursion run on all rows at once.
+
+    "ywadjusted" uses autocovariances with denominator n - k (statsmodels'
+    pacf default); "ywm" uses the biased ones (plot_pacf's default).
+    """
+    x, n = _rows(x)
+    g = acovf(x, nlags)
+    if method == "ywadjusted":
+        g = g * n / (n - np.arange(nlags + 1))
+    elif method != "ywm":
+        raise ValueError(f"unknown method {method!r}")
+
+    out = np.ones((len(x), nlags + 1))
+    phi = np.zeros((len(x), nlags + 1))
+    v = g[:, 0].copy()
+    with np.errstate(invalid="ignore", divide="ignore"):
+        for k in range(1, nlags + 1):
+            # phi_kk = (g_k - sum_j phi_{k-1,j} g_{k-j}) / v_{k-1}
+            num = g[:, k] - np.einsum("ij,ij->i", phi[:, 1:k], g[:, k - 1:0:-1])
+            kk = num / v
+            phi[:, 1:k] = phi[:, 1:k] - kk[:, None] * phi[:, k - 1:0:-1]
+            phi[:, k] = kk
+            v = v * (1 - kk ** 2)
+            out[:, k] = kk
+    return out
+
+
+def ljung_box(x, lags=LB_LAGS, model_df=0):
+    """
+    Ljung-Box Q and p-values of each row at each lag in `lags`.
+
+    Returns (Q, p), both (n_series, len(lags)).
+    """
+    x, n = _rows(x)
+    r = acf(x, max(lags))[:, 1:]
+    terms = np.cumsum(r ** 2 / (n - np.arange(1, max(lags) + 1)), axis=1)
+    q = n * (n + 2) * terms[:, np.asarray(lags) - 1]
+    df = np.maximum(np.asarray(lags) - model_df, 1)
+    return q, stats.chi2.sf(q, df)
+
+
+def moments(x):
+    """
+    Mean, standard deviation (ddof=1), skewness and excess kurtosis per row.
+    """
+    x, n = _rows(x)
+    mean = x.mean(axis=1)
+    xc = x - mean[:, None]
+    m2 = (xc ** 2).mean(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        skew = (xc ** 3).mean(axis=1) / m2 ** 1.5
+        kurt = (xc ** 4).mean(axis=1) / m2 ** 2 - 3
+    return mean, np.sqrt(m2 * n / (n - 1)), skew, kurt
+
+
+def jarque_bera(x):
+    """
+    Jarque-Bera statistic and p-value per row.
+    """
+    x, n = _rows(x)
+    _, _, skew, kurt = moments(x)
+    jb = n / 6 * (skew ** 2 + kurt ** 2 / 4)
+    return jb, stats.chi2.sf(jb, 2)
+
+
+def _shapiro_coefficients(n):
+    # Royston (1992/1995) approximation of the Shapiro-Wilk weights.
+    m = stats.norm.ppf((np.arange(1, n + 1) - 0.375) / (n + 0.25))
+    mm = m @ m
+    u = 1 / np.sqrt(n)
+    a = m / np.sqrt(mm)
+    an = a[-1] + np.polyval([-2.706056, 4.434685, -2.071190, -0.147981, 0.221157, 0], u)
+    if n > 5:
+        an1 = a[-2] + np.polyval([-3.582633, 5.682633, -1.752461, -0.293762, 0.042981, 0], u)
+        phi = (mm - 2 * m[-1] ** 2 - 2 * m[-2] ** 2) / (1 - 2 * an ** 2 - 2 * an1 ** 2)
+        a = m / np.sqrt(phi)
+        a[-1], a[-2], a[0], a[1] = an, an1, -an, -an1
+    else:
+        phi = (mm - 2 * m[-1] ** 2) / (1 - 2 * an ** 2)
+        a = m / np.sqrt(phi)
+        a[-1], a[0] = an, -an
+    return a
+
+
+def shapiro_wilk(x):
+    """
+    Shapiro-Wilk W and p-value per row (Royston's approximation, n >= 4).
+    """
+    x, n = _rows(x)
+    if n < 4:
+        raise ValueError("Shapiro-Wilk needs at least 4 observations per series")
+    a = _shapiro_coefficients(n)
+    xs = np.sort(x, axis=1)
+    ss = ((x - x.mean(axis=1, keepdims=True)) ** 2).sum(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        w = np.minimum((xs @ a) ** 2 / ss, 1.0)
+        w1 = np.log1p(-w)
+        if n <= 11:
+            gamma = 0.459 * n - 2.273
+            mu = np.polyval([-0.0006714, 0.025054, -0.39978, 0.5440], n)
+            sigma = np.exp(np.polyval([-0.0020322, 0.062767, -0.77857, 1.3822], n))
+            z = (-np.log(gamma - w1) - mu) / sigma
+        else:
+            ln = np.log(n)
+            mu = np.polyval([0.0038915, -0.083751, -0.31082, -1.5861], ln)
+            sigma = np.exp(np.polyval([0.0030302, -0.082676, -0.4803], ln))
+            z = (w1 - mu) / sigma
+    return w, stats.norm.sf(z)
+
+
+@traced("diagnose")
+def summarise(x, index=None, nlags=12, lb_lags=LB_LAGS, model_df=0, alpha=ALPHA):
+    """
+    One row of diagnostics per series of `x` (n_series x n_time).
+
+    Rows with missing or infinite values are reported with NaN statistics.
+    `flagged` is True when any Ljung-Box or normality p-value is below
+    `alpha`; `worst_p` is the smallest of those p-values.
+    """
+    x, n = _rows(x)
+    valid = np.isfinite(x).all(axis=1)
+    x = np.where(valid[:, None], x, 0.0)
+
+    mean, sd, skew, kurt = moments(x)
+    r = acf(x, nlags)
+    pr = pacf(x, nlags)
+    q, q_p = ljung_box(x, lb_lags, model_df)
+    jb, jb_p = jarque_bera(x)
+    w, w_p = shapiro_wilk(x)
+
+    table = pd.DataFrame({
+        "n": n, "mean": mean, "sd": sd, "skew": skew, "kurtosis": kurt,
+        "acf_1": r[:, 1], "pacf_1": pr[:, 1],
+        "max_abs_acf": np.abs(r[:, 1:]).max(axis=1),
+        "acf_outside_band": (np.abs(r[:, 1:]) > stats.norm.ppf(1 - alpha / 2) / np.sqrt(n)).sum(axis=1),
+    }, index=index)
+    for j, lag in enumerate(lb_lags):
+        table[f"lb_stat_{lag}"] = q[:, j]
+        table[f"lb_pvalue_{lag}"] = q_p[:, j]
+    table["jb_stat"], table["jb_pvalue"] = jb, jb_p
+    table["shapiro_w"], table["shapiro_pvalue"] = w, w_p
+
+    p_cols = [c for c in table.columns if "pvalue" in c]
+    table.loc[~valid, table.columns.drop("n")] = np.nan
+    table["worst_p"] = table[p_cols].min(axis=1)
+    table["flagged"] = table["worst_p"] < alpha
+    return table
+
+
+def arima110_residuals(y):
+    """
+    One-step residuals of the vectorized ARIMA(1,1,0)+drift fit to each row
+    of `y` (levels), conditional on the first difference.
+    """
+    from arima110 import fit_arima110
+
+    y = np.atleast_2d(np.asarray(y, dtype=np.float64))
+    fit = fit_arima110(y)
+    z = np.diff(y, axis=1) - fit.drift[:, None]
+    return z[:, 1:] - fit.ar_L1[:, None] * z[:, :-1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--input", choices=["dY", "resid"], default="dY",
+                        help="log-differences of each series, or its ARIMA(1,1,0) residuals")
+    parser.add_argument("--nlags", type=int, default=12)
+    parser.add_argument("--plot-worst", type=int, default=0, metavar="N",
+                        help="draw histogram/QQ/ACF-PACF plots for the N most significant series")
+    parser.add_argument("--outdir", default="diagnostics")
+    parser.add_argument("--out", default=None, help="write the summary table to this CSV")
+    args = parser.parse_args()
+
+    from batch_forecast import MIN_OBSERVATIONS, build_series
+    from cube import load_cube
+    from pipeline import Pipeline
+
+    values, index = build_series(load_cube())
+    keep = (values > 0).sum(axis=1) >= MIN_OBSERVATIONS
+    index = index[keep].reset_index(drop=True)
+
+    start = time.perf_counter()
+    if args.input == "dY":
+        x = Pipeline().get("dY_matrix")[0][keep, 1:]
+        model_df = 0
+    else:
+        x = arima110_residuals(values[keep])
+        model_df = 1
+    table = index.join(summarise(x, nlags=args.nlags, model_df=model_df))
+    elapsed = time.perf_counter() - start
+
+    screened = table["sd"].notna()
+    print(f"Diagnostics for {len(table)} series x {x.shape[1]} months of {args.input} "
+          f"in {elapsed*1e3:.1f} ms")
+    print(f"  complete series: {int(screened.sum())}, "
+          f"flagged at {ALPHA:.0%}: {int(table['flagged'].sum())}")
+    worst = table[screened].sort_values("worst_p").head(10)
+    with pd.option_context("display.float_format", "{:,.4f}".format, "display.width", 200):
+        print(worst[["MEASURE", "REGION_NAME", "BNF_CHEMICAL_SUBSTANCE", "acf_1",
+                     f"lb_pvalue_{LB_LAGS[0]}", "shapiro_pvalue", "worst_p"]].to_string(index=False))
+    if args.out:
+        table.to_csv(args.out, index=False)
+
+    if args.plot_worst:
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+        from check_normal import plot_dY_acf_pacf, plot_dY_histogram, plot_dY_qqplot
+
+        os.makedirs(args.outdir, exist_ok=True)
+        for i in table[screened].sort_values("worst_p").index[:args.plot_worst]:
+            series = pd.Series(x[i])
+            for draw, kind in [(plot_dY_histogram, "hist"), (plot_dY_qqplot, "qq"),
+                               (plot_dY_acf_pacf, "acf_pacf")]:
+                plt.close(draw(series, path=os.path.join(args.outdir, f"series_{i}_{kind}.png")))
+        print(f"Plots for the {args.plot_worst} most significant series -> {args.outdir}/")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+"""
+Fan-chart forecast intervals from one mean/variance computation.
+
+prediction.py used to call conf_int() once per confidence level and
+get_forecast() twice on overlapping horizons. Here the predictive mean and
+variance are computed once per horizon, and any set of quantiles (e.g. every
+5% for a full fan chart) is returned as one array:
+
+  moments_from_results()  mean and variance from one statsmodels get_forecast
+  quantiles()             Gaussian quantiles for many probabilities at once
+  intervals()             (lower, upper) bands for a list of confidence levels
+
+For intervals that need not be Gaussian, simulate_paths() draws Monte Carlo
+sample paths of ARIMA(1,1,0)+drift for every series and path in one array
+per step, with normal, Student-t or bootstrapped-residual innovations, and
+path_quantiles() reads the fan off the simulated paths.
+
+    python fanchart.py [--step 0.05] [--paths 10000] [--plot FILE]
+"""
+import argparse
+import time
+
+import numpy as np
+from scipy import stats
+
+from instrument import traced
+
+CONF_LEVELS = [0.90, 0.70, 0.50]
+
+
+def fan_probs(step=0.05):
+    """
+    Quantile probabilities step, 2*step, ..., 1 - step.
+    """
+    return np.round(np.arange(step, 1, step), 10)
+
+
+@traced("forecast")
+def moments_from_results(results, steps):
+    """
+    Predictive mean and variance for horizons 1..steps from one get_forecast
+    call on a statsmodels results object.
+    """
+    fc = results.get_forecast(steps=steps)
+    return np.asarray(fc.predicted_mean), np.asarray(fc.var_pred_mean)
+
+
+def quantiles(mean, var, probs):
+    """
+    Gaussian predictive quantiles for every probability in `probs`.
+
+    Returns an array of shape (len(probs),) + mean.shape.
+    """
+    z = stats.norm.ppf(np.asarray(probs, dtype=np.float64))
+    sd = np.sqrt(np.asarray(var, dtype=np.float64))
+    return np.asarray(mean)[None] + z.reshape((-1,) + (1,) * sd.ndim) * sd[None]
+
+
+def intervals(mean, var, levels=CONF_LEVELS):
+    """
+    Central intervals for each confidence level.
+
+    Returns (lower, upper), each of shape (len(levels),) + mean.shape, in
+    the order of `levels`.
+    """
+    levels = np.asarray(levels, dtype=np.float64)
+    q = quantiles(mean, var, np.r_[(1 - levels) / 2, (1 + levels) / 2])
+    return q[:len(levels)], q[len(levels):]
+
+
+def fit_from_results(results):
+    """
+    An arima110.ARIMA110Fit (one series) with the parameters of a statsmodels
+    ARIMA(1,1,0) trend="t" results object, for use with simulate_paths().
+    """
+    from arima110 import ARIMA110Fit
+
+    y = np.asarray(results.model.endog, dtype=np.float64).ravel()
+    params = dict(zip(results.param_names, np.asarray(results.params)))
+    one = lambda v: np.array([v], dtype=np.float64)
+    return ARIMA110Fit(one(params["x1"]), one(params["ar.L1"]), one(params["sigma2"]),
+                       bse={}, loglike=one(results.llf), nobs=one(results.nobs),
+                       last_y=one(y[-1]), last_dy=one(y[-1] - y[-2]))
+
+
+@traced("forecast")
+def simulate_paths(fit, steps, n_paths=10_000, innovations="normal", resid=None, df=5,
+                   seed=None):
+    """
+    Monte Carlo level paths of ARIMA(1,1,0)+drift for every series in `fit`.
+
+    `innovations` is "normal", "t" (Student-t with `df` degrees of freedom,
+    scaled to variance sigma2) or "bootstrap" (resampled from `resid`,
+    shape (n_series, n_resid)). Returns (n_series, n_paths, steps).
+    """
+    rng = np.random.default_rng(seed)
+    n = len(fit.drift)
+    shape = (steps, n, n_paths)  # step-major, so each step is one contiguous block
+    sd = np.sqrt(fit.sigma2)[None, :, None]
+    if innovations == "normal":
+        eps = rng.standard_normal(shape) * sd
+    elif innovations == "t":
+        eps = rng.standard_t(df, shape) * np.sqrt((df - 2) / df) * sd
+    elif innovations == "bootstrap":
+        resid = np.atleast_2d(np.asarray(resid, dtype=np.float64))
+        resid = resid - np.nanmean(resid, axis=1, keepdims=True)
+        pick = rng.integers(0, resid.shape[1], size=shape)
+        eps = resid[np.arange(n)[None, :, None], pick]
+    else:
+        raise ValueError(f"unknown innovations {innovations!r}")
+
+    mu = fit.drift[:, None]
+    phi = fit.ar_L1[:, None]
+    z = np.broadcast_to(fit.last_dy[:, None], (n, n_paths))
+    for h in range(steps):
+        z = eps[h] = mu + phi * (z - mu) + eps[h]
+    levels = fit.last_y[None, :, None] + np.cumsum(eps, axis=0)
+    return np.moveaxis(levels, 0, 2)
+
+
+def path_quantiles(paths, probs):
+    """
+    Empirical quantiles of simulated paths (series, paths, steps).
+
+    The paths are sorted once and every probability is read off by linear
+    interpolation (numpy's default quantile method). Returns
+    (len(probs), n_series, steps).
+    """
+    ordered = np.sort(paths, axis=1)
+    pos = np.asarray(probs, dtype=np.float64) * (paths.shape[1] - 1)
+    lo = np.floor(pos).astype(np.int64)
+    hi = np.minimum(lo + 1, paths.shape[1] - 1)
+    frac = (pos - lo)[:, None, None]
+    below = np.moveaxis(ordered[:, lo], 1, 0)
+    above = np.moveaxis(ordered[:, hi], 1, 0)
+    return below + frac * (above - below)
+
+
+def plot_fan(y, mean, q, probs, path=None, title="ARIMA(1,1,0) Fan Chart"):
+    """
+    History plus a fan of nested quantile bands, darker towards the median.
+    """
+    import matplotlib.pyplot as plt
+
+    fig = plt.figure(figsize=(10,5))
+    hist = np.arange(len(y))
+    future = np.arange(len(y), len(y) + len(mean))
+    plt.plot(hist, y, marker="o", color="black", label="Data")
+    n_bands = len(probs) // 2
+    for i in range(n_bands):
+        lo, hi = q[i], q[len(probs) - 1 - i]
+        plt.fill_between(future, lo, hi, color="green", alpha=0.8 / n_bands,
+                         label=f"{probs[i]:.0%}-{probs[-1 - i]:.0%}" if i == 0 else None)
+    plt.plot(future, mean, color="green", label="Mean forecast")
+    plt.title(title)
+    plt.xlabel("Time Index")
+    plt.ylabel("ITEMS")
+    plt.legend()
+    plt.tight_layout()
+    if path:
+        fig.savefig(path)
+    return fig
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--steps", type=int, default=10)
+    parser.add_argument("--step", type=float, default=0.05, help="quantile spacing of the fan")
+    parser.add_argument("--paths", type=int, default=10_000)
+    parser.add_argument("--plot", default=None, help="save the national fan chart to this file")
+    args = parser.parse_args()
+
+    from arima110 import fit_arima110
+    from batch_forecast import MIN_OBSERVATIONS, build_series
+    from cube import load_cube
+    from pipeline import Pipeline
+
+    probs = fan_probs(args.step)
+    results = Pipeline().get("arima_full")
+    start = time.perf_counter()
+    mean, var = moments_from_results(results, args.steps)
+    q = quantiles(mean, var, probs)
+    analytic = time.perf_counter() - start
+
+    fit = fit_from_results(results)
+    start = time.perf_counter()
+    paths = simulate_paths(fit, args.steps, args.paths, seed=0)
+    mc_q = path_quantiles(paths, probs)[:, 0]
+    mc = time.perf_counter() - start
+    rel = np.abs(mc_q - q).max() / np.sqrt(var).max()
+    print(f"National ITEMS, {len(probs)} quantiles x {args.steps} steps: "
+          f"analytic {analytic*1e3:.1f} ms, Monte Carlo ({args.paths} paths) {mc*1e3:.1f} ms")
+    print(f"  max |MC - analytic| quantile difference: {rel:.3f} predictive sd")
+
+    values, _ = build_series(load_cube())
+    values = values[np.count_nonzero(values, axis=1) >= MIN_OBSERVATIONS]
+    batch = fit_arima110(values)
+    start = time.perf_counter()
+    m, v = batch.forecast_moments(args.steps)
+    quantiles(m, v, probs)
+    analytic = time.perf_counter() - start
+    start = time.perf_counter()
+    path_quantiles(simulate_paths(batch, args.steps, 1000, seed=0), probs)
+    mc = time.perf_counter() - start
+    print(f"All {len(values)} series: analytic fan {analytic*1e3:.1f} ms, "
+          f"Monte Carlo (1000 paths each) {mc*1e3:.0f} ms")
+
+    if args.plot:
+        import matplotlib
+        matplotlib.use("Agg")
+        plot_fan(np.asarray(results.model.endog).ravel(), mean, q, probs, path=args.plot)
+        print(f"Fan chart -> {args.plot}")
+
+
+if __name__ == "__main__":
+    main()
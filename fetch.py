@@ -0,0 +1,451 @@
+#!/usr/bin/env python3
+"""
+Fetches the drug summary from a CKAN datastore API into the loader cache.
+
+The NHSBSA open-data portal serves the extract through CKAN's
+datastore_search (limit/offset paging) and datastore_search_sql endpoints.
+fetch() asks for the record count, then requests the pages concurrently
+under asyncio, at most `parallel` at a time, over a pool of keep-alive
+HTTP connections (one per concurrent request, reused page after page).
+
+Every finished page is saved under .cache/fetch/<resource>/ as a small
+Parquet file, so an interrupted run resumes with only the missing pages.
+Once all pages are present they are streamed, one page at a time and in
+page order, into the CSV the scripts read and, without re-parsing it, into
+the loader's Parquet cache for that CSV's dataset version (one row group
+per page).
+
+`serve` runs a local CKAN stand-in that pages through a CSV (the shipped
+extract by default); `selftest` fetches from one, including an
+interrupted run that is resumed, and checks the result against the file.
+
+    python fetch.py get --base-url URL --resource ID [--out CSV] [--limit 1000] [--parallel 8] [--mode search|sql]
+    python fetch.py serve [--csv CSV] [--port 8765] [--delay 0.05] [--fail-after N]
+    python fetch.py selftest
+"""
+import argparse
+import asyncio
+import http.client
+import http.server
+import json
+import math
+import os
+import queue
+import re
+import shutil
+import tempfile
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from instrument import traced
+from loader import (CACHE_DIR, CATEGORICAL_COLUMNS, DRUG_SUMMARY_CSV, DRUG_SUMMARY_DTYPES,
+                    _atomic_write_text, _cache_path, _prune_stale_caches, dataset_version,
+                    encode_categoricals, load_drug_summary, to_pounds, with_pence)
+
+NHSBSA_API = "https://opendata.nhsbsa.net/api/3/action"
+COLUMNS = list(DRUG_SUMMARY_DTYPES)
+PAGE_LIMIT = 1000
+PARALLEL = 8
+RETRIES = 4
+BACKOFF = 0.25  # seconds, doubled per retry
+
+
+class FetchError(Exception):
+    pass
+
+
+class ConnectionPool:
+    """
+    Keep-alive HTTP(S) connections to one host, shared by worker threads.
+
+    A connection is taken for one request and returned afterwards; one that
+    the server has closed in the meantime is reopened once transparently.
+    """
+
+    def __init__(self, base_url, timeout=60):
+        url = urllib.parse.urlsplit(base_url)
+        self.https = url.scheme == "https"
+        self.host = url.hostname
+        self.port = url.port
+        self.prefix = url.path.rstrip("/")
+        self.timeout = timeout
+        self.idle = queue.LifoQueue()
+        self.opened = 0
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        cls = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+        with self._lock:
+            self.opened += 1
+        return cls(self.host, self.port, timeout=self.timeout)
+
+    @staticmethod
+    def _get(conn, target):
+        conn.request("GET", target, headers={"Accept": "application/json"})
+        resp = conn.getresponse()
+        return resp.status, resp.read()
+
+    def get_json(self, action, params):
+        """
+        GET {base_url}/{action}?{params}; returns the CKAN "result" object.
+        """
+        target = f"{self.prefix}/{action}?{urllib.parse.urlencode(params)}"
+        try:
+            conn = self.idle.get_nowait()
+            reused = True
+        except queue.Empty:
+            conn, reused = self._connect(), False
+        try:
+            try:
+                status, body = self._get(conn, target)
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                if not reused:
+                    raise
+                conn.close()  # the server dropped an idle keep-alive connection
+                conn = self._connect()
+                status, body = self._get(conn, target)
+        except BaseException:
+            conn.close()
+            raise
+        self.idle.put(conn)
+        with self._lock:
+            self.requests += 1
+
+        if status != 200:
+            raise FetchError(f"HTTP {status} for {target}")
+        payload = json.loads(body)
+        if not payload.get("success"):
+            raise FetchError(f"{action} failed: {payload.get('error')}")
+        return payload["result"]
+
+    def close(self):
+        while not self.idle.empty():
+            self.idle.get_nowait().close()
+
+
+def _page_request(mode, resource, limit, offset):
+    if mode == "sql":
+        sql = f'SELECT * FROM "{resource}" ORDER BY "_id" LIMIT {limit} OFFSET {offset}'
+        return "datastore_search_sql", {"sql": sql}
+    # Without an explicit order, offset pages of datastore_search can overlap or skip rows.
+    return "datastore_search", {"resource_id": resource, "limit": limit, "offset": offset,
+                                "sort": "_id"}
+
+
+def record_count(pool, resource, mode="search"):
+    if mode == "sql":
+        result = pool.get_json("datastore_search_sql",
+                               {"sql": f'SELECT COUNT(*) AS n FROM "{resource}"'})
+        return int(result["records"][0]["n"])
+    return int(pool.get_json("datastore_search", {"resource_id": resource, "limit": 0})["total"])
+
+
+def records_frame(records):
+    """
+    A page of CKAN records as typed columns (COST as COST_PENCE).
+    """
+    df = pd.DataFrame.from_records(records, columns=COLUMNS)
+    for col, dtype in DRUG_SUMMARY_DTYPES.items():
+        if dtype == "category":
+            df[col] = df[col].astype(str)
+        else:
+            df[col] = pd.to_numeric(df[col]).astype(dtype)
+    return with_pence(df)
+
+
+def _page_file(workdir, k):
+    return os.path.join(workdir, f"page-{k:06d}.parquet")
+
+
+def _write_page(workdir, k, frame):
+    target = _page_file(workdir, k)
+    tmp = f"{target}.tmp{os.getpid()}.{threading.get_ident()}"
+    frame.to_parquet(tmp, index=False)
+    os.replace(tmp, target)
+
+
+def _start_state(workdir, state):
+    """
+    Reuses `workdir` if it holds pages of the same request, else clears it.
+    """
+    path = os.path.join(workdir, "state.json")
+    try:
+        with open(path) as fh:
+            if json.load(fh) == state:
+                return
+    except (FileNotFoundError, ValueError):
+        pass
+    shutil.rmtree(workdir, ignore_errors=True)
+    os.makedirs(workdir)
+    _atomic_write_text(path, json.dumps(state, indent=2))
+
+
+async def _fetch_pages(pool, todo, workdir, mode, resource, limit, total, parallel, retries):
+    gate = asyncio.Semaphore(parallel)
+
+    async def one(k):
+        async with gate:
+            action, params = _page_request(mode, resource, limit, k * limit)
+            for attempt in range(retries + 1):
+                try:
+                    result = await asyncio.to_thread(pool.get_json, action, params)
+                    break
+                except (OSError, http.client.HTTPException, FetchError):
+                    if attempt == retries:
+                        raise
+                    await asyncio.sleep(BACKOFF * 2 ** attempt)
+            expected = min(limit, total - k * limit)
+            if len(result["records"]) != expected:
+                raise FetchError(f"page {k}: {len(result['records'])} records, expected {expected}")
+            await asyncio.to_thread(_write_page, workdir, k, records_frame(result["records"]))
+
+    # Threads for the blocking HTTP calls: one per concurrent request.
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(parallel))
+    tasks = [asyncio.create_task(one(k)) for k in todo]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+def assemble(workdir, n_pages, out, cache_dir=CACHE_DIR):
+    """
+    Appends the page files in order to `out` (CSV) and to the loader's
+    Parquet cache, one row group per page, holding one page in memory at a
+    time. Returns the number of rows.
+    """
+    pages = [_page_file(workdir, k) for k in range(n_pages)]
+    # Every label is registered first, so all pages are coded against the
+    # final dictionaries and share one Parquet schema.
+    for page in pages:
+        encode_categoricals(pd.read_parquet(page, columns=list(CATEGORICAL_COLUMNS)), cache_dir)
+
+    tmp_csv = f"{out}.tmp{os.getpid()}"
+    tmp_cache = os.path.join(cache_dir, f"fetch.tmp{os.getpid()}.parquet")
+    rows, writer = 0, None
+    try:
+        with open(tmp_csv, "w", newline="") as fh:
+            for k, page in enumerate(pages):
+                df = pd.read_parquet(page)
+                csv = df.drop(columns="COST_PENCE")
+                csv["COST"] = to_pounds(df["COST_PENCE"].to_numpy())
+                csv[COLUMNS].to_csv(fh, index=False, header=k == 0)
+                table = pa.Table.from_pandas(encode_categoricals(df, cache_dir), preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(tmp_cache, table.schema)
+                writer.write_table(table)
+                rows += len(df)
+    finally:
+        if writer is not None:
+            writer.close()
+    os.replace(tmp_csv, out)
+
+    cache_file = _cache_path(out, cache_dir, dataset_version(out, cache_dir))
+    os.replace(tmp_cache, cache_file)
+    _prune_stale_caches(out, cache_dir, keep=cache_file)
+    return rows
+
+
+@traced("load")
+def fetch(base_url=NHSBSA_API, resource=None, out=DRUG_SUMMARY_CSV, limit=PAGE_LIMIT,
+          parallel=PARALLEL, mode="search", retries=RETRIES, cache_dir=CACHE_DIR, stats=None):
+    """
+    Downloads every record of `resource` into `out` and the loader cache,
+    resuming from the pages saved by an earlier, interrupted call.
+
+    Returns the loaded DataFrame. If `stats` is a dict it is filled with
+    total, pages, fetched, resumed, connections, requests and seconds.
+    """
+    resource = resource or os.path.splitext(os.path.basename(out))[0]
+    workdir = os.path.join(cache_dir, "fetch", re.sub(r"[^\w.-]", "_", resource))
+    start = time.perf_counter()
+    pool = ConnectionPool(base_url)
+    try:
+        total = record_count(pool, resource, mode)
+        n_pages = math.ceil(total / limit)
+        _start_state(workdir, {"base_url": base_url, "resource": resource, "mode": mode,
+                               "limit": limit, "total": total})
+        todo = [k for k in range(n_pages) if not os.path.exists(_page_file(workdir, k))]
+        asyncio.run(_fetch_pages(pool, todo, workdir, mode, resource, limit, total,
+                                 parallel, retries))
+    finally:
+        pool.close()
+    assemble(workdir, n_pages, out, cache_dir)
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    if stats is not None:
+        stats.update(total=total, pages=n_pages, fetched=len(todo), resumed=n_pages - len(todo),
+                     connections=pool.opened, requests=pool.requests,
+                     seconds=time.perf_counter() - start)
+    return load_drug_summary(out, cache_dir)
+
+
+# ---- local CKAN stand-in -------------------------------------------------------
+
+class _StandIn(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, records, resource, delay=0.0, fail_after=None):
+        super().__init__(address, _StandInHandler)
+        self.records = records
+        self.resource = resource
+        self.delay = delay
+        self.fail_after = fail_after
+        self.served = 0
+        self.lock = threading.Lock()
+
+
+class _StandInHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        srv = self.server
+        url = urllib.parse.urlsplit(self.path)
+        action = url.path.rstrip("/").rsplit("/", 1)[-1]
+        q = {k: v[-1] for k, v in urllib.parse.parse_qs(url.query).items()}
+        with srv.lock:
+            srv.served += 1
+            failing = srv.fail_after is not None and srv.served > srv.fail_after
+        if failing:
+            return self._send(503, {"success": False, "error": "stand-in: simulated outage"})
+        if srv.delay:
+            time.sleep(srv.delay)
+
+        if action == "datastore_search":
+            if q.get("resource_id") != srv.resource:
+                return self._send(404, {"success": False, "error": "Resource not found"})
+            limit, offset = int(q.get("limit", 100)), int(q.get("offset", 0))
+        elif action == "datastore_search_sql":
+            sql = q.get("sql", "")
+            table = re.search(r'FROM\s+"([^"]+)"', sql, re.I)
+            if not table or table.group(1) != srv.resource:
+                return self._send(404, {"success": False, "error": "Resource not found"})
+            if re.match(r"\s*SELECT\s+COUNT\(\*\)", sql, re.I):
+                return self._send(200, {"success": True,
+                                        "result": {"records": [{"n": len(srv.records)}]}})
+            limit = re.search(r"LIMIT\s+(\d+)", sql, re.I)
+            offset = re.search(r"OFFSET\s+(\d+)", sql, re.I)
+            limit = int(limit.group(1)) if limit else len(srv.records)
+            offset = int(offset.group(1)) if offset else 0
+        else:
+            return self._send(400, {"success": False, "error": f"unknown action {action!r}"})
+
+        result = {"records": srv.records[offset:offset + limit], "total": len(srv.records)}
+        self._send(200, {"success": True, "result": result})
+
+
+def stand_in(csv=DRUG_SUMMARY_CSV, host="127.0.0.1", port=0, resource=None, delay=0.0,
+             fail_after=None):
+    """
+    A CKAN datastore stand-in serving the rows of `csv` (not yet started;
+    call serve_forever()). port=0 picks a free port: see server_address.
+    """
+    df = pd.read_csv(csv)
+    records = df.to_dict("records")
+    for i, rec in enumerate(records, 1):
+        rec["_id"] = i
+    resource = resource or os.path.splitext(os.path.basename(csv))[0]
+    return _StandIn((host, port), records, resource, delay, fail_after)
+
+
+def selftest(csv=DRUG_SUMMARY_CSV, limit=500, parallel=8, delay=0.01):
+    """
+    Fetches `csv` back from a local stand-in, once with an outage part-way
+    through followed by a resumed run, and once in sql mode.
+    """
+    expected = load_drug_summary(csv)
+    with tempfile.TemporaryDirectory() as tmp:
+        srv = stand_in(csv, delay=delay)
+        threading.Thread(target=srv.serve_forever, daemon=True).start()
+        base = f"http://{srv.server_address[0]}:{srv.server_address[1]}/api/3/action"
+        out = os.path.join(tmp, os.path.basename(csv))
+        cache_dir = os.path.join(tmp, "cache")
+        try:
+            n_pages = math.ceil(len(srv.records) / limit)
+            srv.fail_after = 1 + n_pages // 2  # count request plus about half the pages
+            try:
+                fetch(base, srv.resource, out, limit, parallel, retries=0, cache_dir=cache_dir)
+                raise AssertionError("the simulated outage did not interrupt the fetch")
+            except FetchError as exc:
+                print(f"Interrupted as intended: {exc}")
+            srv.fail_after = None
+
+            for mode in ("search", "sql"):
+                stats = {}
+                df = fetch(base, srv.resource, out, limit, parallel, mode=mode,
+                           cache_dir=cache_dir, stats=stats)
+                same = df.astype({c: str for c in ("REGION_NAME", "BNF_CHEMICAL_SUBSTANCE")}).equals(
+                    expected.astype({c: str for c in ("REGION_NAME", "BNF_CHEMICAL_SUBSTANCE")}))
+                print(f"{mode}: {stats['total']:,} rows, {stats['pages']} pages "
+                      f"({stats['resumed']} resumed) over {stats['connections']} connections, "
+                      f"{stats['requests']} requests in {stats['seconds']:.2f}s; "
+                      f"matches the file: {same}")
+                hit = os.path.exists(_cache_path(out, cache_dir, dataset_version(out, cache_dir)))
+                print(f"  loader cache ready for the fetched CSV: {hit}")
+        finally:
+            srv.shutdown()
+            srv.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+    get = sub.add_parser("get", help="fetch a resource into a CSV and the loader cache")
+    get.add_argument("--base-url", default=NHSBSA_API)
+    get.add_argument("--resource", default=None, help="datastore resource id (default: the CSV stem)")
+    get.add_argument("--out", default=DRUG_SUMMARY_CSV)
+    get.add_argument("--limit", type=int, default=PAGE_LIMIT, help="records per page")
+    get.add_argument("--parallel", type=int, default=PARALLEL)
+    get.add_argument("--mode", choices=["search", "sql"], default="search")
+    serve = sub.add_parser("serve", help="run a local CKAN stand-in over a CSV")
+    serve.add_argument("--csv", default=DRUG_SUMMARY_CSV)
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=8765)
+    serve.add_argument("--resource", default=None)
+    serve.add_argument("--delay", type=float, default=0.0, help="seconds added to every response")
+    serve.add_argument("--fail-after", type=int, default=None, help="answer 503 after N requests")
+    sub.add_parser("selftest", help="fetch the shipped CSV back from a local stand-in")
+    args = parser.parse_args()
+
+    if args.command == "get":
+        stats = {}
+        df = fetch(args.base_url, args.resource, args.out, args.limit, args.parallel, args.mode,
+                   stats=stats)
+        print(f"Fetched {len(df):,} rows in {stats['pages']} pages ({stats['resumed']} resumed) "
+              f"over {stats['connections']} connections in {stats['seconds']:.1f}s -> {args.out}")
+    elif args.command == "serve":
+        srv = stand_in(args.csv, args.host, args.port, args.resource, args.delay, args.fail_after)
+        host, port = srv.server_address[:2]
+        print(f"Serving {len(srv.records):,} records of {srv.resource!r} at "
+              f"http://{host}:{port}/api/3/action/datastore_search")
+        try:
+            srv.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    else:
+        selftest()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+"""
+Incremental monthly ingest into persisted aggregates.
+
+NHSBSA publishes one new YEAR_MONTH at a time. Instead of re-reading the
+whole history, an AggregateStore keeps the month x region x drug slices
+plus small roll-ups (national monthly totals, YEAR x REGION_NAME totals and
+per-drug totals) on disk. append_month() validates the new file, writes its
+slice into spare capacity on the month axis and updates the roll-ups by the
+new month's totals only, so monthly_totals(), annual_by_region() and
+top_drugs() never rescan the history.
+
+Each month is its own slice file, written once; save() writes only the
+new slices, the roll-ups and the manifest, and opening a store reads only
+the latter two (slices are loaded when .cube is first used):
+
+    .cache/aggregates/manifest.json        format, axes, months, sources
+    .cache/aggregates/rollups.npz
+    .cache/aggregates/months/202410.npz    items, cost, observed
+
+A store saved in the older single-file layout (cube.npz, no format in
+the manifest) is converted to slices on its next save; its roll-ups may
+hold COST in pounds, so they are rebuilt from the cube when it is opened.
+
+    python ingest.py init [CSV]        # seed the store from a full extract
+    python ingest.py append NEW.csv    # add one (or more) new months
+    python ingest.py show
+"""
+import hashlib
+import json
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+from cube import MEASURES, Cube, build_cube, load_cube, to_units
+from loader import CACHE_DIR, DRUG_SUMMARY_CSV, _atomic_write_text, file_digest, read_drug_summary_csv
+
+STORE_DIR = os.path.join(CACHE_DIR, "aggregates")
+# Bump when the on-disk layout changes; stores without it are the cube.npz layout.
+STORE_FORMAT = 1
+SLICES = ("items", "cost", "observed")
+
+
+def _capacity(n):
+    return 1 << int(np.ceil(np.log2(max(n, 1))))
+
+
+class _Rows:
+    """
+    An array grown along axis 0 into spare capacity, doubling it when full
+    (as streaming._Accumulator does), so appending a row does not copy the
+    rows before it. The trailing axes can be widened the same way.
+    """
+
+    def __init__(self, rows, dtype):
+        rows = np.asarray(rows, dtype=dtype)
+        self.n, self.tail = len(rows), rows.shape[1:]
+        self.data = np.zeros((_capacity(self.n),) + tuple(_capacity(s) for s in self.tail), dtype)
+        self.data[self._used(self.n, self.tail)] = rows
+
+    @staticmethod
+    def _used(n, tail):
+        return (slice(0, n),) + tuple(slice(0, s) for s in tail)
+
+    @property
+    def rows(self):
+        return self.data[self._used(self.n, self.tail)]
+
+    def widen(self, tail):
+        """
+        Grows the trailing axes to `tail`; new cells are zero.
+        """
+        have = self.data.shape[1:]
+        if any(t > c for t, c in zip(tail, have)):
+            data = np.zeros(self.data.shape[:1] + tuple(max(c, _capacity(t)) for t, c in zip(tail, have)),
+                            self.data.dtype)
+            data[self._used(len(data), have)] = self.data
+            self.data = data
+        self.tail = tuple(tail)
+
+    def append(self, row):
+        """
+        Appends one row (narrower rows are zero-padded) and returns its index.
+        """
+        if self.n == len(self.data):
+            data = np.zeros((2 * len(self.data),) + self.data.shape[1:], self.data.dtype)
+            data[:self.n] = self.data
+            self.data = data
+        self.data[(self.n,) + tuple(slice(0, s) for s in np.shape(row))] = row
+        self.n += 1
+        return self.n - 1
+
+
+class AggregateStore:
+    """
+    Month slices plus incrementally maintained roll-ups, persisted under
+    `root`. `months` (in arrival order), `month_totals` and the roll-ups
+    are always in memory; the slices only once .cube has been used or a
+    month has been appended.
+    """
+
+    def __init__(self, months, regions, drugs, rollups, sources, root=STORE_DIR, version=None):
+        self.months = _Rows(months, np.int64)
+        self.regions = list(regions)
+        self.drugs = list(drugs)
+        self._region_code = {label: i for i, label in enumerate(self.regions)}
+        self._drug_code = {label: i for i, label in enumerate(self.drugs)}
+        rollups = dict(rollups)
+        self.month_totals = {m: _Rows(rollups.pop(f"month_{m.lower()}"), np.int64) for m in MEASURES}
+        self.rollups = rollups
+        self.sources = sources
+        self.root = root
+        self.version = version
+        empty = (0, len(self.regions), len(self.drugs))
+        self._slices = {name: _Rows(np.zeros(empty), bool if name == "observed" else np.int64)
+                        for name in SLICES}
+        self._slot = {}        # month -> row of self._slices
+        self._saved = set(self.months.rows.tolist())
+
+    # ---- construction / persistence ------------------------------------
+
+    @classmethod
+    def from_cube(cls, cube, root=STORE_DIR, source=None, rollups=None):
+        store = cls(cube.months, cube.regions, cube.drugs, rollups or _rollups_from_cube(cube),
+                    [source] if source else [], root, cube.version)
+        for k, month in enumerate(cube.months.tolist()):
+            store._put_slice(month, cube.items[k], cube.cost[k], cube.observed[k])
+        store._saved = set()
+        return store
+
+    @classmethod
+    def open(cls, root=STORE_DIR):
+        with open(os.path.join(root, "manifest.json")) as fh:
+            manifest = json.load(fh)
+        if "format" not in manifest:
+            # Cube.load converts a pounds cube to pence; the old roll-ups are not trusted.
+            store = cls.from_cube(Cube.load(os.path.join(root, "cube.npz")), root)
+            store.sources = manifest["sources"]
+            return store
+        if manifest["format"] != STORE_FORMAT:
+            raise ValueError(f"{root}: store format {manifest['format']}, expected {STORE_FORMAT}")
+        with np.load(os.path.join(root, "rollups.npz"), allow_pickle=False) as z:
+            rollups = {k: z[k] for k in z.files}
+        return cls(manifest["months"], manifest["regions"], manifest["drugs"], rollups,
+                   manifest["sources"], root, manifest["version"])
+
+    def _month_path(self, month):
+        return os.path.join(self.root, "months", f"{month}.npz")
+
+    def save(self):
+        os.makedirs(os.path.join(self.root, "months"), exist_ok=True)
+        for month, slot in self._slot.items():
+            if month in self._saved:
+                continue
+            path = self._month_path(month)
+            tmp = f"{path}.tmp{os.getpid()}.npz"
+            np.savez(tmp, **{name: buf.data[slot, :len(self.regions), :len(self.drugs)]
+                             for name, buf in self._slices.items()})
+            os.replace(tmp, path)
+            self._saved.add(month)
+
+        tmp = os.path.join(self.root, f"rollups.tmp{os.getpid()}.npz")
+        np.savez(tmp, **self.rollups, **{f"month_{m.lower()}": buf.rows for m, buf in self.month_totals.items()})
+        os.replace(tmp, os.path.join(self.root, "rollups.npz"))
+        manifest = {"format": STORE_FORMAT, "version": self.version,
+                    "months": self.months.rows.tolist(), "regions": self.regions,
+                    "drugs": self.drugs, "sources": self.sources}
+        _atomic_write_text(os.path.join(self.root, "manifest.json"), json.dumps(manifest, indent=2))
+        legacy = os.path.join(self.root, "cube.npz")
+        if os.path.exists(legacy):
+            os.remove(legacy)
+
+    def _put_slice(self, month, items, cost, observed):
+        slots = {self._slices[name].append(arr) for name, arr in zip(SLICES, (items, cost, observed))}
+        (self._slot[month],) = slots
+
+    @property
+    def cube(self):
+        """
+        The months x regions x drugs Cube, in chronological order (views
+        into the buffers when months were appended in order).
+        """
+        for month in self.months.rows.tolist():
+            if month not in self._slot:
+                with np.load(self._month_path(month), allow_pickle=False) as z:
+                    self._put_slice(month, z["items"], z["cost"], z["observed"])
+        months = np.sort(self.months.rows)
+        slots = np.array([self._slot[m] for m in months.tolist()], dtype=np.intp)
+        rows = slice(0, len(slots)) if np.array_equal(slots, np.arange(len(slots))) else slots
+        items, cost, observed = (self._slices[name].rows[rows] for name in SLICES)
+        return Cube(months, self.regions, self.drugs, items, cost, observed, version=self.version)
+
+    # ---- ingest --------------------------------------------------------
+
+    def append_month(self, path):
+        """
+        Adds the month(s) in `path` to the store and returns them.
+
+        Raises ValueError if any of the file's YEAR_MONTH values is already
+        loaded; nothing is changed in that case.
+        """
+        df = read_drug_summary_csv(path)
+        new_months = np.unique(df["YEAR_MONTH"].to_numpy())
+        clash = np.intersect1d(new_months, self.months.rows)
+        if len(clash):
+            raise ValueError(f"{path}: YEAR_MONTH {clash.tolist()} already loaded")
+
+        new = build_cube(df)
+        self._grow_axes(new.regions, new.drugs)
+        r_idx = np.array([self._region_code[r] for r in new.regions])
+        d_idx = np.array([self._drug_code[d] for d in new.drugs])
+
+        for k, month in enumerate(new.months.tolist()):
+            self._append_month(month, new, k, r_idx, d_idx)
+
+        digest = file_digest(path)
+        self.sources.append({"path": os.path.abspath(path), "sha256": digest,
+                             "months": new_months.tolist()})
+        self.version = hashlib.sha256(f"{self.version}+{digest}".encode()).hexdigest()
+        return new_months.tolist()
+
+    def _grow_axes(self, regions, drugs):
+        ru = self.rollups
+        add_r = [r for r in regions if r not in self._region_code]
+        add_d = [d for d in drugs if d not in self._drug_code]
+        for label in add_r:
+            self._region_code[label] = len(self.regions)
+            self.regions.append(label)
+        for label in add_d:
+            self._drug_code[label] = len(self.drugs)
+            self.drugs.append(label)
+        if add_r or add_d:
+            for buf in self._slices.values():
+                buf.widen((len(self.regions), len(self.drugs)))
+        if add_r:
+            for key in ("year_region_items", "year_region_cost", "year_region_seen"):
+                ru[key] = np.pad(ru[key], ((0, 0), (0, len(add_r))))
+        if add_d:
+            for key in ("drug_items", "drug_cost"):
+                ru[key] = np.pad(ru[key], (0, len(add_d)))
+
+    def _append_month(self, month, new, k, r_idx, d_idx):
+        ru = self.rollups
+        shape = (len(self.regions), len(self.drugs))
+        items = np.zeros(shape, dtype=np.int64)
+        cost = np.zeros(shape, dtype=np.int64)
+        seen = np.zeros(shape, dtype=bool)
+        sel = np.ix_(r_idx, d_idx)
+        items[sel], cost[sel], seen[sel] = new.items[k], new.cost[k], new.observed[k]
+
+        self._put_slice(month, items, cost, seen)
+        self.months.append(month)
+        self.month_totals["ITEMS"].append(items.sum())
+        self.month_totals["COST"].append(cost.sum())
+
+        year = month // 100
+        y = int(np.searchsorted(ru["years"], year))
+        if y == len(ru["years"]) or ru["years"][y] != year:
+            ru["years"] = np.insert(ru["years"], y, year)
+            for key in ("year_region_items", "year_region_cost", "year_region_seen"):
+                ru[key] = np.insert(ru[key], y, 0, axis=0)
+        ru["year_region_items"][y] += items.sum(axis=1)
+        ru["year_region_cost"][y] += cost.sum(axis=1)
+        ru["year_region_seen"][y] |= seen.any(axis=1)
+
+        ru["drug_items"] += items.sum(axis=0)
+        ru["drug_cost"] += cost.sum(axis=0)
+
+    # ---- downstream outputs (read from roll-ups only) -------------------
+
+    def monthly_totals(self, measures=MEASURES):
+        order = np.argsort(self.months.rows, kind="stable")
+        out = pd.DataFrame({"YEAR_MONTH": self.months.rows[order]})
+        for m in measures:
+            out[m] = to_units(m, self.month_totals[m].rows[order])
+        return out
+
+    def annual_by_region(self, measure):
+        data = np.where(self.rollups["year_region_seen"],
+                        to_units(measure, self.rollups[f"year_region_{measure.lower()}"]), np.nan)
+        return pd.DataFrame(
+            data,
+            index=pd.Index(self.rollups["years"], name="YEAR"),
+            columns=pd.Index(self.regions, name="REGION_NAME"),
+        )
+
+    def by_drug(self, measure):
+        return pd.Series(
+            to_units(measure, self.rollups[f"drug_{measure.lower()}"]),
+            index=pd.Index(self.drugs, name="BNF_CHEMICAL_SUBSTANCE"),
+            name=measure,
+        )
+
+    def top_drugs(self, measure, n):
+        return self.by_drug(measure).sort_values(ascending=False).head(n).index.tolist()
+
+
+def _rollups_from_cube(cube):
+    rollups = {"years": cube.years}
+    rollups["year_region_seen"] = cube.year_sums(cube.observed.any(axis=2).astype(np.int64)) > 0
+    for m in MEASURES:
+        key = m.lower()
+        values = cube.values(m)
+        rollups[f"month_{key}"] = values.sum(axis=(1, 2))
+        rollups[f"year_region_{key}"] = cube.year_sums(values.sum(axis=2))
+        rollups[f"drug_{key}"] = values.sum(axis=(0, 1))
+    return rollups
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in ("init", "append", "show"):
+        print(__doc__)
+        sys.exit(2)
+    command, args = sys.argv[1], sys.argv[2:]
+
+    if command == "init":
+        path = args[0] if args else DRUG_SUMMARY_CSV
+        store = AggregateStore.from_cube(load_cube(path), source={
+            "path": os.path.abspath(path), "sha256": file_digest(path)})
+        store.save()
+        print(f"Initialised {STORE_DIR} with {store.months.n} months from {path}")
+        return
+
+    store = AggregateStore.open()
+    if command == "append":
+        for path in args:
+            try:
+                months = store.append_month(path)
+            except ValueError as exc:
+                print(f"Skipped: {exc}")
+                continue
+            print(f"Appended {months} from {path}")
+        store.save()
+
+    totals = store.monthly_totals()
+    print(f"{len(totals)} months loaded ({totals['YEAR_MONTH'].iloc[0]}-{totals['YEAR_MONTH'].iloc[-1]})")
+    print(totals.tail(3).to_string(index=False))
+    print("Top 5 drugs by items:", store.top_drugs("ITEMS", 5))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""
+Stage-level timing and memory spans for the scripts.
+
+Every stage of a report run (load, aggregate, transform, fit, forecast,
+diagnose, render) is wrapped in a span that records wall time, CPU time,
+the process's peak RSS and, when the stage returns a DataFrame or Series,
+its memory usage. Tracing is off unless NHS_TRACE names an output file:
+
+    NHS_TRACE=trace.jsonl python prediction.py     # one JSON object per span
+    NHS_TRACE=trace.json  python render.py         # Chrome trace (chrome://tracing, Perfetto)
+
+or, equivalently, run any script through this module:
+
+    python instrument.py --trace trace.json [--format chrome|jsonl] SCRIPT.py [ARGS ...]
+
+The format follows the file extension (.json is a Chrome trace, anything
+else JSON lines) unless NHS_TRACE_FORMAT / --format says otherwise. Worker
+processes inherit the setting and append their spans to the same trace.
+
+When tracing is off, traced() returns the function unchanged and span()
+returns a shared no-op context manager, so instrumented code runs exactly
+as before.
+"""
+import atexit
+import contextlib
+import functools
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+TRACE_ENV = "NHS_TRACE"
+FORMAT_ENV = "NHS_TRACE_FORMAT"
+OWNER_ENV = "NHS_TRACE_OWNER"
+
+_PATH = os.environ.get(TRACE_ENV) or None
+ENABLED = _PATH is not None
+_FORMAT = os.environ.get(FORMAT_ENV) or ("chrome" if (_PATH or "").endswith(".json") else "jsonl")
+# Chrome traces are one JSON document, so spans are appended to a sidecar
+# file as they finish and converted once by the process that started tracing.
+_SINK = f"{_PATH}.events" if _FORMAT == "chrome" else _PATH
+_NULL = contextlib.nullcontext()
+_local = threading.local()
+_lock = threading.Lock()
+
+
+def _peak_rss_mb():
+    # ru_maxrss is KiB on Linux, bytes on macOS.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _frame_bytes(value):
+    usage = getattr(value, "memory_usage", None)
+    if usage is None:
+        return None
+    try:
+        total = usage(deep=True)
+    except TypeError:
+        return None
+    return int(total.sum() if hasattr(total, "sum") else total)
+
+
+def _emit(record):
+    line = json.dumps(record, default=str) + "\n"
+    with _lock, open(_SINK, "a") as fh:
+        fh.write(line)
+
+
+class Span:
+    """
+    One timed region. Use through span() or traced(); `set(key=value)` adds
+    attributes and `frame(df)` records a DataFrame's memory usage.
+    """
+
+    def __init__(self, name, cat, attrs):
+        self.name = name
+        self.cat = cat
+        self.attrs = dict(attrs)
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def frame(self, value):
+        nbytes = _frame_bytes(value)
+        if nbytes is not None:
+            self.attrs["frame_bytes"] = nbytes
+
+    def __enter__(self):
+        stack = _local.__dict__.setdefault("stack", [])
+        self.parent = stack[-1].name if stack else None
+        self.depth = len(stack)
+        stack.append(self)
+        self.rss0 = _peak_rss_mb()
+        self.ts = time.time()
+        self.cpu0 = time.process_time()
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        wall = time.perf_counter() - self.t0
+        cpu = time.process_time() - self.cpu0
+        rss = _peak_rss_mb()
+        _local.stack.pop()
+        _emit({
+            "name": self.name, "cat": self.cat, "ts": self.ts,
+            "wall_s": wall, "cpu_s": cpu,
+            "peak_rss_mb": round(rss, 1), "peak_rss_growth_mb": round(rss - self.rss0, 1),
+            "pid": os.getpid(), "tid": threading.get_ident(),
+            "depth": self.depth, "parent": self.parent,
+            "error": exc_type.__name__ if exc_type else None,
+            **self.attrs,
+        })
+        return False
+
+
+def span(name, cat="stage", **attrs):
+    """
+    Context manager timing the enclosed block as span `name` of category
+    `cat` (load, aggregate, transform, fit, forecast, diagnose, render).
+    """
+    if not ENABLED:
+        return _NULL
+    return Span(name, cat, attrs)
+
+
+def traced(cat, name=None):
+    """
+    Decorator: runs the function inside a span named after it. A DataFrame
+    or Series return value has its memory usage recorded.
+    """
+    def wrap(fn):
+        if not ENABLED:
+            return fn
+        label = name or f"{fn.__module__}.{fn.__qualname__}"
+
+        @functools.wraps(fn)
+        def inner(*args, **kwargs):
+            with Span(label, cat, {}) as sp:
+                value = fn(*args, **kwargs)
+                sp.frame(value)
+                return value
+        return inner
+    return wrap
+
+
+def to_chrome(events_path, out_path):
+    """
+    Converts JSON-lines span records to a Chrome trace-event file.
+    """
+    events = []
+    with open(events_path) as fh:
+        for line in fh:
+            rec = json.loads(line)
+            args = {k: v for k, v in rec.items()
+                    if k not in ("name", "cat", "ts", "wall_s", "pid", "tid")}
+            events.append({"name": rec["name"], "cat": rec["cat"], "ph": "X",
+                           "ts": rec["ts"] * 1e6, "dur": rec["wall_s"] * 1e6,
+                           "pid": rec["pid"], "tid": rec["tid"], "args": args})
+    tmp = f"{out_path}.tmp{os.getpid()}"
+    with open(tmp, "w") as fh:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, fh)
+    os.replace(tmp, out_path)
+
+
+def _finish():
+    if os.environ.get(OWNER_ENV) == str(os.getpid()) and os.path.exists(_SINK):
+        to_chrome(_SINK, _PATH)
+        os.remove(_SINK)
+
+
+if ENABLED:
+    if OWNER_ENV not in os.environ:
+        # This process started tracing: begin a fresh trace and, for Chrome
+        # output, convert the collected spans when it exits.
+        os.environ[OWNER_ENV] = str(os.getpid())
+        if os.path.exists(_SINK):
+            os.remove(_SINK)
+    if _FORMAT == "chrome" and os.environ[OWNER_ENV] == str(os.getpid()):
+        atexit.register(_finish)
+
+
+def main():
+    import argparse
+    import runpy
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--trace", required=True, help="output file (.json: Chrome trace)")
+    parser.add_argument("--format", choices=["chrome", "jsonl"], default=None)
+    parser.add_argument("script")
+    parser.add_argument("args", nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+
+    # The script imports this module afresh (this copy is __main__), and that
+    # import reads the settings from the environment.
+    os.environ[TRACE_ENV] = os.path.abspath(args.trace)
+    if args.format:
+        os.environ[FORMAT_ENV] = args.format
+    os.environ.pop(OWNER_ENV, None)
+    sys.argv = [args.script] + args.args
+    sys.path.insert(0, os.path.dirname(os.path.abspath(args.script)))
+    runpy.run_path(args.script, run_name="__main__")
+
+
+if __name__ == "__main__":
+    main()
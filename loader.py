@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+"""
+Shared loader for the NHSBSA regional drug summary.
+
+The CSV is parsed once and stored as a Parquet file under .cache/. The cache
+is keyed by the source file's content hash; the file's size and mtime are
+kept in a small manifest so an unchanged source is recognised without
+re-hashing it. Every analysis script reads the data through
+load_drug_summary() instead of calling pd.read_csv itself.
+
+REGION_NAME and BNF_CHEMICAL_SUBSTANCE are dictionary-encoded as pandas
+categoricals and YEAR / YEAR_MONTH are stored as small integers. The
+code -> label dictionaries are kept in .cache/dictionaries.json: labels are
+only ever appended, so a code keeps its meaning across dataset versions.
+
+COST is published in pounds with at most two decimal places. It is held
+as an exact int64 COST_PENCE column, so every total is an integer sum that
+does not depend on summation order; to_pounds() converts for display.
+Run `python loader.py --memory-report` to compare against a plain read_csv.
+"""
+import hashlib
+import json
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+from instrument import traced
+
+try:
+    import pyarrow  # noqa: F401  (needed for the Parquet cache)
+    HAVE_PYARROW = True
+except ImportError:
+    HAVE_PYARROW = False
+
+DRUG_SUMMARY_CSV = "BSA_ODP_PCA_REGIONAL_DRUG_SUMMARY.csv"
+# Month x region totals over all drugs; about 30x smaller than the drug file.
+REGIONAL_SUMMARY_CSV = "BSA_ODP_PCA_REGIONAL_SUMMARY.csv"
+CACHE_DIR = ".cache"
+# Bump when the cached column layout changes so old caches are not reused.
+CACHE_FORMAT = 3
+
+CATEGORICAL_COLUMNS = ("REGION_NAME", "BNF_CHEMICAL_SUBSTANCE")
+DRUG_SUMMARY_DTYPES = {
+    "YEAR": "int16",
+    "YEAR_MONTH": "int32",
+    "REGION_NAME": "category",
+    "BNF_CHEMICAL_SUBSTANCE": "category",
+    "ITEMS": "int64",
+    "COST": "float64",
+}
+REGIONAL_SUMMARY_DTYPES = {
+    "YEAR_MONTH": "int32",
+    "REGION_NAME": "category",
+    "ITEMS": "int64",
+    "COST": "float64",
+}
+PENCE_PER_POUND = 100
+
+
+def file_digest(path, block_size=1 << 20):
+    """
+    Returns the SHA-256 hex digest of a file's content.
+    """
+    h = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for block in iter(lambda: fh.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _manifest_path(path, cache_dir):
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(cache_dir, f"{stem}.manifest.json")
+
+
+def _cache_path(path, cache_dir, digest):
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(cache_dir, f"{stem}.{digest[:16]}.v{CACHE_FORMAT}.parquet")
+
+
+def dataset_version(path=DRUG_SUMMARY_CSV, cache_dir=CACHE_DIR):
+    """
+    Returns the content hash identifying the current version of `path`.
+
+    The hash is only recomputed when the file's size or mtime differ from
+    the ones recorded in the manifest, so repeated calls are cheap.
+    """
+    st = os.stat(path)
+    manifest_file = _manifest_path(path, cache_dir)
+    manifest = {}
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as fh:
+            manifest = json.load(fh)
+
+    if manifest.get("size") == st.st_size and manifest.get("mtime_ns") == st.st_mtime_ns:
+        return manifest["sha256"]
+
+    digest = file_digest(path)
+    os.makedirs(cache_dir, exist_ok=True)
+    manifest = {"source": os.path.abspath(path), "size": st.st_size,
+                "mtime_ns": st.st_mtime_ns, "sha256": digest}
+    _atomic_write_text(manifest_file, json.dumps(manifest, indent=2))
+    return digest
+
+
+def _atomic_write_text(path, text):
+    tmp = f"{path}.tmp{os.getpid()}"
+    with open(tmp, "w") as fh:
+        fh.write(text)
+    os.replace(tmp, path)
+
+
+def to_pence(pounds):
+    """
+    COST values in pounds (two decimal places, as published) as int64 pence.
+    """
+    pounds = np.asarray(pounds, dtype=np.float64)
+    if not np.isfinite(pounds).all():
+        raise ValueError("COST has missing or non-finite values")
+    return np.rint(pounds * PENCE_PER_POUND).astype(np.int64)
+
+
+def to_pounds(pence):
+    """
+    Exact pence totals as float64 pounds, for display and modelling.
+    """
+    return np.asarray(pence) / PENCE_PER_POUND
+
+
+def with_pence(df):
+    """
+    Replaces the parsed COST column by COST_PENCE, in the same position.
+    """
+    pos = df.columns.get_loc("COST")
+    pence = to_pence(df.pop("COST").to_numpy())
+    df.insert(pos, "COST_PENCE", pence)
+    return df
+
+
+@traced("load")
+def read_drug_summary_csv(path=DRUG_SUMMARY_CSV, cache_dir=CACHE_DIR):
+    """
+    Parses the drug summary CSV into compact, dictionary-encoded columns.
+    """
+    df = pd.read_csv(path, dtype=DRUG_SUMMARY_DTYPES)
+    return encode_categoricals(with_pence(df), cache_dir)
+
+
+@traced("load")
+def read_regional_summary_csv(path=REGIONAL_SUMMARY_CSV):
+    """
+    Parses the month x region summary CSV (no drug breakdown).
+    """
+    return with_pence(pd.read_csv(path, dtype=REGIONAL_SUMMARY_DTYPES))
+
+
+def load_dictionaries(cache_dir=CACHE_DIR):
+    """
+    Returns the persisted {column: [label for code 0, 1, ...]} mappings.
+    """
+    path = os.path.join(cache_dir, "dictionaries.json")
+    if not os.path.exists(path):
+        return {}
+    with open(path) as fh:
+        return json.load(fh)
+
+
+def encode_categoricals(df, cache_dir=CACHE_DIR):
+    """
+    Re-codes the categorical columns of `df` against the stable dictionaries.
+
+    Labels not seen before are appended (in sorted order) to the column's
+    dictionary, which is then saved; existing codes never change. Columns
+    missing from `df` (e.g. a projected read) are skipped.
+    """
+    dictionaries = load_dictionaries(cache_dir)
+    changed = False
+    for col in CATEGORICAL_COLUMNS:
+        if col not in df.columns:
+            continue
+        known = dictionaries.get(col, [])
+        seen = set(known)
+        if isinstance(df[col].dtype, pd.CategoricalDtype):
+            labels = df[col].cat.categories
+        else:
+            labels = df[col].dropna().unique()
+        new = sorted(str(v) for v in labels if v not in seen)
+        if new:
+            known = known + new
+            dictionaries[col] = known
+            changed = True
+        df[col] = pd.Categorical(df[col], categories=known)
+
+    if changed:
+        os.makedirs(cache_dir, exist_ok=True)
+        _atomic_write_text(os.path.join(cache_dir, "dictionaries.json"),
+                           json.dumps(dictionaries, indent=2))
+    return df
+
+
+@traced("load")
+def load_drug_summary(path=DRUG_SUMMARY_CSV, cache_dir=CACHE_DIR, use_cache=True):
+    """
+    Loads the drug summary, going through the Parquet cache when possible.
+
+    The cache is rebuilt only when the source file's content changes. Without
+    pyarrow (or with use_cache=False) the CSV is parsed directly.
+    """
+    if not (use_cache and HAVE_PYARROW):
+        return read_drug_summary_csv(path, cache_dir)
+
+    digest = dataset_version(path, cache_dir)
+    cache_file = _cache_path(path, cache_dir, digest)
+    if os.path.exists(cache_file):
+        return pd.read_parquet(cache_file, memory_map=True)
+
+    df = read_drug_summary_csv(path, cache_dir)
+    write_cache(df, path, cache_dir)
+    return df
+
+
+def write_cache(df, path=DRUG_SUMMARY_CSV, cache_dir=CACHE_DIR):
+    """
+    Stores `df` (laid out as read_drug_summary_csv returns it) as the Parquet
+    cache for the current content of `path`, so the next load_drug_summary()
+    does not parse the CSV. A no-op without pyarrow.
+    """
+    if not HAVE_PYARROW:
+        return
+    cache_file = _cache_path(path, cache_dir, dataset_version(path, cache_dir))
+    tmp = f"{cache_file}.tmp{os.getpid()}"
+    df.to_parquet(tmp, index=False)
+    os.replace(tmp, cache_file)
+    _prune_stale_caches(path, cache_dir, keep=cache_file)
+
+
+def _prune_stale_caches(path, cache_dir, keep):
+    stem = os.path.splitext(os.path.basename(path))[0]
+    for name in os.listdir(cache_dir):
+        full = os.path.join(cache_dir, name)
+        if name.startswith(f"{stem}.") and name.endswith(".parquet") and full != keep:
+            os.remove(full)
+
+
+def memory_report(path=DRUG_SUMMARY_CSV, cache_dir=CACHE_DIR):
+    """
+    Per-column memory (bytes) of a plain object-string read_csv vs the loader.
+    """
+    raw = pd.read_csv(path, dtype={c: object for c in CATEGORICAL_COLUMNS})
+    raw = raw.rename(columns={"COST": "COST_PENCE"})  # float pounds vs int pence
+    encoded = load_drug_summary(path, cache_dir)
+    report = pd.DataFrame({
+        "raw_dtype": raw.dtypes.astype(str),
+        "raw_bytes": raw.memory_usage(deep=True, index=False),
+        "encoded_dtype": encoded.dtypes.astype(str),
+        "encoded_bytes": encoded.memory_usage(deep=True, index=False),
+    })
+    report.loc["TOTAL", ["raw_bytes", "encoded_bytes"]] = report[["raw_bytes", "encoded_bytes"]].sum()
+    report["ratio"] = report["raw_bytes"] / report["encoded_bytes"]
+    return report
+
+
+def main():
+    args = sys.argv[1:]
+    if "--memory-report" in args:
+        args.remove("--memory-report")
+        path = args[0] if args else DRUG_SUMMARY_CSV
+        print(memory_report(path).to_string(float_format="{:,.1f}".format))
+        return
+
+    path = args[0] if args else DRUG_SUMMARY_CSV
+    df = load_drug_summary(path)
+    print(f"Loaded {len(df):,} rows from {path} (version {dataset_version(path)[:16]})")
+    print(df.dtypes)
+
+
+if __name__ == "__main__":
+    main()
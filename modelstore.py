@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+"""
+Compact persisted ARIMA(1,1,0)+drift models and a statsmodels-free forecast().
+
+An ARIMA(1,1,0)+drift forecast needs only the drift, ar.L1 and sigma2 and
+the last level and first difference of the series (see arima110.py), so a
+model is one fixed-width binary record instead of a pickled ARIMAResults
+with its data and filter output:
+
+    drift, ar_L1, sigma2    f8      parameters (x1, ar.L1, sigma2)
+    cov                     f8[3,3] parameter covariance, same order
+    last_y, last_dy         f8      final state
+    nobs, last_month        i4      observations, last YEAR_MONTH
+
+The file is a short JSON header (series ids, dataset version) followed by
+the records, 120 bytes each; it is memory-mapped, so opening it reads only
+the header, and the models actually used are kept in an in-process LRU.
+
+build_store() fits every region x drug series of the cube with the
+vectorized fitter, plus the national ITEMS and COST series, and also keeps
+the statsmodels fits of the pipeline (ITEMS/national/statsmodels and
+ITEMS/national/statsmodels-train, the models of prediction.py) with their
+own covariance. Series ids are "MEASURE/REGION/DRUG" and "MEASURE/national".
+
+    python modelstore.py [--rebuild] [--series ID] [--steps 5]
+"""
+import argparse
+import functools
+import json
+import math
+import os
+import time
+from collections import namedtuple
+from statistics import NormalDist
+
+import numpy as np
+
+from instrument import traced
+from loader import CACHE_DIR
+
+MODEL_STORE = os.path.join(CACHE_DIR, "models.bin")
+MAGIC = b"NHSARIMA"
+STORE_FORMAT = 1
+HOT_MODELS = 4096
+PARAMS = ("x1", "ar.L1", "sigma2")
+
+MODEL_DTYPE = np.dtype([
+    ("drift", "<f8"), ("ar_L1", "<f8"), ("sigma2", "<f8"),
+    ("cov", "<f8", (3, 3)),
+    ("last_y", "<f8"), ("last_dy", "<f8"),
+    ("nobs", "<i4"), ("last_month", "<i4"),
+])
+
+Model = namedtuple("Model", "drift ar_L1 sigma2 last_y last_dy nobs last_month")
+
+
+@functools.lru_cache(maxsize=None)
+def _z(level):
+    return NormalDist().inv_cdf(0.5 + level / 2)
+
+
+def write_store(path, ids, fit, last_month, cov=None, version=None):
+    """
+    Writes the models of an arima110.ARIMA110Fit (one per id) to `path`.
+
+    `cov` is (n, 3, 3); by default the diagonal of the fit's standard
+    errors (the three estimates are asymptotically independent).
+    """
+    records = np.zeros(len(ids), dtype=MODEL_DTYPE)
+    records["drift"], records["ar_L1"], records["sigma2"] = fit.drift, fit.ar_L1, fit.sigma2
+    records["cov"] = _diag_cov(fit) if cov is None else cov
+    records["last_y"], records["last_dy"] = fit.last_y, fit.last_dy
+    records["nobs"], records["last_month"] = fit.nobs, last_month
+
+    header = json.dumps({"format": STORE_FORMAT, "version": version, "ids": list(ids)}).encode()
+    # Records start on an 8-byte boundary after magic, header length and header.
+    pad = -(len(MAGIC) + 4 + len(header)) % 8
+    tmp = f"{path}.tmp{os.getpid()}"
+    with open(tmp, "wb") as fh:
+        fh.write(MAGIC)
+        fh.write(len(header).to_bytes(4, "little"))
+        fh.write(header + b" " * pad)
+        fh.write(records.tobytes())
+    os.replace(tmp, path)
+
+
+def _diag_cov(fit):
+    cov = np.zeros((len(fit.drift), 3, 3))
+    for i, p in enumerate(PARAMS):
+        cov[:, i, i] = np.asarray(fit.bse[p]) ** 2
+    return cov
+
+
+def _results_cov(results):
+    cov = results.cov_params()
+    return np.asarray(cov.loc[list(PARAMS), list(PARAMS)], dtype=np.float64)[None]
+
+
+def _concat(fits):
+    """
+    One ARIMA110Fit (without standard errors) holding the series of several.
+    """
+    from arima110 import ARIMA110Fit
+
+    cat = lambda attr: np.concatenate([np.atleast_1d(getattr(f, attr)) for f in fits])
+    return ARIMA110Fit(cat("drift"), cat("ar_L1"), cat("sigma2"), {}, cat("loglike"),
+                       cat("nobs"), cat("last_y"), cat("last_dy"))
+
+
+@traced("fit")
+def build_store(cube=None, path=MODEL_STORE, pipe=None):
+    """
+    Fits and stores every series' model (see the module docstring);
+    returns the number of models written.
+    """
+    from arima110 import fit_arima110
+    from batch_forecast import MIN_OBSERVATIONS, build_series
+    from cube import MEASURES, load_cube
+    from fanchart import fit_from_results
+    from pipeline import TEST_SIZE, Pipeline
+
+    cube = cube or load_cube()
+    last_month = int(cube.months[-1])
+    values, index = build_series(cube)
+    keep = np.count_nonzero(values, axis=1) >= MIN_OBSERVATIONS
+    ids = [f"{m}/{r}/{d}" for m, r, d in index[keep].itertuples(index=False)]
+    national = np.vstack([cube.monthly_totals([m])[m].to_numpy(dtype=np.float64) for m in MEASURES])
+    ids += [f"{m}/national" for m in MEASURES]
+    fits = [fit_arima110(values[keep]), fit_arima110(national)]
+    covs = [_diag_cov(f) for f in fits]
+
+    pipe = pipe or Pipeline()
+    months = [last_month] * len(ids)
+    for name, stage, end in (("statsmodels", "arima_full", last_month),
+                             ("statsmodels-train", "arima_train", int(cube.months[-1 - TEST_SIZE]))):
+        results = pipe.get(stage)
+        ids.append(f"ITEMS/national/{name}")
+        fits.append(fit_from_results(results))
+        covs.append(_results_cov(results))
+        months.append(end)
+
+    write_store(path, ids, _concat(fits), months, np.concatenate(covs), version=cube.version)
+    return len(ids)
+
+
+class ModelStore:
+    """
+    Read-only access to a file written by write_store(), with an LRU of
+    decoded models.
+    """
+
+    def __init__(self, path=MODEL_STORE, cache_size=HOT_MODELS):
+        self.path = path
+        with open(path, "rb") as fh:
+            if fh.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not a model store")
+            size = int.from_bytes(fh.read(4), "little")
+            header = json.loads(fh.read(size))
+        if header["format"] != STORE_FORMAT:
+            raise ValueError(f"{path}: store format {header['format']}, expected {STORE_FORMAT}")
+        offset = len(MAGIC) + 4 + size + (-(len(MAGIC) + 4 + size) % 8)
+        self.version = header["version"]
+        self.ids = header["ids"]
+        self.row = {sid: i for i, sid in enumerate(self.ids)}
+        self.records = np.memmap(path, dtype=MODEL_DTYPE, mode="r", offset=offset,
+                                 shape=(len(self.ids),))
+        self.model = functools.lru_cache(maxsize=cache_size)(self._decode)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, series_id):
+        return series_id in self.row
+
+    def _decode(self, series_id):
+        try:
+            rec = self.records[self.row[series_id]]
+        except KeyError:
+            raise KeyError(f"no model for series {series_id!r}") from None
+        return Model(float(rec["drift"]), float(rec["ar_L1"]), float(rec["sigma2"]),
+                     float(rec["last_y"]), float(rec["last_dy"]), int(rec["nobs"]),
+                     int(rec["last_month"]))
+
+    def params(self, series_id):
+        """
+        {x1, ar.L1, sigma2} and their covariance matrix.
+        """
+        m = self.model(series_id)
+        cov = np.array(self.records[self.row[series_id]]["cov"])
+        return {"x1": m.drift, "ar.L1": m.ar_L1, "sigma2": m.sigma2}, cov
+
+    def forecast(self, series_id, steps=5, levels=(0.90, 0.70, 0.50)):
+        """
+        Returns (mean, {level: (lower, upper)}) as lists over `steps` ahead,
+        the same values as ARIMA110Fit.forecast and statsmodels' get_forecast.
+        """
+        m = self.model(series_id)
+        mean, var = [], []
+        level, z, psi, phi_k, s = m.last_y, m.last_dy, 0.0, 1.0, 0.0
+        for _ in range(steps):
+            z = m.drift + m.ar_L1 * (z - m.drift)
+            level += z
+            mean.append(level)
+            psi += phi_k          # psi_k = 1 + phi + ... + phi^k
+            phi_k *= m.ar_L1
+            s += psi * psi
+            var.append(m.sigma2 * s)
+        sd = [math.sqrt(v) for v in var]
+        intervals = {}
+        for lv in levels:
+            q = _z(lv)
+            intervals[lv] = ([a - q * b for a, b in zip(mean, sd)], [a + q * b for a, b in zip(mean, sd)])
+        return mean, intervals
+
+
+def open_store(path=MODEL_STORE, rebuild=False, cube=None):
+    """
+    A ModelStore fitted to the current dataset version, (re)building it first
+    if it is missing or was fitted to another version.
+    """
+    from cube import load_cube
+
+    cube = cube or load_cube()
+    if not rebuild and os.path.exists(path):
+        store = ModelStore(path)
+        if store.version == cube.version:
+            return store
+    build_store(cube, path)
+    return ModelStore(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rebuild", action="store_true")
+    parser.add_argument("--series", default="ITEMS/national/statsmodels")
+    parser.add_argument("--steps", type=int, default=5)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    store = open_store(rebuild=args.rebuild)
+    print(f"{len(store):,} models in {store.path} ({os.path.getsize(store.path):,} bytes), "
+          f"ready in {(time.perf_counter() - start)*1e3:.1f} ms")
+
+    mean, intervals = store.forecast(args.series, args.steps)
+    print(f"{args.series}: mean {np.round(mean, 1).tolist()}")
+    for level, (lo, hi) in intervals.items():
+        print(f"  {level:.0%}: {np.round(lo, 1).tolist()} .. {np.round(hi, 1).tolist()}")
+
+    n = 10_000
+    start = time.perf_counter()
+    for _ in range(n):
+        store.forecast(args.series, args.steps)
+    hot = (time.perf_counter() - start) / n
+    cold = ModelStore(store.path, cache_size=0)
+    start = time.perf_counter()
+    for sid in cold.ids:
+        cold.forecast(sid, args.steps)
+    print(f"forecast(): {hot*1e6:.1f} us per call for a hot model, "
+          f"{(time.perf_counter() - start) / len(cold)*1e6:.1f} us uncached")
+
+    if args.series.startswith("ITEMS/national/statsmodels"):
+        from fanchart import intervals as bands, moments_from_results
+        from pipeline import Pipeline
+        stage = "arima_train" if args.series.endswith("train") else "arima_full"
+        ref_mean, ref_var = moments_from_results(Pipeline().get(stage), args.steps)
+        lo, hi = bands(ref_mean, ref_var, list(intervals))
+        err = max(np.abs(np.asarray(mean) - ref_mean).max(),
+                  max(np.abs(np.asarray(intervals[lv][0]) - lo[i]).max() for i, lv in enumerate(intervals)))
+        print(f"max abs difference from statsmodels get_forecast: {err:.2e}")
+
+
+if __name__ == "__main__":
+    main()
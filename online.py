@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+Online ARIMA(1,1,0)+drift: O(1) updates as each new month arrives.
+
+The exact AR(1)-with-mean likelihood of the differences depends on the
+data only through the sums of arima110.ar1_stats, so OnlineARIMA110 keeps
+those sums (plus the last level and difference) for every series. A new
+YEAR_MONTH column of levels extends them in constant time per series, and
+the parameters are re-estimated from the sums with a couple of Newton steps
+warm-started at the previous ar.L1, all series in one vectorized step. The
+updated fit forecasts the next months straight away.
+
+With forgetting < 1 every sum (including the first observation's weight)
+is discounted by that factor per month, so the estimates track recent
+behaviour; forgetting=1 reproduces the full-history fit.
+
+    python online.py [--series national|all] [--warmup 12] [--forgetting 1.0]
+"""
+import argparse
+import time
+
+import numpy as np
+
+from arima110 import fit_arima110, fit_from_stats
+from instrument import traced
+
+SUMS = ("n", "w1", "sx", "st", "sxx", "stt", "sxt")
+
+
+class OnlineARIMA110:
+    """
+    Recursively updated ARIMA(1,1,0)+drift fits for a batch of series.
+
+    `y` holds the history to start from (levels, n_series x n_months, at
+    least two months); `fit` is the current arima110.ARIMA110Fit.
+    """
+
+    def __init__(self, y, forgetting=1.0, refine=2):
+        y = np.atleast_2d(np.asarray(y, dtype=np.float64))
+        if y.shape[1] < 2:
+            raise ValueError("need at least two months to start from")
+        if not 0 < forgetting <= 1:
+            raise ValueError(f"forgetting must be in (0, 1], got {forgetting}")
+        self.forgetting = forgetting
+        self.refine = refine
+        z = np.diff(y, axis=1)
+        shift = z.mean(axis=1)
+        zeros = np.zeros(len(y))
+        self.stats = {"n": np.ones(len(y)), "w1": np.ones(len(y)), "shift": shift,
+                      "z1": z[:, 0] - shift, "sx": zeros.copy(), "st": zeros.copy(),
+                      "sxx": zeros.copy(), "stt": zeros.copy(), "sxt": zeros.copy()}
+        self.last_y, self.last_dy = y[:, 1], z[:, 0]
+        for t in range(2, y.shape[1]):
+            self._accumulate(y[:, t])
+        self.months = y.shape[1]
+        self.fit = fit_from_stats(self.stats, self.last_y, self.last_dy)
+
+    def _accumulate(self, y_new):
+        s = self.stats
+        if self.forgetting < 1:
+            for key in SUMS:
+                s[key] *= self.forgetting
+        z = y_new - self.last_y
+        x, t = self.last_dy - s["shift"], z - s["shift"]
+        s["n"] += 1
+        s["sx"] += x
+        s["st"] += t
+        s["sxx"] += x * x
+        s["stt"] += t * t
+        s["sxt"] += x * t
+        self.last_y, self.last_dy = y_new, z
+
+    @traced("fit")
+    def update(self, y_new):
+        """
+        Appends one month of levels (one per series) and returns the
+        re-estimated fit.
+        """
+        y_new = np.asarray(y_new, dtype=np.float64)
+        if y_new.shape != self.last_y.shape:
+            raise ValueError(f"expected {self.last_y.shape[0]} levels, got shape {y_new.shape}")
+        self._accumulate(y_new)
+        self.months += 1
+        self.fit = fit_from_stats(self.stats, self.last_y, self.last_dy,
+                                  refine=self.refine, phi_start=self.fit.ar_L1)
+        return self.fit
+
+    def forecast(self, steps=1, levels=(0.90, 0.70, 0.50)):
+        """
+        Returns (mean, {level: (lower, upper)}) from the current fit.
+        """
+        return self.fit.forecast(steps, levels)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--series", choices=["national", "all"], default="all",
+                        help="national monthly ITEMS, or every region x drug series of ITEMS and COST")
+    parser.add_argument("--warmup", type=int, default=12, help="months in the starting history")
+    parser.add_argument("--forgetting", type=float, default=1.0)
+    args = parser.parse_args()
+
+    from cube import load_cube
+    cube = load_cube()
+    if args.series == "national":
+        y = cube.monthly_totals(["ITEMS"])["ITEMS"].to_numpy(dtype=np.float64)[None, :]
+    else:
+        from batch_forecast import MIN_OBSERVATIONS, build_series
+        y, _ = build_series(cube)
+        y = y[np.count_nonzero(y, axis=1) >= MIN_OBSERVATIONS]
+    T = y.shape[1]
+
+    online = OnlineARIMA110(y[:, :args.warmup], forgetting=args.forgetting)
+    errors, update_s, refit_s = [], [], []
+    for t in range(args.warmup, T):
+        mean, _ = online.forecast(1)
+        errors.append(np.abs(y[:, t] - mean[:, 0]))
+        start = time.perf_counter()
+        online.update(y[:, t])
+        update_s.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        fit_arima110(y[:, :t + 1])
+        refit_s.append(time.perf_counter() - start)
+
+    print(f"{len(y)} series, {args.warmup} warm-up months, {T - args.warmup} online updates "
+          f"(forgetting {args.forgetting})")
+    print(f"  update: {np.mean(update_s)*1e3:.3f} ms per month for all series "
+          f"({np.mean(update_s) / len(y)*1e6:.2f} us per series); "
+          f"full refit: {np.mean(refit_s)*1e3:.3f} ms per month")
+    print(f"  one-step-ahead MAE over the online months: {np.mean(errors):,.1f}")
+
+    if args.forgetting == 1:
+        full = fit_arima110(y)
+        for name in ("drift", "ar_L1", "sigma2"):
+            a, b = getattr(online.fit, name), getattr(full, name)
+            rel = np.abs(a - b) / np.maximum(np.abs(b), 1e-12)
+            print(f"  {name:<7} vs full refit: max relative difference {np.nanmax(rel):.2e}")
+
+    mean, intervals = online.forecast(1)
+    lo, hi = intervals[0.90]
+    print(f"  next month, first series: {mean[0, 0]:,.1f} (90%: {lo[0, 0]:,.1f} .. {hi[0, 0]:,.1f})")
+
+
+if __name__ == "__main__":
+    main()
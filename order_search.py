@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+"""
+Automatic ARIMA order selection for the national and region x drug series.
+
+prediction.py and residual_diagnostics.py use ARIMA(1,1,0) with trend "t",
+chosen by reading the ACF/PACF in check_normal.py. This script searches
+orders per series instead:
+
+  d        the smallest d <= --max-d for which a KPSS test no longer rejects
+           stationarity of the d-times differenced series (information
+           criteria are not comparable across d, so d is not ranked by IC);
+  p, q     0..--max-p / 0..--max-q, with and without drift (statsmodels
+           trend "c" for d = 0, "t" for d = 1);
+  P, Q     optional seasonal AR/MA terms of period 12 (--seasonal), as tried
+           when checking for a yearly cycle; --seasonal-diff adds D = 1.
+
+The differenced (and rescaled) series is computed once per series and shared
+by every candidate, which is then fitted as an ARMA on it. Candidates are
+fitted in a process pool, level by level in the number of ARMA terms. A
+candidate is only fitted if one of its parents (the same model with one term
+fewer) came within --prune-margin of the best AIC/BIC found so far for that
+series; more complex versions of clearly dominated models are skipped.
+The first level (no ARMA terms) of every series is always fitted; after
+that, candidates not started when the --budget (seconds) runs out are
+dropped and the best model found so far is kept, so every series still gets
+a model.
+
+    python order_search.py [--series national|all] [--ic aic|bic] [--seasonal] [--budget S] [--out FILE]
+"""
+import argparse
+import itertools
+import os
+import time
+import warnings
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+import pandas as pd
+
+from instrument import traced
+
+SEASONAL_PERIOD = 12
+PRUNE_MARGIN = 10.0  # IC units; a gap above 10 leaves a model essentially no support
+KPSS_ALPHA = 0.05
+
+
+def _init_worker():
+    warnings.simplefilter("ignore")
+
+
+def choose_d(y, max_d=1, alpha=KPSS_ALPHA):
+    """
+    Smallest number of differences after which KPSS does not reject
+    stationarity at `alpha`.
+    """
+    from statsmodels.tsa.stattools import kpss
+
+    z = np.asarray(y, dtype=np.float64)
+    for d in range(max_d):
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")  # p-value outside the lookup table
+            p_value = kpss(z, regression="c", nlags="auto")[1]
+        if p_value >= alpha:
+            return d
+        z = np.diff(z)
+    return max_d
+
+
+def difference(y, d, seasonal_d=0, period=SEASONAL_PERIOD):
+    """
+    Applies `d` ordinary and `seasonal_d` seasonal differences.
+    """
+    z = np.asarray(y, dtype=np.float64)
+    for _ in range(d):
+        z = np.diff(z)
+    for _ in range(seasonal_d):
+        z = z[period:] - z[:-period]
+    return z
+
+
+def candidates(d, max_p, max_q, seasonal):
+    """
+    Every (p, q, P, Q, drift) in the grid, grouped by number of ARMA terms.
+    """
+    drifts = (False, True) if d <= 1 else (False,)
+    max_s = 1 if seasonal else 0
+    levels = {}
+    for p, q, P, Q, drift in itertools.product(range(max_p + 1), range(max_q + 1),
+                                               range(max_s + 1), range(max_s + 1), drifts):
+        levels.setdefault(p + q + P + Q, []).append((p, q, P, Q, drift))
+    return [levels[k] for k in sorted(levels)]
+
+
+def _parents(cand):
+    p, q, P, Q, drift = cand
+    terms = [p, q, P, Q]
+    for i, t in enumerate(terms):
+        if t:
+            parent = terms.copy()
+            parent[i] -= 1
+            yield (*parent, drift)
+
+
+def fit_candidate(z, cand, period=SEASONAL_PERIOD):
+    """
+    Fits one ARMA candidate to the differenced, rescaled series `z`.
+
+    Returns (status, aic, bic, params dict) on the scale of `z`.
+    """
+    from statsmodels.tsa.arima.model import ARIMA
+
+    p, q, P, Q, drift = cand
+    try:
+        res = ARIMA(z, order=(p, 0, q), seasonal_order=(P, 0, Q, period if P or Q else 0),
+                    trend="c" if drift else "n").fit()
+    except Exception as exc:  # one bad candidate must not stop the search
+        return f"failed: {type(exc).__name__}", np.inf, np.inf, {}
+    converged = res.mle_retvals.get("converged", True) if res.mle_retvals else True
+    return ("ok" if converged else "not converged"), res.aic, res.bic, dict(zip(res.param_names, res.params))
+
+
+class _SeriesSearch:
+    """
+    Search state for one series: its shared differenced data and the
+    candidates fitted so far.
+    """
+
+    def __init__(self, y, d, seasonal_d, period):
+        z = difference(y, d, seasonal_d, period)
+        self.d = d
+        self.seasonal_d = seasonal_d
+        self.scale = z.std() or 1.0
+        self.z = z / self.scale
+        self.fitted = {}  # cand -> (status, aic, bic, params)
+
+    def best_ic(self, ic):
+        values = [r[1 if ic == "aic" else 2] for r in self.fitted.values()]
+        return min(values, default=np.inf)
+
+    def wanted(self, cand, ic, margin):
+        parents = list(_parents(cand))
+        if not parents:
+            return True  # no ARMA terms: always fitted
+        best = self.best_ic(ic)
+        col = 1 if ic == "aic" else 2
+        return any(self.fitted[p][col] <= best + margin for p in parents if p in self.fitted)
+
+
+@traced("fit")
+def search_orders(y, ic="aic", max_p=2, max_q=2, max_d=1, d=None, seasonal=False,
+                  seasonal_d=0, period=SEASONAL_PERIOD, margin=PRUNE_MARGIN,
+                  budget=None, jobs=None):
+    """
+    Order search for each row of `y` (levels, n_series x n_months).
+
+    Returns a DataFrame with one row per fitted candidate: SERIES, order,
+    seasonal_order, drift, STATUS, aic, bic (in the units of the
+    d-differenced series) and the candidate's rank within its series;
+    converged fits rank first.
+    """
+    y = np.atleast_2d(np.asarray(y, dtype=np.float64))
+    deadline = None if budget is None else time.perf_counter() + budget
+
+    searches = [_SeriesSearch(row, choose_d(row, max_d) if d is None else d, seasonal_d, period)
+                for row in y]
+    grids = {s.d: candidates(s.d, max_p, max_q, seasonal) for s in searches}
+    n_levels = max(len(g) for g in grids.values())
+
+    out_of_time = False
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker) as pool:
+        for level in range(n_levels):
+            if out_of_time:
+                break
+            futures = {}
+            for i, s in enumerate(searches):
+                grid = grids[s.d]
+                if level >= len(grid):
+                    continue
+                for cand in grid[level]:
+                    if s.wanted(cand, ic, margin):
+                        futures[pool.submit(fit_candidate, s.z, cand, period)] = (i, cand)
+            pending = set(futures)
+            while pending:
+                timeout = None
+                # The level-0 baselines always finish, so no series is left without a fit.
+                if deadline is not None and not out_of_time and level > 0:
+                    timeout = max(deadline - time.perf_counter(), 0)
+                done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    i, cand = futures[fut]
+                    searches[i].fitted[cand] = fut.result()
+                if not done:
+                    # Out of time: drop candidates that have not started and
+                    # let the running ones finish.
+                    out_of_time = True
+                    pending = {f for f in pending if not f.cancel()}
+
+    records = []
+    for i, s in enumerate(searches):
+        # AIC/BIC of the rescaled series, mapped back to the units of the
+        # differenced series (the same shift for every candidate of a series).
+        shift = 2 * len(s.z) * np.log(s.scale)
+        for (p, q, P, Q, drift), (status, aic, bic, params) in s.fitted.items():
+            records.append({
+                "SERIES": i,
+                "order": (p, s.d, q),
+                "seasonal_order": (P, s.seasonal_d, Q, period) if P or Q or s.seasonal_d else (0, 0, 0, 0),
+                "drift": drift,
+                "STATUS": status,
+                "aic": aic + shift,
+                "bic": bic + shift,
+                "n_params": len(params),
+            })
+    # Converged fits rank ahead of any that did not converge or failed.
+    table = pd.DataFrame.from_records(records)
+    table = table.assign(_bad=table["STATUS"] != "ok").sort_values(["SERIES", "_bad", ic])
+    table["rank"] = table.groupby("SERIES").cumcount() + 1
+    return table.drop(columns="_bad").reset_index(drop=True)
+
+
+def best_orders(table):
+    """
+    The top-ranked candidate of each series.
+    """
+    return table[table["rank"] == 1].reset_index(drop=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--series", choices=["national", "all"], default="national",
+                        help="national monthly ITEMS, or every region x drug series of ITEMS and COST")
+    parser.add_argument("--ic", choices=["aic", "bic"], default="aic")
+    parser.add_argument("--max-p", type=int, default=2)
+    parser.add_argument("--max-q", type=int, default=2)
+    parser.add_argument("--max-d", type=int, default=1)
+    parser.add_argument("--d", type=int, default=None, help="fix d instead of choosing it by KPSS")
+    parser.add_argument("--seasonal", action="store_true", help="also try seasonal AR/MA terms (period 12)")
+    parser.add_argument("--seasonal-diff", type=int, default=0)
+    parser.add_argument("--prune-margin", type=float, default=PRUNE_MARGIN)
+    parser.add_argument("--budget", type=float, default=None, help="time budget in seconds")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count())
+    parser.add_argument("--limit", type=int, help="only search the first N series")
+    parser.add_argument("--out", default=None, help="write every fitted candidate to this CSV")
+    args = parser.parse_args()
+
+    from cube import load_cube
+    cube = load_cube()
+    if args.series == "national":
+        y = cube.monthly_totals(["ITEMS"])["ITEMS"].to_numpy(dtype=np.float64)[None, :]
+        index = pd.DataFrame({"MEASURE": ["ITEMS"], "REGION_NAME": ["ALL"], "BNF_CHEMICAL_SUBSTANCE": ["ALL"]})
+    else:
+        from batch_forecast import MIN_OBSERVATIONS, build_series
+        y, index = build_series(cube)
+        keep = np.count_nonzero(y, axis=1) >= MIN_OBSERVATIONS
+        y, index = y[keep], index[keep].reset_index(drop=True)
+    if args.limit:
+        y, index = y[:args.limit], index.iloc[:args.limit]
+
+    start = time.perf_counter()
+    table = search_orders(y, ic=args.ic, max_p=args.max_p, max_q=args.max_q, max_d=args.max_d,
+                          d=args.d, seasonal=args.seasonal, seasonal_d=args.seasonal_diff,
+                          margin=args.prune_margin, budget=args.budget, jobs=args.jobs)
+    elapsed = time.perf_counter() - start
+    table = index.join(table.set_index("SERIES"), how="right").reset_index(drop=True)
+    if args.out:
+        table.to_csv(args.out, index=False)
+
+    n_grid = sum(len(level) for level in candidates(1, args.max_p, args.max_q, args.seasonal))
+    best = best_orders(table)
+    print(f"Searched {len(y)} series in {elapsed:.1f}s: fitted {len(table)} candidates "
+          f"(full grid {n_grid} per series)")
+    if len(best) <= 20:
+        print(best.to_string(index=False))
+    else:
+        counts = best.groupby(["order", "seasonal_order", "drift"]).size().sort_values(ascending=False)
+        print(f"Best {args.ic.upper()} orders:")
+        print(counts.head(15).to_string())
+
+
+if __name__ == "__main__":
+    main()
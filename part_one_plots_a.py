@@ -1,16 +1,16 @@
 #!/usr/bin/env python3
-import pandas as pd
 import matplotlib.pyplot as plt
 
-def main():
-    # Read your CSV
-    df = pd.read_csv('BSA_ODP_PCA_REGIONAL_DRUG_SUMMARY.csv')
-
-    # Calculate Annual Items
-    annual_items = df.groupby('YEAR', as_index=False)['ITEMS'].sum()
+from query import totals_cube
+from instrument import traced
 
-    # Calculate Annual Cost
-    annual_cost = df.groupby('YEAR', as_index=False)['COST'].sum()
+@traced("render")
+def plot_annual_items_cost(annual, path='annual_items_cost_subplots.png'):
+    """
+    Side-by-side bar charts of annual ITEMS and COST; saves to `path`.
+    """
+    annual_items = annual[['YEAR', 'ITEMS']]
+    annual_cost = annual[['YEAR', 'COST']]
 
     # Create a single figure with 2 subplots side by side
     fig, axes = plt.subplots(1, 2, figsize=(8, 4))
@@ -29,9 +29,20 @@ def main():
     axes[1].set_ylabel('Total Cost (£)')
     axes[1].grid(axis='y', linestyle='--', alpha=0.7)
 
-    plt.tight_layout()
+    fig.tight_layout()
+    fig.savefig(path)
+    return fig
+
+
+def main():
+    # Load the regional totals (the summary file when it reconciles)
+    cube = totals_cube()
+
+    # Calculate Annual Items and Cost
+    annual = cube.annual_totals()
+
     # Save to file, then show
-    plt.savefig('annual_items_cost_subplots.png')
+    plot_annual_items_cost(annual)
     plt.show()
 
 
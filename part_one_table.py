@@ -3,10 +3,15 @@ import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 
-def plot_colored_table(df, cmap, value_fmt, title):
+from query import totals_cube
+from instrument import traced
+
+@traced("render")
+def plot_colored_table(df, cmap, value_fmt, title, path=None):
     """
     Creates a heatmap-like plot for a pivoted DataFrame, with numeric labels.
-    Automatically saves the figure to a PDF using the plot title as the filename.
+    Automatically saves the figure to a PDF using the plot title as the filename
+    (or to `path` if given) and returns the figure.
     """
     fig, ax = plt.subplots(figsize=(12, 4))
     
@@ -42,46 +47,53 @@ def plot_colored_table(df, cmap, value_fmt, title):
     plt.tight_layout()
     
     # Save to PDF (use the title to form the filename)
-    pdf_filename = f"{title.replace(' ', '_')}.pdf"
-    plt.savefig(pdf_filename)
-    
-    # Display the plot
-    plt.show()
+    pdf_filename = path or f"{title.replace(' ', '_')}.pdf"
+    fig.savefig(pdf_filename)
+    return fig
 
 
-def display_colored_tables_as_plots(df):
+def display_colored_tables_as_plots(cube):
     """
     Creates pivot tables for ITEMS and COST, then plots each one as 
     a heatmap-like figure with color coding and numeric labels. 
     Saves each plot as a PDF, too.
     """
-    # 1) Create pivot tables
-    annual_items_region = df.groupby(['YEAR','REGION_NAME'], as_index=False)['ITEMS'].sum()
-    items_pivot = annual_items_region.pivot(index='YEAR', columns='REGION_NAME', values='ITEMS')
-    
-    annual_cost_region = df.groupby(['YEAR','REGION_NAME'], as_index=False)['COST'].sum()
-    cost_pivot = annual_cost_region.pivot(index='YEAR', columns='REGION_NAME', values='COST')
+    # 1) Create pivot tables (YEAR x REGION_NAME sums over the cube)
+    items_pivot = cube.annual_by_region('ITEMS')
+    cost_pivot = cube.annual_by_region('COST')
+
+    # 2) Plot the ITEMS pivot, then display it
+    plot_items_table(items_pivot)
+    plt.show()
+
+    # 3) Plot the COST pivot, then display it
+    plot_cost_table(cost_pivot)
+    plt.show()
 
-    # 2) Plot the ITEMS pivot
-    plot_colored_table(
+
+def plot_items_table(items_pivot, path=None):
+    return plot_colored_table(
         df=items_pivot,
         cmap='Blues',
         value_fmt='{:,.0f}',  # integer w/ commas
-        title="Annual Antidepressant Items per Region"
+        title="Annual Antidepressant Items per Region",
+        path=path
     )
 
-    # 3) Plot the COST pivot
-    plot_colored_table(
+
+def plot_cost_table(cost_pivot, path=None):
+    return plot_colored_table(
         df=cost_pivot,
         cmap='Oranges',
         value_fmt='{:,.2f}',  # two decimal places
-        title="Annual Antidepressant Cost per Region"
+        title="Annual Antidepressant Cost per Region",
+        path=path
     )
 
 
 def main():
-    df = pd.read_csv('BSA_ODP_PCA_REGIONAL_DRUG_SUMMARY.csv')
-    display_colored_tables_as_plots(df)
+    cube = totals_cube()
+    display_colored_tables_as_plots(cube)
 
 if __name__ == "__main__":
     main()
@@ -1,21 +1,22 @@
 #!/usr/bin/env python3
-import pandas as pd
 import matplotlib.pyplot as plt
 
-def main():
-    # 1) Read CSV
-    df = pd.read_csv('BSA_ODP_PCA_REGIONAL_DRUG_SUMMARY.csv')
-    
-    # 2) Monthly National Totals
-    # Group data by YEAR_MONTH to get total items & cost across all regions/drugs
-    monthly_totals = df.groupby('YEAR_MONTH', as_index=False)[['ITEMS','COST']].sum()
-    monthly_totals = monthly_totals.sort_values('YEAR_MONTH')  # ensure chronological order
+from query import totals_cube
+from instrument import traced
+
+def monthly_national_totals(cube):
+    # Sum over regions/drugs to get total items & cost per YEAR_MONTH (already chronological)
+    monthly_totals = cube.monthly_totals()
     
     # Convert YEAR_MONTH to string for x-axis labeling
     monthly_totals['YEAR_MONTH_STR'] = monthly_totals['YEAR_MONTH'].astype(str)
-    
+    return monthly_totals
+
+
+@traced("render")
+def plot_monthly_items(monthly_totals, path='part_two_monthly_items.png'):
     # (A) Line Chart for Monthly Items
-    plt.figure(figsize=(8,5))
+    fig = plt.figure(figsize=(8,5))
     plt.plot(monthly_totals['YEAR_MONTH_STR'], monthly_totals['ITEMS'], marker='o', color='blue')
     plt.title('Monthly Total Antidepressant Items (National)', fontsize=14)
     plt.xlabel('YEAR_MONTH (YYYYMM)')
@@ -23,11 +24,14 @@ def main():
     plt.xticks(rotation=70)
     plt.grid(True, linestyle='--', alpha=0.7)
     plt.tight_layout()
-    plt.savefig('part_two_monthly_items.png')
-    plt.show()
-    
+    fig.savefig(path)
+    return fig
+
+
+@traced("render")
+def plot_monthly_cost(monthly_totals, path='part_two_monthly_cost.png'):
     # (B) Line Chart for Monthly Cost
-    plt.figure(figsize=(8,5))
+    fig = plt.figure(figsize=(8,5))
     plt.plot(monthly_totals['YEAR_MONTH_STR'], monthly_totals['COST'], marker='o', color='red')
     plt.title('Monthly Total Antidepressant Cost (National)', fontsize=14)
     plt.xlabel('YEAR_MONTH (YYYYMM)')
@@ -35,7 +39,21 @@ def main():
     plt.xticks(rotation=70)
     plt.grid(True, linestyle='--', alpha=0.7)
     plt.tight_layout()
-    plt.savefig('part_two_monthly_cost.png')
+    fig.savefig(path)
+    return fig
+
+
+def main():
+    # 1) Load the regional totals (the summary file when it reconciles)
+    cube = totals_cube()
+    
+    # 2) Monthly National Totals
+    monthly_totals = monthly_national_totals(cube)
+    
+    plot_monthly_items(monthly_totals)
+    plt.show()
+    
+    plot_monthly_cost(monthly_totals)
     plt.show()
 
 if __name__ == "__main__":
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""
+YEAR=/REGION_NAME= partitioned Parquet dataset with partition pruning.
+
+write_partitioned() exports the drug summary, a chunk at a time, as a Hive
+layout under the cache directory:
+
+    .cache/partitioned/<stem>/YEAR=2022/REGION_NAME=LONDON/part-0-0.parquet
+
+Each file holds YEAR_MONTH, BNF_CHEMICAL_SUBSTANCE, ITEMS and COST_PENCE
+for one year and region; YEAR and REGION_NAME live in the directory names.
+The export is redone only when the source's dataset version changes.
+
+read_slice() turns year/region filters into partition pruning (only the
+matching directories are opened), applies month/drug filters inside the
+files, and reads only the requested columns, so a one-region ITEMS series
+or a one-year pivot costs in proportion to the slice, not the history.
+aggregate() sums such a slice by any of the key columns.
+
+    python partitioned.py [--rebuild]     # export if stale, then slice timings
+"""
+import argparse
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+from cube import to_units
+from instrument import traced
+from loader import (CACHE_DIR, DRUG_SUMMARY_CSV, DRUG_SUMMARY_DTYPES, _atomic_write_text,
+                    dataset_version, encode_categoricals, with_pence)
+
+PARTITION_DIR = os.path.join(CACHE_DIR, "partitioned")
+PARTITIONING = ds.partitioning(pa.schema([("YEAR", pa.int16()), ("REGION_NAME", pa.string())]),
+                               flavor="hive")
+# Bump when the file layout changes so old exports are rewritten.
+PARTITION_FORMAT = 1
+CHUNKSIZE = 1_000_000
+MARKER = "_dataset.json"  # leading "_": skipped by dataset discovery
+
+MEASURE_COLUMNS = {"ITEMS": "ITEMS", "COST": "COST_PENCE"}
+
+
+def dataset_dir(path=DRUG_SUMMARY_CSV, root=PARTITION_DIR):
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(root, stem)
+
+
+@traced("load")
+def write_partitioned(path=DRUG_SUMMARY_CSV, target=None, cache_dir=CACHE_DIR, chunksize=CHUNKSIZE):
+    """
+    Writes `path` as a YEAR/REGION_NAME-partitioned Parquet dataset at
+    `target`, replacing any previous export. Returns `target`.
+    """
+    target = target or dataset_dir(path)
+    version = dataset_version(path, cache_dir)
+    tmp = f"{target}.tmp{os.getpid()}"
+    shutil.rmtree(tmp, ignore_errors=True)
+
+    rows = 0
+    with pd.read_csv(path, dtype=DRUG_SUMMARY_DTYPES, chunksize=chunksize) as reader:
+        for i, chunk in enumerate(reader):
+            chunk = with_pence(chunk)
+            chunk["REGION_NAME"] = chunk["REGION_NAME"].astype(str)
+            chunk["BNF_CHEMICAL_SUBSTANCE"] = chunk["BNF_CHEMICAL_SUBSTANCE"].astype(str)
+            ds.write_dataset(pa.Table.from_pandas(chunk, preserve_index=False), tmp,
+                             format="parquet", partitioning=PARTITIONING,
+                             basename_template=f"part-{i}-{{i}}.parquet",
+                             existing_data_behavior="overwrite_or_ignore")
+            rows += len(chunk)
+
+    _atomic_write_text(os.path.join(tmp, MARKER), json.dumps({
+        "source": os.path.abspath(path), "version": version, "rows": rows,
+        "format": PARTITION_FORMAT}, indent=2))
+    shutil.rmtree(target, ignore_errors=True)
+    os.replace(tmp, target)
+    return target
+
+
+def _marker(target):
+    try:
+        with open(os.path.join(target, MARKER)) as fh:
+            return json.load(fh)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def open_dataset(path=DRUG_SUMMARY_CSV, target=None, cache_dir=CACHE_DIR, rebuild=False):
+    """
+    The pyarrow dataset for the current version of `path`, exporting it
+    first if the export is missing or stale.
+    """
+    target = target or dataset_dir(path)
+    marker = _marker(target)
+    if (rebuild or marker.get("version") != dataset_version(path, cache_dir)
+            or marker.get("format") != PARTITION_FORMAT):
+        write_partitioned(path, target, cache_dir)
+    return ds.dataset(target, format="parquet", partitioning=PARTITIONING)
+
+
+def _filter(years=None, regions=None, months=None, drugs=None):
+    expr = None
+    for col, values in (("YEAR", years), ("REGION_NAME", regions),
+                        ("YEAR_MONTH", months), ("BNF_CHEMICAL_SUBSTANCE", drugs)):
+        if values is None:
+            continue
+        term = ds.field(col).isin(list(values))
+        expr = term if expr is None else expr & term
+    return expr
+
+
+@traced("load")
+def read_slice(columns=None, years=None, regions=None, months=None, drugs=None,
+               path=DRUG_SUMMARY_CSV, cache_dir=CACHE_DIR, stats=None):
+    """
+    Rows matching the filters, with only `columns` (default: all) read.
+
+    YEAR and REGION_NAME filters prune whole partitions; YEAR_MONTH and
+    BNF_CHEMICAL_SUBSTANCE filters are applied within the files. Label
+    columns come back as categoricals with the loader's stable codes. If
+    `stats` is a dict it is filled with files, files_total, rows and bytes.
+    """
+    dataset = open_dataset(path, cache_dir=cache_dir)
+    expr = _filter(years, regions, months, drugs)
+    table = dataset.to_table(columns=columns, filter=expr)
+    if stats is not None:
+        stats.update(files=sum(1 for _ in dataset.get_fragments(filter=expr)),
+                     files_total=len(dataset.files), rows=table.num_rows, bytes=table.nbytes)
+    return encode_categoricals(table.to_pandas(), cache_dir)
+
+
+@traced("aggregate")
+def aggregate(by=("YEAR_MONTH",), measures=("ITEMS", "COST"), years=None, regions=None,
+              months=None, drugs=None, path=DRUG_SUMMARY_CSV, cache_dir=CACHE_DIR, stats=None):
+    """
+    `measures` summed by the `by` columns over the filtered slice, reading
+    only those columns (COST in pounds). Groups with no rows are left out.
+    """
+    by = list(by)
+    cols = by + [MEASURE_COLUMNS[m] for m in measures]
+    df = read_slice(cols, years, regions, months, drugs, path, cache_dir, stats)
+    if by:
+        out = df.groupby(by, observed=True, sort=True)[cols[len(by):]].sum().reset_index()
+    else:
+        out = df[cols].sum().to_frame().T
+    for m in measures:
+        out[m] = to_units(m, out.pop(MEASURE_COLUMNS[m]).to_numpy())
+    for col in ("REGION_NAME", "BNF_CHEMICAL_SUBSTANCE"):
+        if col in out.columns:
+            out[col] = out[col].astype(object)
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--path", default=DRUG_SUMMARY_CSV)
+    parser.add_argument("--rebuild", action="store_true")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    dataset = open_dataset(args.path, rebuild=args.rebuild)
+    print(f"Partitioned dataset {dataset_dir(args.path)}: {len(dataset.files)} files "
+          f"(ready in {(time.perf_counter() - start)*1e3:.1f} ms)")
+
+    from cube import load_cube
+    cube = load_cube(args.path)
+    year, region = int(cube.years[-1]), str(cube.regions[0])
+    r = cube.region_code(region)
+    seen = cube.observed[:, r].any(axis=1)
+    region_ref = pd.DataFrame({"YEAR_MONTH": cube.months[seen],
+                               "ITEMS": cube.items[:, r].sum(axis=1)[seen]})
+    cases = [
+        ("full scan, all columns", lambda s: read_slice(path=args.path, stats=s), None),
+        ("monthly ITEMS (delta_Y.py)", lambda s: aggregate(["YEAR_MONTH"], ["ITEMS"], path=args.path, stats=s),
+         cube.monthly_totals(["ITEMS"])),
+        (f"YEAR={year} pivot (part_one_table.py)",
+         lambda s: aggregate(["YEAR", "REGION_NAME"], ["ITEMS", "COST"], years=[year], path=args.path, stats=s),
+         cube.annual_by_region("ITEMS").loc[[year]]),
+        (f"REGION_NAME={region} ITEMS series",
+         lambda s: aggregate(["YEAR_MONTH"], ["ITEMS"], regions=[region], path=args.path, stats=s),
+         region_ref),
+    ]
+    rows = []
+    for name, fn, ref in cases:
+        stats = {}
+        start = time.perf_counter()
+        out = fn(stats)
+        elapsed = time.perf_counter() - start
+        if isinstance(ref, pd.DataFrame) and "YEAR_MONTH" in ref:
+            ok = np.array_equal(out[["YEAR_MONTH", "ITEMS"]].to_numpy(), ref[["YEAR_MONTH", "ITEMS"]].to_numpy())
+        elif isinstance(ref, pd.DataFrame):
+            got = out.pivot(index="YEAR", columns="REGION_NAME", values="ITEMS")[ref.columns]
+            ok = np.array_equal(got.to_numpy(), ref.to_numpy())
+        else:
+            ok = None
+        rows.append({"query": name, "files": f"{stats['files']}/{stats['files_total']}",
+                     "rows": stats["rows"], "kB read": stats["bytes"] / 1024,
+                     "ms": elapsed * 1e3, "matches cube": ok})
+    with pd.option_context("display.float_format", "{:,.1f}".format):
+        print(pd.DataFrame(rows).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""
+Pipeline driver: named stages with declared inputs and cached artifacts.
+
+monthly_totals, Y = log(ITEMS), dY = Y.diff() and the ARIMA(1,1,0) fits used
+by delta_Y.py, check_normal.py, residual_diagnostics.py and prediction.py are
+registered here as stages, along with dY_matrix, the ΔY of every region x
+drug series (see transforms.py). Each stage's output is pickled under
+.cache/pipeline/ and indexed by a key built from the stage name, its version
+and the content hashes of its inputs, so a stage only runs when something it
+depends on has actually changed.
+
+    python pipeline.py [STAGE ...] [--force] [--list]
+"""
+import hashlib
+import json
+import os
+import pickle
+import sys
+import time
+
+import numpy as np
+
+from instrument import span
+from loader import CACHE_DIR, DRUG_SUMMARY_CSV, _atomic_write_text, dataset_version
+
+PIPELINE_DIR = os.path.join(CACHE_DIR, "pipeline")
+
+# Months held out of the training fit in prediction.py.
+TEST_SIZE = 5
+
+STAGES = {}
+
+
+class Stage:
+    def __init__(self, name, inputs, fn, version, kind):
+        self.name = name
+        self.inputs = tuple(inputs)
+        self.fn = fn
+        self.version = version
+        self.kind = kind
+
+
+def stage(name, inputs=(), version=1, kind="stage"):
+    """
+    Registers the decorated function as stage `name`.
+
+    The function receives the outputs of `inputs` as positional arguments.
+    Bump `version` when the function's logic changes to invalidate old
+    artifacts. `kind` (aggregate, transform, fit, ...) is the span category
+    used when tracing is on (see instrument.py).
+    """
+    def register(fn):
+        STAGES[name] = Stage(name, inputs, fn, version, kind)
+        return fn
+    return register
+
+
+# ---- stages ----------------------------------------------------------------
+
+@stage("monthly_totals", inputs=["source"], version=2, kind="aggregate")
+def _monthly_totals(path):
+    from cube import load_cube
+    return load_cube(path).monthly_totals()
+
+
+@stage("Y", inputs=["monthly_totals"], kind="transform")
+def _log_items(monthly_totals):
+    return np.log(monthly_totals["ITEMS"]).rename("Y")
+
+
+@stage("dY", inputs=["Y"], kind="transform")
+def _log_diff(Y):
+    return Y.diff().rename("dY")
+
+
+@stage("dY_matrix", inputs=["source"], version=2, kind="transform")
+def _dY_matrix(path):
+    from cube import load_cube
+    from transforms import dY_matrix
+    return dY_matrix(load_cube(path))
+
+
+def _fit_arima110(y):
+    from statsmodels.tsa.arima.model import ARIMA
+    return ARIMA(y, order=(1,1,0), trend="t").fit()
+
+
+@stage("arima_full", inputs=["monthly_totals"], kind="fit")
+def _arima_full(monthly_totals):
+    return _fit_arima110(monthly_totals["ITEMS"].astype(float))
+
+
+@stage("arima_train", inputs=["monthly_totals"], kind="fit")
+def _arima_train(monthly_totals):
+    y = monthly_totals["ITEMS"].astype(float)
+    return _fit_arima110(y.iloc[:len(y) - TEST_SIZE])
+
+
+# ---- runner ----------------------------------------------------------------
+
+class Pipeline:
+    """
+    Resolves stages against the on-disk artifact cache.
+
+    `log` collects (stage, status, seconds) for every stage touched, where
+    status is "ran" or "cached".
+    """
+
+    def __init__(self, source=DRUG_SUMMARY_CSV, root=PIPELINE_DIR, force=()):
+        self.source = source
+        self.root = root
+        self.force = set(force)
+        self.log = []
+        self._digests = {}
+        self._values = {}
+        self._index_path = os.path.join(root, "index.json")
+        self._index = {}
+        if os.path.exists(self._index_path):
+            with open(self._index_path) as fh:
+                self._index = json.load(fh)
+
+    def _artifact(self, digest):
+        return os.path.join(self.root, f"{digest}.pkl")
+
+    def digest(self, name):
+        """
+        Brings stage `name` up to date and returns its output's content hash.
+        """
+        if name in self._digests:
+            return self._digests[name]
+        if name == "source":
+            digest = dataset_version(self.source)
+            self._values[name] = self.source
+            self._digests[name] = digest
+            return digest
+
+        st = STAGES[name]
+        input_digests = [self.digest(i) for i in st.inputs]
+        key = hashlib.sha256(json.dumps([name, st.version, input_digests]).encode()).hexdigest()
+        digest = self._index.get(key)
+
+        if digest and name not in self.force and os.path.exists(self._artifact(digest)):
+            self.log.append((name, "cached", 0.0))
+        else:
+            start = time.perf_counter()
+            inputs = [self.get(i) for i in st.inputs]
+            with span(f"stage:{name}", st.kind) as sp:
+                value = st.fn(*inputs)
+                if sp is not None:
+                    sp.frame(value)
+            blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+            digest = hashlib.sha256(blob).hexdigest()
+            os.makedirs(self.root, exist_ok=True)
+            tmp = f"{self._artifact(digest)}.tmp{os.getpid()}"
+            with open(tmp, "wb") as fh:
+                fh.write(blob)
+            os.replace(tmp, self._artifact(digest))
+            self._index[key] = digest
+            _atomic_write_text(self._index_path, json.dumps(self._index, indent=2))
+            self._values[name] = value
+            self.log.append((name, "ran", time.perf_counter() - start))
+
+        self._digests[name] = digest
+        return digest
+
+    def get(self, name):
+        """
+        Returns the output of stage `name`, running it (and any stale inputs)
+        only if its cached artifact is out of date.
+        """
+        digest = self.digest(name)
+        if name not in self._values:
+            with span(f"cached:{name}", "load"), open(self._artifact(digest), "rb") as fh:
+                self._values[name] = pickle.load(fh)
+        return self._values[name]
+
+
+def run(name, source=DRUG_SUMMARY_CSV):
+    """
+    Convenience wrapper: the up-to-date output of one stage.
+    """
+    return Pipeline(source).get(name)
+
+
+def main():
+    args = sys.argv[1:]
+    if "--list" in args:
+        for st in STAGES.values():
+            print(f"{st.name:16s} <- {', '.join(st.inputs)}")
+        return
+    force = "--force" in args
+    targets = [a for a in args if not a.startswith("--")] or list(STAGES)
+
+    pipe = Pipeline(force=STAGES if force else ())
+    start = time.perf_counter()
+    for name in targets:
+        pipe.digest(name)
+    for name, status, seconds in pipe.log:
+        print(f"  {name:16s} {status:6s} {seconds:7.3f}s")
+    print(f"Pipeline finished in {time.perf_counter() - start:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,21 @@
 #!/usr/bin/env python3
-import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
-from statsmodels.tsa.arima.model import ARIMA
+
+from fanchart import intervals, moments_from_results
+from pipeline import TEST_SIZE, Pipeline
 
 def main():
-    # 1) Read CSV
-    df = pd.read_csv("BSA_ODP_PCA_REGIONAL_DRUG_SUMMARY.csv")
-
-    # 2) Aggregate monthly totals and sort
-    monthly_df = (
-        df.groupby("YEAR_MONTH", as_index=False)["ITEMS"]
-          .sum()
-          .sort_values("YEAR_MONTH")
-    )
+    # 1) Resolve the cached pipeline stages (only stale ones are recomputed)
+    pipe = Pipeline()
+
+    # 2) Monthly totals (already in chronological order)
+    monthly_df = pipe.get("monthly_totals")
     y = monthly_df["ITEMS"].astype(float)
 
 
     # forecast 5 points into the future.
-    test_size = 5
+    test_size = TEST_SIZE
     N_future = 5
     train_size = len(y) - test_size
 
@@ -26,9 +23,8 @@ def main():
     y_train = y.iloc[:train_size]
     y_test = y.iloc[train_size:]
 
-    # 4) Fit ARIMA(1,1,0) with a linear trend ('t')
-    model = ARIMA(y_train, order=(1,1,0), trend="t")
-    results = model.fit()
+    # 4) ARIMA(1,1,0) with a linear trend ('t'), fitted on y_train
+    results = pipe.get("arima_train")
 
     params = results.params
     conf_int_90 = results.conf_int(alpha=0.10)  # 90% CI for parameters
@@ -60,10 +56,10 @@ def main():
         print(f"  sigma    = {sigma_val:.4f} "
               f"(90% CI: {sigma_ci_lower:.4f}, {sigma_ci_upper:.4f})")
 
-    # 5) Create forecasts
+    # 5) Create forecasts: predictive mean and variance once for the whole
+    #    horizon (test + future); the test forecasts are its first steps
     steps_ahead_test = len(y_test)
-    forecast_test_obj = results.get_forecast(steps=steps_ahead_test)
-    forecast_full_obj = results.get_forecast(steps=steps_ahead_test + N_future)
+    mean, var = moments_from_results(results, steps_ahead_test + N_future)
 
     # 6) Indices for plotting
     x_index      = np.arange(len(y))        
@@ -79,6 +75,9 @@ def main():
     # Corresponding alpha for the fill regions (increasingly darker).
     fill_alphas = [0.2, 0.4, 0.6]
 
+    # Every band from the one set of moments
+    lower, upper = intervals(mean, var, conf_levels)
+
     plt.figure(figsize=(10,5))
 
     # (a) Training + Test data
@@ -87,10 +86,8 @@ def main():
 
     # Plot layered CIs for TEST portion
     for i, conf in enumerate(conf_levels):
-        alpha_ = 1.0 - conf
-        ci_test = forecast_test_obj.conf_int(alpha=alpha_)
-        lower_test = ci_test.iloc[:,0]
-        upper_test = ci_test.iloc[:,1]
+        lower_test = lower[i, :steps_ahead_test]
+        upper_test = upper[i, :steps_ahead_test]
         plt.fill_between(
             test_index,
             lower_test,
@@ -101,15 +98,9 @@ def main():
         )
 
     # Plot layered CIs for FUTURE portion
-    forecast_full_ci = {}
-    for conf in conf_levels:
-        alpha_ = 1.0 - conf
-        forecast_full_ci[conf] = forecast_full_obj.conf_int(alpha=alpha_)
-
     for i, conf in enumerate(conf_levels):
-        ci_future_part = forecast_full_ci[conf].iloc[test_size:]
-        lower_future = ci_future_part.iloc[:,0]
-        upper_future = ci_future_part.iloc[:,1]
+        lower_future = lower[i, test_size:]
+        upper_future = upper[i, test_size:]
         plt.fill_between(
             future_index,
             lower_future,
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+"""
+Total-level queries answered from the regional summary when it agrees.
+
+BSA_ODP_PCA_REGIONAL_SUMMARY.csv holds ITEMS and COST per YEAR_MONTH and
+REGION_NAME already summed over drugs, in about 300 rows instead of the
+drug file's ~10,000. Any query that does not break totals down by drug
+(national monthly totals, annual totals, the YEAR x REGION_NAME pivots of
+part_one_table.py) can be read from it instead of the drug-level cube.
+
+The summary is only used once it has been reconciled with the drug file:
+both are turned into cubes and every month x region cell must be present
+in both with exactly the same ITEMS and COST (pence). The verdict is
+cached in the loader's cache directory, keyed by both dataset versions, so
+it is recomputed only when either file changes. If they disagree, queries
+fall back to the drug-level cube.
+
+  summary_cube()   the summary as a Cube with a single "(all drugs)" drug
+  reconcile()      cell-by-cell comparison of the two cubes
+  totals_cube()    the summary cube if it reconciles, else the drug cube
+  totals()         long-format totals by any of YEAR, YEAR_MONTH,
+                   REGION_NAME, BNF_CHEMICAL_SUBSTANCE, routed to the
+                   cheapest source that can answer it
+
+    python query.py     # reconciliation report and timings
+"""
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from cube import MEASURES, Cube, cube_path, load_cube, to_units
+from instrument import traced
+from loader import (CACHE_DIR, DRUG_SUMMARY_CSV, REGIONAL_SUMMARY_CSV, _atomic_write_text,
+                    dataset_version, read_regional_summary_csv)
+
+ALL_DRUGS = "(all drugs)"
+KEYS = ("YEAR", "YEAR_MONTH", "REGION_NAME", "BNF_CHEMICAL_SUBSTANCE")
+
+
+@traced("load")
+def summary_cube(path=REGIONAL_SUMMARY_CSV, cache_dir=CACHE_DIR):
+    """
+    The regional summary as a Cube whose drug axis has one entry, ALL_DRUGS,
+    so every Cube aggregation that sums over drugs works unchanged. Cached
+    next to the drug cube, keyed by the summary's dataset version.
+    """
+    version = dataset_version(path, cache_dir)
+    target = cube_path(path, cache_dir, version)
+    if os.path.exists(target):
+        return Cube.load(target)
+
+    df = read_regional_summary_csv(path)
+    month_codes, months = pd.factorize(df["YEAR_MONTH"], sort=True)
+    region_codes, regions = pd.factorize(df["REGION_NAME"].astype(str), sort=True)
+    shape = (len(months), len(regions), 1)
+    flat = np.ravel_multi_index((month_codes, region_codes), shape[:2])
+    size = shape[0] * shape[1]
+
+    items = np.bincount(flat, weights=df["ITEMS"].to_numpy(), minlength=size)
+    cost = np.bincount(flat, weights=df["COST_PENCE"].to_numpy(), minlength=size)
+    observed = np.bincount(flat, minlength=size) > 0
+    cube = Cube(
+        months=np.asarray(months),
+        regions=np.asarray(regions, dtype=object),
+        drugs=np.array([ALL_DRUGS], dtype=object),
+        items=np.rint(items).astype(np.int64).reshape(shape),
+        cost=np.rint(cost).astype(np.int64).reshape(shape),
+        observed=observed.reshape(shape),
+        version=version,
+    )
+    os.makedirs(cache_dir, exist_ok=True)
+    cube.save(target)
+    return cube
+
+
+@traced("aggregate")
+def reconcile(cube, summary):
+    """
+    Compares the drug cube summed over drugs with the summary cube.
+
+    Returns (ok, mismatches): `mismatches` has one row per month x region
+    cell that is missing from either side or whose ITEMS or COST differ,
+    with both values and the differences (COST in pounds).
+    """
+    months = np.union1d(cube.months, summary.months)
+    regions = np.union1d(cube.regions.astype(str), summary.regions.astype(str))
+
+    def aligned(c, arr):
+        out = np.zeros((len(months), len(regions)), dtype=arr.dtype)
+        mi = np.searchsorted(months, c.months)
+        ri = np.searchsorted(regions, c.regions.astype(str))
+        out[np.ix_(mi, ri)] = arr
+        return out
+
+    seen_d = aligned(cube, cube.observed.any(axis=2))
+    seen_s = aligned(summary, summary.observed.any(axis=2))
+    diffs, bad = {}, seen_d != seen_s
+    for m in MEASURES:
+        d = aligned(cube, cube.values(m).sum(axis=2))
+        s = aligned(summary, summary.values(m).sum(axis=2))
+        diffs[m] = (d, s)
+        bad |= d != s
+
+    mi, ri = np.nonzero(bad)
+    mismatches = pd.DataFrame({
+        "YEAR_MONTH": months[mi],
+        "REGION_NAME": regions[ri],
+        "in_drug_file": seen_d[mi, ri],
+        "in_summary": seen_s[mi, ri],
+    })
+    for m, (d, s) in diffs.items():
+        mismatches[f"{m}_drug"] = to_units(m, d[mi, ri])
+        mismatches[f"{m}_summary"] = to_units(m, s[mi, ri])
+        mismatches[f"{m}_diff"] = to_units(m, d[mi, ri] - s[mi, ri])
+    return not len(mismatches), mismatches
+
+
+def _verdict_path(cache_dir):
+    return os.path.join(cache_dir, "reconcile.json")
+
+
+def reconciled(path=DRUG_SUMMARY_CSV, summary_path=REGIONAL_SUMMARY_CSV, cache_dir=CACHE_DIR,
+               summary=None):
+    """
+    Whether the summary agrees with the drug file, from the cached verdict
+    when both dataset versions are unchanged.
+    """
+    key = f"{dataset_version(path, cache_dir)}:{dataset_version(summary_path, cache_dir)}"
+    target = _verdict_path(cache_dir)
+    try:
+        with open(target) as fh:
+            cached = json.load(fh)
+        if cached.get("key") == key:
+            return cached["ok"]
+    except (FileNotFoundError, ValueError):
+        pass
+
+    ok, mismatches = reconcile(load_cube(path, cache_dir), summary or summary_cube(summary_path, cache_dir))
+    os.makedirs(cache_dir, exist_ok=True)
+    _atomic_write_text(target, json.dumps({"key": key, "ok": ok, "mismatches": len(mismatches)}))
+    return ok
+
+
+def totals_cube(path=DRUG_SUMMARY_CSV, summary_path=REGIONAL_SUMMARY_CSV, cache_dir=CACHE_DIR):
+    """
+    The cube to answer drug-free total queries from: the summary cube when
+    it reconciles with the drug file, otherwise the drug-level cube.
+    """
+    if os.path.exists(summary_path):
+        summary = summary_cube(summary_path, cache_dir)
+        if reconciled(path, summary_path, cache_dir, summary=summary):
+            return summary
+    return load_cube(path, cache_dir)
+
+
+@traced("aggregate")
+def totals(by=("YEAR_MONTH",), measures=MEASURES, regions=None, drugs=None,
+           path=DRUG_SUMMARY_CSV, summary_path=REGIONAL_SUMMARY_CSV, cache_dir=CACHE_DIR):
+    """
+    Long table of `measures` summed by the `by` columns (any of KEYS),
+    optionally restricted to some regions and/or drugs.
+
+    Queries that neither group nor filter by drug are answered from the
+    summary (see totals_cube()); the rest from the drug cube. Groups with no
+    source rows are left out, as in a groupby. The source used is recorded in
+    `df.attrs["source"]` ("summary" or "drug").
+    """
+    by = list(by)
+    unknown = set(by) - set(KEYS)
+    if unknown:
+        raise KeyError(f"Unknown grouping column(s) {sorted(unknown)}; expected some of {KEYS}")
+    if "YEAR" in by and "YEAR_MONTH" in by:
+        raise ValueError("group by YEAR or YEAR_MONTH, not both")
+
+    needs_drugs = "BNF_CHEMICAL_SUBSTANCE" in by or drugs is not None
+    cube = load_cube(path, cache_dir) if needs_drugs else totals_cube(path, summary_path, cache_dir)
+    source = "summary" if cube.drugs.tolist() == [ALL_DRUGS] else "drug"
+
+    r_idx = (np.arange(len(cube.regions)) if regions is None
+             else np.array([cube.region_code(r) for r in regions], dtype=np.int64))
+    d_idx = (np.arange(len(cube.drugs)) if drugs is None
+             else np.array([cube.drug_code(d) for d in drugs], dtype=np.int64))
+    select = lambda arr: arr[:, r_idx][:, :, d_idx]
+
+    by_time = "YEAR" in by or "YEAR_MONTH" in by
+    sum_axes = tuple(ax for ax, keep in ((0, by_time), (1, "REGION_NAME" in by),
+                                         (2, "BNF_CHEMICAL_SUBSTANCE" in by)) if not keep)
+    reduce = lambda arr: arr.sum(axis=sum_axes, keepdims=True)
+    arrays = {m: reduce(select(cube.values(m))) for m in measures}
+    seen = reduce(select(cube.observed).astype(np.int64))
+    times = cube.months
+    if "YEAR" in by:
+        arrays = {m: cube.year_sums(a) for m, a in arrays.items()}
+        seen = cube.year_sums(seen)
+        times = cube.years
+
+    labels = {0: times, 1: cube.regions[r_idx], 2: cube.drugs[d_idx]}
+    axis_of = {"YEAR": 0, "YEAR_MONTH": 0, "REGION_NAME": 1, "BNF_CHEMICAL_SUBSTANCE": 2}
+    mask = seen > 0
+    coords = np.nonzero(mask)
+    out = pd.DataFrame({col: labels[axis_of[col]][coords[axis_of[col]]] for col in by})
+    for m, arr in arrays.items():
+        out[m] = to_units(m, arr[mask])
+    out = out.sort_values(by, kind="stable", ignore_index=True) if by else out
+    out.attrs["source"] = source
+    return out
+
+
+def main():
+    start = time.perf_counter()
+    cube = load_cube()
+    t_cube = time.perf_counter() - start
+    start = time.perf_counter()
+    summary = summary_cube()
+    t_summary = time.perf_counter() - start
+
+    start = time.perf_counter()
+    ok, mismatches = reconcile(cube, summary)
+    t_reconcile = time.perf_counter() - start
+    m, r, _ = summary.shape
+    print(f"Regional summary {summary.version[:16]}: {m} months x {r} regions")
+    print(f"  reconciles with drug file: {ok} ({len(mismatches)} mismatched cells, "
+          f"checked in {t_reconcile*1e3:.2f} ms)")
+    if not ok:
+        print(mismatches.head(20).to_string(index=False))
+    print(f"  load: summary cube {t_summary*1e3:.1f} ms, drug cube {t_cube*1e3:.1f} ms")
+
+    # The same queries from both sources agree.
+    for name, fn in [("monthly_totals", lambda c: c.monthly_totals()),
+                     ("annual_totals", lambda c: c.annual_totals()),
+                     ("annual_by_region ITEMS", lambda c: c.annual_by_region("ITEMS")),
+                     ("annual_by_region COST", lambda c: c.annual_by_region("COST"))]:
+        a, b = fn(summary), fn(cube)
+        print(f"  {name}: max abs difference {np.nanmax(np.abs(a.to_numpy(float) - b.to_numpy(float))):.1e}")
+
+    df = totals(["YEAR", "REGION_NAME"])
+    print(f"\ntotals(by=YEAR, REGION_NAME) from the {df.attrs['source']} source:")
+    print(df.head(8).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
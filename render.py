@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+Headless batch rendering of every report figure in a process pool.
+
+Each figure is drawn by the per-figure function in its script, on the Agg
+backend, and plt.show() is never called. Shared inputs (the cube and the
+pipeline stages) are brought up to date once in the parent process, so the
+workers only read cached artifacts.
+
+    python render.py [--jobs N] [--outdir DIR] [FILENAME ...]
+"""
+import argparse
+import functools
+import importlib
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from instrument import traced
+
+# (output file, script module, figure function, input data key)
+FIGURES = [
+    ("annual_items_cost_subplots.png", "part_one_plots_a", "plot_annual_items_cost", "annual_totals"),
+    ("top_10_items_barh.png", "part_one_plots_b", "plot_top_10_items", "cube"),
+    ("top_10_cost_barh.png", "part_one_plots_b", "plot_top_10_cost", "cube"),
+    ("Annual_Antidepressant_Items_per_Region.pdf", "part_one_table", "plot_items_table", "items_pivot"),
+    ("Annual_Antidepressant_Cost_per_Region.pdf", "part_one_table", "plot_cost_table", "cost_pivot"),
+    ("part_two_monthly_items.png", "part_two_a", "plot_monthly_items", "monthly_national"),
+    ("part_two_monthly_cost.png", "part_two_a", "plot_monthly_cost", "monthly_national"),
+    ("part_two_top5_items_trend.png", "part_two_b", "plot_top5_items_trend", "cube"),
+    ("part_two_top5_cost_trend.png", "part_two_b", "plot_top5_cost_trend", "cube"),
+    ("plot_dY_over_time.png", "delta_Y", "plot_dY_over_time", "monthly_log_diff"),
+    ("dY_histogram.png", "check_normal", "plot_dY_histogram", "dY"),
+    ("dY_qqplot.png", "check_normal", "plot_dY_qqplot", "dY"),
+    ("dY_acf_pacf.png", "check_normal", "plot_dY_acf_pacf", "dY"),
+    ("resid_timeseries.png", "residual_diagnostics", "plot_resid_timeseries", "resid"),
+]
+
+
+@functools.lru_cache(maxsize=None)
+def _data(key):
+    """
+    Figure inputs, computed at most once per worker process.
+    """
+    from cube import load_cube
+    from pipeline import Pipeline
+    from query import totals_cube
+
+    if key == "cube":
+        return load_cube()
+    if key == "totals":
+        return totals_cube()
+    if key == "annual_totals":
+        return _data("totals").annual_totals()
+    if key == "items_pivot":
+        return _data("totals").annual_by_region("ITEMS")
+    if key == "cost_pivot":
+        return _data("totals").annual_by_region("COST")
+    if key == "monthly_national":
+        from part_two_a import monthly_national_totals
+        return monthly_national_totals(_data("totals"))
+    if key == "monthly_log_diff":
+        from delta_Y import monthly_log_diff
+        return monthly_log_diff(Pipeline())
+    if key == "dY":
+        from check_normal import load_dY
+        return load_dY(Pipeline())
+    if key == "resid":
+        return Pipeline().get("arima_full").resid
+    raise KeyError(key)
+
+
+def _init_worker():
+    import matplotlib
+    matplotlib.use("Agg", force=True)
+
+
+@traced("render")
+def render_figure(filename, module, function, data_key, outdir="."):
+    """
+    Draws and saves one figure; returns (filename, seconds).
+
+    The timing covers drawing and saving only; module imports and input
+    loading are shared by every figure a worker renders.
+    """
+    _init_worker()
+    import matplotlib.pyplot as plt
+
+    draw = getattr(importlib.import_module(module), function)
+    data = _data(data_key)
+    start = time.perf_counter()
+    fig = draw(data, path=os.path.join(outdir, filename))
+    plt.close(fig)
+    return filename, time.perf_counter() - start
+
+
+def prepare():
+    """
+    Brings the cubes, the summary reconciliation and every pipeline stage
+    up to date before fan-out.
+    """
+    from cube import load_cube
+    from pipeline import STAGES, Pipeline
+    from query import totals_cube
+
+    load_cube()
+    totals_cube()
+    pipe = Pipeline()
+    for name in STAGES:
+        pipe.digest(name)
+
+
+def render_all(figures=FIGURES, jobs=None, outdir="."):
+    """
+    Renders `figures` across `jobs` worker processes.
+
+    Returns ({filename: seconds}, wall_seconds).
+    """
+    os.makedirs(outdir, exist_ok=True)
+    start = time.perf_counter()
+    prepare()
+    timings = {}
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker) as pool:
+        futures = [pool.submit(render_figure, *fig, outdir=outdir) for fig in figures]
+        for fut in as_completed(futures):
+            filename, seconds = fut.result()
+            timings[filename] = seconds
+    return timings, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("figures", nargs="*", help="output filenames to render (default: all)")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count())
+    parser.add_argument("--outdir", default=".")
+    args = parser.parse_args()
+
+    figures = [f for f in FIGURES if not args.figures or f[0] in args.figures]
+    timings, wall = render_all(figures, jobs=args.jobs, outdir=args.outdir)
+    for filename, *_ in figures:
+        print(f"  {filename:45s} {timings[filename]:6.2f}s")
+    total = sum(timings.values())
+    print(f"Rendered {len(figures)} figures with {args.jobs} workers in {wall:.2f}s "
+          f"(sum of per-figure times {total:.2f}s)")
+
+
+if __name__ == "__main__":
+    main()
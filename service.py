@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+"""
+Read-only HTTP/JSON query service over the month x region x drug cube.
+
+The cube is loaded once at start-up and every query is answered from it:
+
+  /series?measure=ITEMS[&drug=D ...][&region=R ...]
+        monthly totals, national or for some drugs/regions (part_two_a.py,
+        part_two_b.py); months without rows are left out
+  /top?measure=COST[&n=5][&year=Y ...][&region=R ...]
+        the n drugs with the largest totals (part_one_plots_b.py, part_two_b.py)
+  /pivot?measure=ITEMS
+        YEAR x REGION_NAME totals, null where a region has no rows
+        (part_one_table.py)
+  /forecast?series=ITEMS/LONDON/Sertraline%20hydrochloride[&steps=5][&level=0.9 ...]
+        ARIMA(1,1,0)+drift forecast mean and intervals from the persisted
+        model store (modelstore.py); /forecast lists the series ids
+  /metrics   request counts, cache hits and p50/p99 latency per endpoint
+  /health    dataset version and cube shape
+
+Responses are kept in an LRU cache keyed by the normalised query, and carry
+an ETag built from the dataset version and the query, so clients can
+revalidate with If-None-Match and get 304 until the data changes.
+Connections are HTTP/1.1 keep-alive.
+
+    python service.py [--port 8766] [--cache-size 1024]
+    python service.py --bench [--requests 2000]     # latency check on a local instance
+"""
+import argparse
+import collections
+import functools
+import hashlib
+import http.client
+import http.server
+import json
+import threading
+import time
+import urllib.parse
+
+import numpy as np
+
+from batch_forecast import future_months
+from cube import MEASURES, load_cube, to_units
+
+CACHE_SIZE = 1024
+LATENCY_WINDOW = 10_000  # most recent requests per endpoint kept for percentiles
+ENDPOINTS = ("series", "top", "pivot", "forecast")
+MAX_STEPS = 60
+
+
+class QueryError(ValueError):
+    pass
+
+
+def _one(params, key, default=None):
+    values = params.get(key)
+    return values[-1] if values else default
+
+
+def _measure(params):
+    measure = _one(params, "measure", "ITEMS")
+    if measure not in MEASURES:
+        raise QueryError(f"measure must be one of {MEASURES}, got {measure!r}")
+    return measure
+
+
+def _codes(lookup, labels):
+    try:
+        # A repeated code would be counted twice in the sums.
+        return list(dict.fromkeys(lookup(label) for label in labels))
+    except KeyError as exc:
+        raise QueryError(exc.args[0]) from None
+
+
+class QueryService:
+    """
+    Answers the JSON queries from one Cube, with an LRU response cache and
+    latency metrics. Thread-safe; shared by all request handlers.
+    """
+
+    def __init__(self, cube, cache_size=CACHE_SIZE, models=None):
+        self.cube = cube
+        self.models = models
+        self.version = cube.version or ""
+        self.respond = functools.lru_cache(maxsize=cache_size)(self._respond)
+        self.latency = collections.defaultdict(lambda: collections.deque(maxlen=LATENCY_WINDOW))
+        self.statuses = collections.Counter()
+        self._lock = threading.Lock()
+
+    # ---- queries -----------------------------------------------------------
+
+    def _slice(self, params, measure):
+        """
+        `measure` restricted to the requested regions/drugs: (arr, observed).
+        """
+        c = self.cube
+        r = _codes(c.region_code, params.get("region", [])) or slice(None)
+        d = _codes(c.drug_code, params.get("drug", [])) or slice(None)
+        arr = c.values(measure)[:, r][:, :, d]
+        seen = c.observed[:, r][:, :, d]
+        return arr, seen
+
+    def series(self, params):
+        measure = _measure(params)
+        arr, seen = self._slice(params, measure)
+        mask = seen.any(axis=(1, 2))
+        values = to_units(measure, arr.sum(axis=(1, 2))[mask])
+        return {"measure": measure, "YEAR_MONTH": self.cube.months[mask].tolist(),
+                "values": values.tolist()}
+
+    def top(self, params):
+        c = self.cube
+        measure = _measure(params)
+        try:
+            n = int(_one(params, "n", 10))
+            years = [int(y) for y in params.get("year", [])]
+        except ValueError:
+            raise QueryError("n and year must be integers") from None
+        if n < 1:
+            raise QueryError(f"n must be at least 1, got {n}")
+        arr, seen = self._slice({"region": params.get("region", [])}, measure)
+        if years:
+            rows = np.isin(c.months // 100, years)
+            arr, seen = arr[rows], seen[rows]
+        totals = arr.sum(axis=(0, 1))
+        present = np.flatnonzero(seen.any(axis=(0, 1)))
+        order = present[np.argsort(-totals[present], kind="stable")][:n]
+        return {"measure": measure, "drugs": c.drugs[order].tolist(),
+                "values": to_units(measure, totals[order]).tolist()}
+
+    def pivot(self, params):
+        measure = _measure(params)
+        table = self.cube.annual_by_region(measure)
+        data = [[None if np.isnan(v) else v for v in row] for row in table.to_numpy().tolist()]
+        return {"measure": measure, "YEAR": table.index.tolist(),
+                "REGION_NAME": table.columns.tolist(), "data": data}
+
+    def forecast(self, params):
+        if self.models is None:
+            raise QueryError("no model store loaded")
+        series = _one(params, "series")
+        if series is None:
+            return {"series": self.models.ids}
+        if series not in self.models:
+            raise QueryError(f"no model for series {series!r}")
+        try:
+            steps = int(_one(params, "steps", 5))
+            levels = [float(v) for v in params.get("level", [])] or [0.90, 0.70, 0.50]
+        except ValueError:
+            raise QueryError("steps must be an integer and level a number") from None
+        if not 1 <= steps <= MAX_STEPS or not all(0 < lv < 1 for lv in levels):
+            raise QueryError(f"steps must be in 1..{MAX_STEPS} and level in (0, 1)")
+        mean, intervals = self.models.forecast(series, steps, levels)
+        months = future_months(self.models.model(series).last_month, steps)
+        return {"series": series, "YEAR_MONTH": months,
+                "mean": mean, "intervals": {str(lv): {"lower": lo, "upper": hi}
+                                            for lv, (lo, hi) in intervals.items()}}
+
+    # ---- responses -------------------------------------------------------------
+
+    def _respond(self, endpoint, query):
+        """
+        (status, body, etag) for a normalised query; cached by respond().
+        """
+        params = collections.defaultdict(list)
+        for k, v in query:
+            params[k].append(v)
+        try:
+            payload = getattr(self, endpoint)(params)
+        except QueryError as exc:
+            return 400, json.dumps({"error": str(exc)}).encode(), None
+        body = json.dumps(payload, separators=(",", ":")).encode()
+        tag = hashlib.sha256(repr((endpoint, query)).encode()).hexdigest()[:16]
+        return 200, body, f'"{self.version[:16]}-{tag}"'
+
+    def record(self, endpoint, status, seconds):
+        with self._lock:
+            self.latency[endpoint].append(seconds)
+            self.statuses[status] += 1
+
+    def metrics(self):
+        info = self.respond.cache_info()
+        with self._lock:
+            per_endpoint = {
+                name: {"count": len(lat),
+                       "p50_ms": float(np.percentile(lat, 50)) * 1e3,
+                       "p99_ms": float(np.percentile(lat, 99)) * 1e3}
+                for name, lat in self.latency.items() if lat}
+            statuses = {str(k): v for k, v in self.statuses.items()}
+        return {"version": self.version, "cache": {"hits": info.hits, "misses": info.misses,
+                                                   "size": info.currsize, "max": info.maxsize},
+                "status": statuses, "latency": per_endpoint}
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True  # small keep-alive responses go out at once
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body, etag=None):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if etag:
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", "no-cache")  # revalidate with If-None-Match
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        start = time.perf_counter()
+        service = self.server.service
+        url = urllib.parse.urlsplit(self.path)
+        endpoint = url.path.strip("/")
+        if endpoint in ENDPOINTS:
+            # Sorted so that equivalent query strings share a cache entry.
+            query = tuple(sorted(urllib.parse.parse_qsl(url.query)))
+            status, body, etag = service.respond(endpoint, query)
+            if etag and self.headers.get("If-None-Match") == etag:
+                status, body = 304, b""
+        elif endpoint == "metrics":
+            status, body, etag = 200, json.dumps(service.metrics()).encode(), None
+        elif endpoint == "health":
+            m, r, d = service.cube.shape
+            status, etag = 200, None
+            body = json.dumps({"version": service.version, "months": m, "regions": r,
+                               "drugs": d}).encode()
+        else:
+            status, body, etag = 404, json.dumps({"error": f"unknown endpoint {url.path!r}"}).encode(), None
+        self._send(status, body, etag if status in (200, 304) else None)
+        service.record(endpoint if endpoint in ENDPOINTS else "other", status,
+                       time.perf_counter() - start)
+
+
+class QueryServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, service):
+        super().__init__(address, _Handler)
+        self.service = service
+
+
+def make_server(host="127.0.0.1", port=8766, cube=None, cache_size=CACHE_SIZE):
+    """
+    A QueryServer over `cube` (default: the current load_cube()) and its
+    model store; call serve_forever() to run it.
+    """
+    from modelstore import open_store
+
+    cube = cube or load_cube()
+    return QueryServer((host, port), QueryService(cube, cache_size, open_store(cube=cube)))
+
+
+def bench(n_requests=2000):
+    """
+    Starts a local instance and measures client-side latency of cold,
+    cached and revalidated (304) requests over one keep-alive connection.
+    """
+    srv = make_server(port=0)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    cube = srv.service.cube
+    conn = http.client.HTTPConnection(*srv.server_address[:2])
+
+    def get(path, headers=None):
+        start = time.perf_counter()
+        conn.request("GET", path, headers=headers or {})
+        resp = conn.getresponse()
+        resp.read()
+        return time.perf_counter() - start, resp
+
+    drugs, regions = cube.drugs.tolist(), cube.regions.tolist()
+    paths = [f"/series?measure={m}&drug={urllib.parse.quote(d)}&region={urllib.parse.quote(r)}"
+             for m in MEASURES for d in drugs for r in regions]
+    paths += [f"/top?measure={m}&n=5&year={y}" for m in MEASURES for y in cube.years.tolist()]
+    paths += [f"/pivot?measure={m}" for m in MEASURES] + ["/series?measure=ITEMS"]
+    paths += [f"/forecast?series={urllib.parse.quote(s)}" for s in srv.service.models.ids]
+
+    cold = [get(p)[0] for p in paths]
+    rng = np.random.default_rng(0)
+    picks = rng.integers(0, len(paths), n_requests)
+    cached = [get(paths[i])[0] for i in picks]
+    _, resp = get(paths[0])
+    etag = resp.getheader("ETag")
+    revalidated = [get(paths[0], {"If-None-Match": etag}) for _ in range(200)]
+    assert all(r.status == 304 for _, r in revalidated)
+
+    pct = lambda xs: f"p50 {np.percentile(xs, 50)*1e3:.3f} ms, p99 {np.percentile(xs, 99)*1e3:.3f} ms"
+    print(f"{len(paths)} distinct queries, {n_requests} cached requests, one keep-alive connection")
+    print(f"  cold (computed):   {pct(cold)}")
+    print(f"  cached:            {pct(cached)}")
+    print(f"  304 revalidation:  {pct([t for t, _ in revalidated])}")
+    conn.request("GET", "/metrics")
+    metrics = json.loads(conn.getresponse().read())
+    print("  server-side:", {k: f"p50 {v['p50_ms']:.3f} ms, p99 {v['p99_ms']:.3f} ms"
+                             for k, v in metrics["latency"].items()})
+    print("  cache:", metrics["cache"])
+    conn.close()
+    srv.shutdown()
+    srv.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--cache-size", type=int, default=CACHE_SIZE)
+    parser.add_argument("--bench", action="store_true")
+    parser.add_argument("--requests", type=int, default=2000)
+    args = parser.parse_args()
+
+    if args.bench:
+        bench(args.requests)
+        return
+    srv = make_server(args.host, args.port, cache_size=args.cache_size)
+    m, r, d = srv.service.cube.shape
+    print(f"Serving cube {srv.service.version[:16]} ({m} months x {r} regions x {d} drugs) "
+          f"at http://{args.host}:{srv.server_address[1]}/")
+    try:
+        srv.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+"""
+Embedded SQLite store of the drug-level data with indexed rollups.
+
+The drug summary is loaded once into a single-file SQLite database under
+the cache directory (no server, standard library only):
+
+  facts            one row per YEAR_MONTH x region x drug, clustered on
+                   (year_month, region, drug), with secondary indexes on
+                   (region, year_month) and (drug, year_month)
+  rollup_<grain>   ITEMS, COST and source-row counts pre-summed by month,
+                   year, region, drug and their month/year x region/drug
+                   pairs
+  regions, drugs   code -> label tables (the loader's dictionary codes)
+
+COST is stored as integer pence and every SUM is an exact integer sum.
+The file is rebuilt when the source CSV's dataset version changes.
+
+SQLStore.totals() answers any grouping/filter over YEAR, YEAR_MONTH,
+REGION_NAME and BNF_CHEMICAL_SUBSTANCE from the smallest rollup that
+covers it, and SQLStore also provides the Cube methods the report scripts
+use (monthly_totals, annual_totals, annual_by_region, by_drug, top_drugs,
+drug_monthly), so part_one_table.py and part_two_b.py plots can be drawn
+from the database without loading the rows into memory.
+
+    python sqlstore.py [--rebuild]                       # check against the cube, with timings
+    python sqlstore.py --by YEAR,REGION_NAME [--region R] [--drug D] [--year Y] [--month YYYYMM]
+"""
+import argparse
+import os
+import sqlite3
+import time
+
+import numpy as np
+import pandas as pd
+
+from cube import MEASURES, to_units
+from instrument import span, traced
+from loader import (CACHE_DIR, DRUG_SUMMARY_CSV, DRUG_SUMMARY_DTYPES, dataset_version,
+                    encode_categoricals, load_dictionaries, with_pence)
+
+# Bump when the schema changes so old database files are rebuilt.
+STORE_FORMAT = 1
+CHUNKSIZE = 200_000
+
+# Dataset column -> SQL column.
+COLUMNS = {
+    "YEAR": "year",
+    "YEAR_MONTH": "year_month",
+    "REGION_NAME": "region",
+    "BNF_CHEMICAL_SUBSTANCE": "drug",
+}
+MEASURE_COLUMNS = {"ITEMS": "items", "COST": "cost_pence"}
+
+# Materialized rollups: name -> key columns.
+ROLLUPS = {
+    "month": ("year_month",),
+    "year": ("year",),
+    "region": ("region",),
+    "drug": ("drug",),
+    "month_region": ("year_month", "region"),
+    "year_region": ("year", "region"),
+    "month_drug": ("year_month", "drug"),
+    "year_drug": ("year", "drug"),
+}
+
+SCHEMA = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE regions (code INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);
+CREATE TABLE drugs (code INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);
+CREATE TABLE facts (
+    year_month INTEGER NOT NULL,
+    year INTEGER NOT NULL,
+    region INTEGER NOT NULL,
+    drug INTEGER NOT NULL,
+    items INTEGER NOT NULL,
+    cost_pence INTEGER NOT NULL,
+    n_rows INTEGER NOT NULL,
+    PRIMARY KEY (year_month, region, drug)
+) WITHOUT ROWID;
+"""
+
+UPSERT = """
+INSERT INTO facts VALUES (?, ?, ?, ?, ?, ?, 1)
+ON CONFLICT (year_month, region, drug) DO UPDATE SET
+    items = items + excluded.items,
+    cost_pence = cost_pence + excluded.cost_pence,
+    n_rows = n_rows + 1
+"""
+
+
+def db_path(path=DRUG_SUMMARY_CSV, cache_dir=CACHE_DIR):
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(cache_dir, f"{stem}.v{STORE_FORMAT}.sqlite")
+
+
+@traced("load")
+def build_store(path=DRUG_SUMMARY_CSV, db=None, cache_dir=CACHE_DIR, chunksize=CHUNKSIZE):
+    """
+    Loads `path` into a new SQLite file at `db`, streaming `chunksize` rows
+    at a time, then builds the rollups and indexes. Returns `db`.
+    """
+    db = db or db_path(path, cache_dir)
+    version = dataset_version(path, cache_dir)
+    os.makedirs(os.path.dirname(db) or ".", exist_ok=True)
+    tmp = f"{db}.tmp{os.getpid()}"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+
+    con = sqlite3.connect(tmp)
+    try:
+        # A fresh temporary file: durability only matters once it is renamed.
+        con.execute("PRAGMA journal_mode = OFF")
+        con.execute("PRAGMA synchronous = OFF")
+        con.executescript(SCHEMA)
+        with pd.read_csv(path, dtype=DRUG_SUMMARY_DTYPES, chunksize=chunksize) as reader:
+            for chunk in reader:
+                chunk = encode_categoricals(with_pence(chunk), cache_dir)
+                ym = chunk["YEAR_MONTH"].to_numpy(dtype=np.int64)
+                con.executemany(UPSERT, zip(
+                    ym.tolist(), (ym // 100).tolist(),
+                    chunk["REGION_NAME"].cat.codes.tolist(),
+                    chunk["BNF_CHEMICAL_SUBSTANCE"].cat.codes.tolist(),
+                    chunk["ITEMS"].tolist(), chunk["COST_PENCE"].tolist()))
+
+        dictionaries = load_dictionaries(cache_dir)
+        for table, col in (("regions", "REGION_NAME"), ("drugs", "BNF_CHEMICAL_SUBSTANCE")):
+            con.executemany(f"INSERT INTO {table} VALUES (?, ?)", enumerate(dictionaries[col]))
+
+        con.execute("CREATE INDEX facts_region ON facts (region, year_month)")
+        con.execute("CREATE INDEX facts_drug ON facts (drug, year_month)")
+        for name, keys in ROLLUPS.items():
+            k = ", ".join(keys)
+            con.execute(f"CREATE TABLE rollup_{name} ({k}, items INTEGER, cost_pence INTEGER, "
+                        f"n_rows INTEGER, PRIMARY KEY ({k})) WITHOUT ROWID")
+            con.execute(f"INSERT INTO rollup_{name} SELECT {k}, SUM(items), SUM(cost_pence), "
+                        f"SUM(n_rows) FROM facts GROUP BY {k}")
+        con.executemany("INSERT INTO meta VALUES (?, ?)", [
+            ("source", os.path.abspath(path)), ("version", version), ("format", str(STORE_FORMAT))])
+        con.execute("ANALYZE")
+        con.commit()
+    finally:
+        con.close()
+    os.replace(tmp, db)
+    return db
+
+
+def open_store(path=DRUG_SUMMARY_CSV, db=None, cache_dir=CACHE_DIR, rebuild=False):
+    """
+    An SQLStore for the current version of `path`, (re)building the
+    database file first if it is missing or stale.
+    """
+    db = db or db_path(path, cache_dir)
+    version = dataset_version(path, cache_dir)
+    if not rebuild and os.path.exists(db):
+        store = SQLStore(db)
+        if store.version == version:
+            return store
+        store.close()
+    build_store(path, db, cache_dir)
+    return SQLStore(db)
+
+
+class SQLStore:
+    """
+    Read-only query API over a database written by build_store().
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.con = sqlite3.connect(f"file:{db}?mode=ro", uri=True, check_same_thread=False)
+        meta = dict(self.con.execute("SELECT key, value FROM meta"))
+        self.version = meta.get("version")
+        # Labels of the codes present in the data, in code order (the cube's axis order).
+        self.labels = {}
+        for col, table, key in (("REGION_NAME", "regions", "region"),
+                                ("BNF_CHEMICAL_SUBSTANCE", "drugs", "drug")):
+            rows = self.con.execute(
+                f"SELECT code, name FROM {table} WHERE code IN "
+                f"(SELECT {key} FROM rollup_{key}) ORDER BY code").fetchall()
+            self.labels[col] = dict(rows)
+        self.codes = {col: {name: code for code, name in lab.items()}
+                      for col, lab in self.labels.items()}
+
+    def close(self):
+        self.con.close()
+
+    @property
+    def regions(self):
+        return np.asarray(list(self.labels["REGION_NAME"].values()), dtype=object)
+
+    @property
+    def drugs(self):
+        return np.asarray(list(self.labels["BNF_CHEMICAL_SUBSTANCE"].values()), dtype=object)
+
+    def _code(self, col, label):
+        try:
+            return self.codes[col][label]
+        except KeyError:
+            raise KeyError(f"{label!r} is not a known {col}") from None
+
+    @staticmethod
+    def _table_for(columns):
+        """
+        The smallest rollup whose keys include every column, else facts.
+        """
+        fits = [(len(keys), name) for name, keys in ROLLUPS.items() if set(columns) <= set(keys)]
+        return f"rollup_{min(fits)[1]}" if fits else "facts"
+
+    def execute(self, sql, params=()):
+        """
+        Runs ad-hoc SQL against the store; returns a DataFrame.
+        """
+        cur = self.con.execute(sql, params)
+        return pd.DataFrame(cur.fetchall(), columns=[d[0] for d in cur.description])
+
+    @traced("aggregate")
+    def totals(self, by=("YEAR_MONTH",), measures=MEASURES, years=None, months=None,
+               regions=None, drugs=None):
+        """
+        Long table of `measures` summed by the `by` columns, optionally
+        restricted to some years, months, regions and/or drugs. Groups with
+        no source rows are left out, as in a groupby; COST is in pounds.
+        """
+        by = list(by)
+        unknown = set(by) - set(COLUMNS)
+        if unknown:
+            raise KeyError(f"Unknown grouping column(s) {sorted(unknown)}; expected some of {tuple(COLUMNS)}")
+        filters = {"YEAR": years, "YEAR_MONTH": months, "REGION_NAME": regions,
+                   "BNF_CHEMICAL_SUBSTANCE": drugs}
+        where, params = [], []
+        for col, values in filters.items():
+            if values is None:
+                continue
+            values = list(values)
+            if col in self.codes:
+                values = [self._code(col, v) for v in values]
+            where.append(f"{COLUMNS[col]} IN ({', '.join('?' * len(values))})")
+            params.extend(int(v) for v in values)
+
+        needed = [COLUMNS[c] for c in by] + [COLUMNS[c] for c, v in filters.items() if v is not None]
+        keys = ", ".join(COLUMNS[c] for c in by)
+        sums = ", ".join(f"SUM({MEASURE_COLUMNS[m]})" for m in measures)
+        sql = f"SELECT {keys + ', ' if keys else ''}{sums} FROM {self._table_for(needed)}"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        if keys:
+            sql += f" GROUP BY {keys} ORDER BY {keys}"
+
+        with span("sqlstore.query", "aggregate", sql=sql):
+            rows = self.con.execute(sql, params).fetchall()
+        if not by and rows and rows[0][0] is None:
+            rows = []  # SUM over no rows
+        out = pd.DataFrame(rows, columns=by + list(measures))
+        for col in by:
+            if col in self.labels:
+                out[col] = out[col].map(self.labels[col])
+        for m in measures:
+            out[m] = to_units(m, out[m].to_numpy(dtype=np.int64))
+        return out
+
+    # ---- the Cube methods used by the report scripts ----------------------
+
+    def monthly_totals(self, measures=MEASURES):
+        return self.totals(["YEAR_MONTH"], measures)
+
+    def annual_totals(self, measures=MEASURES):
+        return self.totals(["YEAR"], measures)
+
+    def annual_by_region(self, measure):
+        """
+        YEAR x REGION_NAME pivot of `measure`, NaN where a region has no rows.
+        """
+        long = self.totals(["YEAR", "REGION_NAME"], [measure])
+        pivot = long.pivot(index="YEAR", columns="REGION_NAME", values=measure)
+        return pivot.reindex(columns=pd.Index(self.regions, name="REGION_NAME")).astype(np.float64)
+
+    def by_drug(self, measure):
+        """
+        All-years total of `measure` per BNF_CHEMICAL_SUBSTANCE.
+        """
+        long = self.totals(["BNF_CHEMICAL_SUBSTANCE"], [measure])
+        return (long.set_index("BNF_CHEMICAL_SUBSTANCE")[measure]
+                .reindex(pd.Index(self.drugs, name="BNF_CHEMICAL_SUBSTANCE")))
+
+    def top_drugs(self, measure, n):
+        """
+        Names of the `n` drugs with the largest all-years total of `measure`.
+        """
+        rows = self.con.execute(
+            f"SELECT drug FROM rollup_drug ORDER BY {MEASURE_COLUMNS[measure]} DESC, drug LIMIT ?",
+            (int(n),)).fetchall()
+        return [self.labels["BNF_CHEMICAL_SUBSTANCE"][code] for (code,) in rows]
+
+    def drug_monthly(self, measure, drugs):
+        """
+        Long table of monthly national `measure` for the given drugs, months
+        without rows left out (as Cube.drug_monthly).
+        """
+        long = self.totals(["YEAR_MONTH", "BNF_CHEMICAL_SUBSTANCE"], [measure], drugs=drugs)
+        order = {d: i for i, d in enumerate(drugs)}
+        long["_order"] = long["BNF_CHEMICAL_SUBSTANCE"].map(order)
+        return (long.sort_values(["_order", "YEAR_MONTH"], kind="stable")
+                .sort_values("YEAR_MONTH", kind="stable")
+                .drop(columns="_order").reset_index(drop=True))
+
+
+def _timed(fn, repeat=20):
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        value = fn()
+    return value, (time.perf_counter() - start) / repeat
+
+
+def _same_frame(a, b):
+    # Labels and values compared exactly, ignoring dtype differences.
+    text = lambda x: pd.DataFrame(x).reset_index().astype(str)
+    return text(a).equals(text(b))
+
+
+def check(store):
+    """
+    Compares every Cube method against the in-memory cube, with timings.
+    """
+    from cube import load_cube
+
+    cube = load_cube()
+    top = cube.top_drugs("ITEMS", 5)
+    cases = [
+        ("monthly_totals", lambda c: c.monthly_totals()),
+        ("annual_totals", lambda c: c.annual_totals()),
+        ("annual_by_region ITEMS", lambda c: c.annual_by_region("ITEMS")),
+        ("annual_by_region COST", lambda c: c.annual_by_region("COST")),
+        ("by_drug COST", lambda c: c.by_drug("COST")),
+        ("top_drugs COST", lambda c: c.top_drugs("COST", 5)),
+        ("drug_monthly ITEMS", lambda c: c.drug_monthly("ITEMS", top).reset_index(drop=True)),
+    ]
+    rows = []
+    for name, fn in cases:
+        got, sql_s = _timed(lambda: fn(store))
+        want, cube_s = _timed(lambda: fn(cube))
+        same = got == want if isinstance(want, list) else _same_frame(got, want)
+        rows.append({"query": name, "equal": same, "sqlite_ms": sql_s * 1e3, "cube_ms": cube_s * 1e3})
+    return pd.DataFrame(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--path", default=DRUG_SUMMARY_CSV)
+    parser.add_argument("--rebuild", action="store_true")
+    parser.add_argument("--by", default=None, help="comma-separated grouping columns")
+    parser.add_argument("--measure", action="append", choices=MEASURES, default=None)
+    parser.add_argument("--year", type=int, action="append", default=None)
+    parser.add_argument("--month", type=int, action="append", default=None)
+    parser.add_argument("--region", action="append", default=None)
+    parser.add_argument("--drug", action="append", default=None)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    store = open_store(args.path, rebuild=args.rebuild)
+    print(f"Store {store.db} (version {store.version[:16]}) ready in "
+          f"{(time.perf_counter() - start)*1e3:.1f} ms")
+
+    if args.by is None and not any([args.year, args.month, args.region, args.drug]):
+        with pd.option_context("display.float_format", "{:,.3f}".format):
+            print(check(store).to_string(index=False))
+        return
+
+    by = [c for c in (args.by or "").split(",") if c]
+    start = time.perf_counter()
+    df = store.totals(by, args.measure or MEASURES, years=args.year, months=args.month,
+                      regions=args.region, drugs=args.drug)
+    elapsed = time.perf_counter() - start
+    print(df.to_string(index=False))
+    print(f"{len(df)} rows in {elapsed*1e3:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+Chunked streaming aggregation for extracts that do not fit in memory.
+
+The CSV is read in fixed-size chunks and each chunk is folded into the
+month x region x drug totals, so memory use is bounded by the size of the
+cube rather than the number of rows. The result is a cube.Cube with the same
+axis order as cube.build_cube() over the fully loaded data.
+
+    python streaming.py [CSV] [--chunksize N] [--verify]
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from cube import Cube
+from instrument import traced
+from loader import (CACHE_DIR, DRUG_SUMMARY_CSV, DRUG_SUMMARY_DTYPES, encode_categoricals,
+                    load_dictionaries, with_pence)
+
+DEFAULT_CHUNKSIZE = 1_000_000
+
+
+class _Accumulator:
+    """
+    Growable dense totals indexed by (month slot, region code, drug code).
+    """
+
+    def __init__(self):
+        self.month_slot = {}
+        self.shape = (16, 8, 64)
+        self.items = np.zeros(self.shape, dtype=np.int64)
+        self.cost = np.zeros(self.shape, dtype=np.int64)
+        self.rows = np.zeros(self.shape, dtype=np.int64)
+
+    def _grow(self, need):
+        if all(n <= s for n, s in zip(need, self.shape)):
+            return
+        shape = tuple(max(s, 1 << int(np.ceil(np.log2(max(n, 1))))) for n, s in zip(need, self.shape))
+        for name in ("items", "cost", "rows"):
+            old = getattr(self, name)
+            new = np.zeros(shape, dtype=old.dtype)
+            new[:old.shape[0], :old.shape[1], :old.shape[2]] = old
+            setattr(self, name, new)
+        self.shape = shape
+
+    def fold(self, chunk):
+        if chunk.empty:
+            return
+        months = chunk["YEAR_MONTH"].to_numpy()
+        for m in np.unique(months):
+            self.month_slot.setdefault(int(m), len(self.month_slot))
+        lookup = pd.Series(self.month_slot)
+        m_codes = lookup.reindex(months).to_numpy(dtype=np.intp)
+        r_codes = chunk["REGION_NAME"].cat.codes.to_numpy()
+        d_codes = chunk["BNF_CHEMICAL_SUBSTANCE"].cat.codes.to_numpy()
+        self._grow((len(self.month_slot),
+                    len(chunk["REGION_NAME"].cat.categories),
+                    len(chunk["BNF_CHEMICAL_SUBSTANCE"].cat.categories)))
+
+        flat = np.ravel_multi_index((m_codes, r_codes, d_codes), self.shape)
+        keys, inverse = np.unique(flat, return_inverse=True)
+        # Per-chunk sums are exact in float64 (see cube.build_cube); the
+        # running totals are kept in int64 so chunking cannot change them.
+        sums = lambda col: np.rint(np.bincount(inverse, weights=chunk[col].to_numpy())).astype(np.int64)
+        self.items.ravel()[keys] += sums("ITEMS")
+        self.cost.ravel()[keys] += sums("COST_PENCE")
+        self.rows.ravel()[keys] += np.bincount(inverse)
+
+    def to_cube(self, region_labels, drug_labels, version=None):
+        observed = self.rows > 0
+        month_order = sorted(self.month_slot)
+        m_idx = np.array([self.month_slot[m] for m in month_order], dtype=np.intp)
+        r_idx = np.flatnonzero(observed.any(axis=(0, 2)))
+        d_idx = np.flatnonzero(observed.any(axis=(0, 1)))
+        sel = np.ix_(m_idx, r_idx, d_idx)
+        return Cube(
+            months=np.array(month_order, dtype=np.int64),
+            regions=np.asarray(region_labels, dtype=object)[r_idx],
+            drugs=np.asarray(drug_labels, dtype=object)[d_idx],
+            items=self.items[sel],
+            cost=self.cost[sel],
+            observed=observed[sel],
+            version=version,
+        )
+
+
+@traced("aggregate")
+def stream_cube(path=DRUG_SUMMARY_CSV, chunksize=DEFAULT_CHUNKSIZE, cache_dir=CACHE_DIR,
+                version=None, stats=None):
+    """
+    Builds a Cube from `path` by folding `chunksize`-row chunks; a file
+    with no rows gives an empty (0, 0, 0) cube.
+
+    If `stats` is a dict it is filled with rows, chunks, seconds and
+    rows_per_sec.
+    """
+    acc = _Accumulator()
+    rows = chunks = 0
+    start = time.perf_counter()
+    with pd.read_csv(path, dtype=DRUG_SUMMARY_DTYPES, chunksize=chunksize) as reader:
+        for chunk in reader:
+            chunk = encode_categoricals(with_pence(chunk), cache_dir)
+            acc.fold(chunk)
+            rows += len(chunk)
+            chunks += 1
+    # Codes index the stable dictionaries, which cover every label folded in.
+    dictionaries = load_dictionaries(cache_dir)
+    cube = acc.to_cube(dictionaries.get("REGION_NAME", []),
+                       dictionaries.get("BNF_CHEMICAL_SUBSTANCE", []), version=version)
+    elapsed = time.perf_counter() - start
+
+    if stats is not None:
+        stats.update(rows=rows, chunks=chunks, seconds=elapsed,
+                     rows_per_sec=rows / elapsed if elapsed > 0 else float("inf"))
+    return cube
+
+
+def cubes_match(a, b):
+    """
+    True when two cubes have the same axes and identical ITEMS and COST
+    (pence) in every cell.
+    """
+    return (
+        np.array_equal(a.months, b.months)
+        and np.array_equal(a.regions, b.regions)
+        and np.array_equal(a.drugs, b.drugs)
+        and np.array_equal(a.observed, b.observed)
+        and np.array_equal(a.items, b.items)
+        and np.array_equal(a.cost, b.cost)
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("path", nargs="?", default=DRUG_SUMMARY_CSV)
+    parser.add_argument("--chunksize", type=int, default=DEFAULT_CHUNKSIZE)
+    parser.add_argument("--verify", action="store_true",
+                        help="compare against the in-memory cube (needs the data to fit in RAM)")
+    args = parser.parse_args()
+
+    stats = {}
+    cube = stream_cube(args.path, chunksize=args.chunksize, stats=stats)
+    m, r, d = cube.shape
+    print(f"Streamed {stats['rows']:,} rows in {stats['chunks']} chunks of {args.chunksize:,} "
+          f"({stats['seconds']:.2f}s, {stats['rows_per_sec']:,.0f} rows/s)")
+    print(f"Cube: {m} months x {r} regions x {d} drugs")
+
+    if args.verify:
+        from cube import build_cube
+        from loader import load_drug_summary
+        reference = build_cube(load_drug_summary(args.path))
+        print("Matches in-memory path:", cubes_match(cube, reference))
+
+
+if __name__ == "__main__":
+    main()
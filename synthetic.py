@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""
+Synthetic BSA_ODP_PCA_REGIONAL_DRUG_SUMMARY-shaped data at any scale.
+
+The output has the same columns, dtypes and row order as the shipped CSV
+(YEAR, YEAR_MONTH, REGION_NAME, BNF_CHEMICAL_SUBSTANCE, ITEMS, COST). Each
+region x drug series follows the pattern the report finds in the real data:
+log ITEMS with a slow upward trend plus AR(1) "bounce-back" log-differences
+(a negative ar.L1), around a heavy-tailed drug popularity and a per-region
+share. COST is ITEMS times a drug-specific cost per item with its own small
+drift. Low-volume series have months with no prescriptions, which, like the
+real extract, have no row.
+
+Scale is set by months, regions and drugs. Up to 7 regions and 32 drugs reuse
+the real names; beyond that, regions become practices ("PRACTICE 000123")
+and drugs get generated names. Rows are produced a month at a time, so a
+10^8-row file is written without holding it in memory.
+
+    python synthetic.py --rows 1000000 --out synthetic.csv
+    python synthetic.py --months 120 --regions 500 --drugs 64 --out synthetic.csv
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+REGIONS = ["EAST OF ENGLAND", "LONDON", "MIDLANDS", "NORTH EAST AND YORKSHIRE",
+           "NORTH WEST", "SOUTH EAST", "SOUTH WEST"]
+COLUMNS = ["YEAR", "YEAR_MONTH", "REGION_NAME", "BNF_CHEMICAL_SUBSTANCE", "ITEMS", "COST"]
+
+# Fitted to the national series of the shipped extract (see arima110.py).
+AR_L1 = -0.66
+DRIFT = 0.003      # monthly growth of log ITEMS
+SIGMA = 0.035      # sd of the national (shared) log-difference innovations
+IDIO_SIGMA = 0.02  # sd of each series' own innovations, before small-count inflation
+MAX_SIGMA = 0.25   # cap, so tiny practice-level series do not random-walk to overflow
+# Bump when the generated values change, so cached benchmark files are regenerated.
+GENERATOR_VERSION = 2
+START_MONTH = 202101
+
+
+def _drug_names(n):
+    try:
+        real = pd.read_csv("BSA_ODP_PCA_REGIONAL_DRUG_SUMMARY.csv",
+                           usecols=["BNF_CHEMICAL_SUBSTANCE"])["BNF_CHEMICAL_SUBSTANCE"]
+        real = sorted(real.unique())
+    except (FileNotFoundError, ValueError):
+        real = []
+    if n <= len(real):
+        return list(real[:n])
+    return [f"Drug {i:05d}" for i in range(n)]
+
+
+def _region_names(n):
+    if n <= len(REGIONS):
+        return REGIONS[:n]
+    return [f"PRACTICE {i:06d}" for i in range(n)]
+
+
+def month_sequence(n_months, start=START_MONTH):
+    """
+    `n_months` consecutive YEAR_MONTH values starting at `start`.
+    """
+    year, month = divmod(start, 100)
+    idx = (year * 12 + month - 1) + np.arange(n_months)
+    return (idx // 12) * 100 + idx % 12 + 1
+
+
+def shape_for_rows(rows, months=46, drugs=32):
+    """
+    (months, regions, drugs) giving roughly `rows` rows: months and drugs are
+    fixed and regions (practices) absorb the scale, as in a practice-level
+    extract. Below one region's worth of rows, drugs are reduced instead.
+    """
+    cells = max(int(rows), 1)
+    if cells < months * drugs:
+        drugs = max(1, cells // months)
+    # about 4% of cells are empty months of low-volume series
+    regions = max(1, int(round(cells / (months * drugs * 0.96))))
+    return months, regions, drugs
+
+
+def generate_months(n_months=46, n_regions=7, n_drugs=32, seed=0, start=START_MONTH):
+    """
+    Yields one DataFrame of rows per month, in chronological order.
+    """
+    rng = np.random.default_rng(seed)
+    regions = np.asarray(_region_names(n_regions), dtype=object)
+    drugs = np.asarray(_drug_names(n_drugs), dtype=object)
+
+    # Popularity of each drug (heavy-tailed, like the real 1..490k ITEMS range),
+    # each region's share, and a per-series idiosyncratic level.
+    drug_level = rng.lognormal(mean=8.5, sigma=2.2, size=n_drugs)
+    region_share = rng.dirichlet(np.full(n_regions, 5.0)) * min(n_regions, 7)
+    level = np.log(np.outer(region_share, drug_level)) + rng.normal(0, 0.1, (n_regions, n_drugs))
+    cost_per_item = rng.lognormal(mean=1.0, sigma=0.9, size=n_drugs)
+    cost_drift = rng.normal(-0.002, 0.004, size=n_drugs)
+
+    drift = DRIFT + rng.normal(0, 0.002, (n_regions, n_drugs))
+    sigma = np.minimum(IDIO_SIGMA * (1 + 20 / np.sqrt(np.exp(level))), MAX_SIGMA)  # small series are noisier
+    z_prev = np.zeros((n_regions, n_drugs))
+    log_items = level.copy()
+
+    # Rows within a month are ordered by drug, then region, as in the real file.
+    region_col = np.tile(regions, n_drugs)
+    drug_col = np.repeat(drugs, n_regions)
+    for t, ym in enumerate(month_sequence(n_months, start)):
+        if t:
+            # A shared shock (e.g. working days in the month) plus each series' own.
+            shock = SIGMA * rng.standard_normal() + sigma * rng.standard_normal(z_prev.shape)
+            z = drift + AR_L1 * (z_prev - drift) + shock
+            log_items = log_items + z
+            z_prev = z
+        items = rng.poisson(np.exp(log_items)).T.ravel()
+        cpi = cost_per_item * np.exp(cost_drift * t)
+        cost = np.round(items * np.repeat(cpi, n_regions) * rng.lognormal(0, 0.02, items.shape), 2)
+        keep = items > 0
+        yield pd.DataFrame({
+            "YEAR": ym // 100,
+            "YEAR_MONTH": ym,
+            "REGION_NAME": region_col[keep],
+            "BNF_CHEMICAL_SUBSTANCE": drug_col[keep],
+            "ITEMS": items[keep],
+            "COST": cost[keep],
+        }, columns=COLUMNS)
+
+
+def generate(n_months=46, n_regions=7, n_drugs=32, seed=0, start=START_MONTH):
+    """
+    The whole synthetic extract as one DataFrame (for small sizes).
+    """
+    return pd.concat(generate_months(n_months, n_regions, n_drugs, seed, start), ignore_index=True)
+
+
+def write_csv(path, n_months=46, n_regions=7, n_drugs=32, seed=0, start=START_MONTH):
+    """
+    Writes the synthetic extract to `path` a month at a time; returns the
+    number of rows written.
+    """
+    rows = 0
+    with open(path, "w", newline="") as fh:
+        for i, chunk in enumerate(generate_months(n_months, n_regions, n_drugs, seed, start)):
+            chunk.to_csv(fh, header=(i == 0), index=False)
+            rows += len(chunk)
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=float, help="approximate row count (sets --regions)")
+    parser.add_argument("--months", type=int, default=46)
+    parser.add_argument("--regions", type=int, default=7)
+    parser.add_argument("--drugs", type=int, default=32)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default="synthetic_drug_summary.csv")
+    args = parser.parse_args()
+
+    months, regions, drugs = args.months, args.regions, args.drugs
+    if args.rows:
+        months, regions, drugs = shape_for_rows(args.rows, months, drugs)
+    start = time.perf_counter()
+    rows = write_csv(args.out, months, regions, drugs, seed=args.seed)
+    print(f"Wrote {rows:,} rows ({months} months x {regions} regions x {drugs} drugs) "
+          f"to {args.out} in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,18 @@
+import numpy as np
+import pytest
+
+from anomaly import WARMUP, ChangeDetector
+
+
+@pytest.mark.parametrize("forgetting", [1.0, 0.9, 0.8, 0.6])
+def test_series_are_scored_after_warmup(forgetting):
+    dy = np.random.default_rng(0).normal(size=(5, 30))
+    detector = ChangeDetector(len(dy), forgetting=forgetting)
+    scored = [np.isfinite(detector.update(dy[:, j])["z"]).all() for j in range(dy.shape[1])]
+    # The first month has no pair; scoring starts once WARMUP pairs are in.
+    assert not any(scored[:WARMUP + 1]) and all(scored[WARMUP + 1:])
+
+
+def test_forgetting_that_can_never_score_is_rejected():
+    with pytest.raises(ValueError, match="above 0.5"):
+        ChangeDetector(3, forgetting=0.5)
@@ -0,0 +1,19 @@
+import numpy as np
+
+from batch_forecast import forecast_all
+from cube import Cube
+
+
+def test_numpy_engine_reports_degenerate_fits():
+    months = [y * 100 + m for y in (2021, 2022, 2023) for m in range(1, 13)]
+    rng = np.random.default_rng(0)
+    walk = 500 + np.cumsum(rng.normal(0, 10, len(months)))
+    items = np.stack([np.full(len(months), 40.0), 10.0 * np.arange(1, len(months) + 1), walk],
+                     axis=1).round().astype(np.int64)[:, None, :]
+    cube = Cube(months, ["R"], ["constant", "ramp", "walk"], items, items * 100,
+                np.ones(items.shape, dtype=bool))
+    table = forecast_all(cube, steps=2, measures=["ITEMS"], engine="numpy")
+    status = table.drop_duplicates("BNF_CHEMICAL_SUBSTANCE").set_index("BNF_CHEMICAL_SUBSTANCE")["STATUS"]
+    assert status["constant"] == "failed: degenerate fit"
+    assert status["ramp"] == "failed: degenerate fit"
+    assert status["walk"] == "ok"
@@ -0,0 +1,106 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from cube import build_cube
+from ingest import AggregateStore, _rollups_from_cube
+from loader import DRUG_SUMMARY_CSV, read_drug_summary_csv, to_pounds
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SOURCE = os.path.join(ROOT, DRUG_SUMMARY_CSV)
+
+
+@pytest.fixture
+def split(tmp_path, monkeypatch):
+    """
+    The extract as a history CSV (all but the last two months, without one
+    drug) and one CSV per remaining month, so appends add a drug too.
+    """
+    monkeypatch.chdir(tmp_path)  # the loader's dictionaries go to ./.cache
+    df = pd.read_csv(SOURCE, dtype=str)
+    months = sorted(df["YEAR_MONTH"].unique())
+    late_drug = sorted(df["BNF_CHEMICAL_SUBSTANCE"].unique())[0]
+    history = df[df["YEAR_MONTH"].isin(months[:-2]) & (df["BNF_CHEMICAL_SUBSTANCE"] != late_drug)]
+    history.to_csv("history.csv", index=False)
+    paths = []
+    for month in months[-2:]:
+        paths.append(str(tmp_path / f"{month}.csv"))
+        df[df["YEAR_MONTH"] == month].to_csv(paths[-1], index=False)
+    return str(tmp_path / "history.csv"), paths
+
+
+def _aligned(cube, regions, drugs):
+    r = [list(cube.regions).index(x) for x in regions]
+    d = [list(cube.drugs).index(x) for x in drugs]
+    return [a[:, r][:, :, d] for a in (cube.items, cube.cost, cube.observed)]
+
+
+def test_append_matches_full_build(split, tmp_path):
+    history, new = split
+    root = str(tmp_path / "store")
+    AggregateStore.from_cube(build_cube(read_drug_summary_csv(history)), root).save()
+    slices = os.path.join(root, "months")
+    before = {f: os.stat(os.path.join(slices, f)).st_mtime_ns for f in os.listdir(slices)}
+
+    for path in new:
+        store = AggregateStore.open(root)
+        store.append_month(path)
+        store.save()
+
+    # Only the new months' slices were written; the history's are untouched.
+    after = {f: os.stat(os.path.join(slices, f)).st_mtime_ns for f in os.listdir(slices)}
+    assert {f: after[f] for f in before} == before
+    assert len(after) == len(before) + len(new)
+
+    pd.concat([pd.read_csv(p, dtype=str) for p in [history] + new]).to_csv("all.csv", index=False)
+    full = build_cube(read_drug_summary_csv("all.csv"))
+    store = AggregateStore.open(root)
+    cube = store.cube
+    assert np.array_equal(cube.months, full.months)
+    assert sorted(cube.regions) == sorted(full.regions) and sorted(cube.drugs) == sorted(full.drugs)
+    for got, want in zip(_aligned(cube, full.regions, full.drugs), (full.items, full.cost, full.observed)):
+        assert np.array_equal(got, want)
+
+    pd.testing.assert_frame_equal(store.monthly_totals(), full.monthly_totals())
+    pd.testing.assert_frame_equal(store.annual_by_region("COST")[list(full.regions)],
+                                  full.annual_by_region("COST"), check_names=False)
+    for measure in ("ITEMS", "COST"):
+        assert store.by_drug(measure).sort_index().equals(full.by_drug(measure).sort_index())
+
+
+def test_duplicate_month_is_rejected(split, tmp_path):
+    history, new = split
+    store = AggregateStore.from_cube(build_cube(read_drug_summary_csv(history)), str(tmp_path / "store"))
+    store.append_month(new[0])
+    with pytest.raises(ValueError, match="already loaded"):
+        store.append_month(new[0])
+    assert store.months.n == len(np.unique(store.months.rows))
+
+
+def test_legacy_store_in_pounds_is_rebuilt(split, tmp_path):
+    history, new = split
+    root = tmp_path / "store"
+    root.mkdir()
+    cube = build_cube(read_drug_summary_csv(history))
+    # The single-file layout from before COST was held in pence.
+    np.savez(root / "cube.npz", months=cube.months, regions=cube.regions.astype(str),
+             drugs=cube.drugs.astype(str), items=cube.items, cost=to_pounds(cube.cost),
+             observed=cube.observed, version=np.array(cube.version or ""))
+    rollups = {k: to_pounds(v) if "cost" in k else v for k, v in _rollups_from_cube(cube).items()}
+    np.savez(root / "rollups.npz", **rollups)
+    (root / "manifest.json").write_text(json.dumps({"months": cube.months.tolist(), "sources": []}))
+
+    store = AggregateStore.open(str(root))
+    pd.testing.assert_frame_equal(store.monthly_totals(), cube.monthly_totals())
+    store.append_month(new[0])
+    store.save()
+
+    pd.concat([pd.read_csv(p, dtype=str) for p in (history, new[0])]).to_csv("all.csv", index=False)
+    full = build_cube(read_drug_summary_csv("all.csv"))
+    store = AggregateStore.open(str(root))
+    assert not (root / "cube.npz").exists()
+    pd.testing.assert_frame_equal(store.monthly_totals(), full.monthly_totals())
+    assert store.by_drug("COST").sort_index().equals(full.by_drug("COST").sort_index())
@@ -0,0 +1,11 @@
+import numpy as np
+
+from order_search import best_orders, search_orders
+
+
+def test_every_series_gets_a_model_when_the_budget_runs_out():
+    rng = np.random.default_rng(0)
+    y = np.cumsum(rng.normal(1.0, 1.0, size=(3, 40)), axis=1)
+    best = best_orders(search_orders(y, d=1, budget=0, jobs=2))
+    assert best["SERIES"].tolist() == [0, 1, 2]
+    assert (best["STATUS"] == "ok").all()
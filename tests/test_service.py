@@ -0,0 +1,28 @@
+import json
+import os
+
+from cube import build_cube
+from loader import DRUG_SUMMARY_CSV, read_drug_summary_csv
+from service import QueryService
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _service(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)  # the loader's dictionaries go to ./.cache
+    return QueryService(build_cube(read_drug_summary_csv(os.path.join(ROOT, DRUG_SUMMARY_CSV))))
+
+
+def test_top_rejects_n_below_one(tmp_path, monkeypatch):
+    svc = _service(tmp_path, monkeypatch)
+    for n in ("0", "-3"):
+        status, body, _ = svc.respond("top", (("n", n),))
+        assert status == 400 and "n must be" in json.loads(body)["error"]
+
+
+def test_repeated_codes_count_once(tmp_path, monkeypatch):
+    svc = _service(tmp_path, monkeypatch)
+    region, drug = svc.cube.regions[0], svc.cube.drugs[0]
+    once = svc.respond("series", (("drug", drug), ("region", region)))
+    twice = svc.respond("series", (("drug", drug), ("drug", drug), ("region", region), ("region", region)))
+    assert twice[0] == 200 and json.loads(twice[1]) == json.loads(once[1])
@@ -0,0 +1,44 @@
+import os
+
+import pandas as pd
+import pytest
+
+from cube import build_cube
+from loader import DRUG_SUMMARY_CSV, read_drug_summary_csv
+from streaming import cubes_match, stream_cube
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SOURCE = os.path.join(ROOT, DRUG_SUMMARY_CSV)
+
+
+@pytest.fixture(scope="module")
+def sample(tmp_path_factory):
+    """
+    Every 47th row of the extract: all months, regions and most drugs, in
+    a file small enough to stream one row at a time.
+    """
+    path = tmp_path_factory.mktemp("data") / "sample.csv"
+    pd.read_csv(SOURCE, dtype=str).iloc[::47].to_csv(path, index=False)
+    return str(path)
+
+
+@pytest.mark.parametrize("chunksize", [1, 7, 64, 10_000])
+def test_matches_in_memory_cube(sample, chunksize, tmp_path):
+    reference = build_cube(read_drug_summary_csv(sample, cache_dir=str(tmp_path)))
+    streamed = stream_cube(sample, chunksize=chunksize, cache_dir=str(tmp_path))
+    assert cubes_match(streamed, reference)
+
+
+def test_full_extract_matches(tmp_path):
+    reference = build_cube(read_drug_summary_csv(SOURCE, cache_dir=str(tmp_path)))
+    for chunksize in (1000, 1_000_000):
+        assert cubes_match(stream_cube(SOURCE, chunksize=chunksize, cache_dir=str(tmp_path)), reference)
+
+
+def test_header_only_gives_empty_cube(tmp_path):
+    path = tmp_path / "empty.csv"
+    with open(SOURCE) as src:
+        path.write_text(src.readline())
+    cube = stream_cube(str(path), cache_dir=str(tmp_path))
+    assert cube.shape == (0, 0, 0)
+    assert len(cube.months) == len(cube.regions) == len(cube.drugs) == 0